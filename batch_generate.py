@@ -0,0 +1,201 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import card_engine
+import card_export
+import output_store
+import pptx_patcher
+from instrumentation import METRICS, STAGE_CARD, configure_logging, timed
+from template_registry import TEMPLATES_DIR, TemplateRegistry, load_cast_families
+
+# Способы рендеринга карт
+BACKENDS = {
+    'pptx': card_engine.render_card,
+    'patch': pptx_patcher.render_card,
+    # PNG в разрешении печати без PowerPoint; QR всегда растровый
+    'png': lambda template_path, data, output_dir, qr_mode: card_export.export_png(template_path, data, output_dir),
+}
+
+# Параметры процесса-обработчика
+_worker_registry = None
+_worker_output_dir = None
+_worker_render = None
+_worker_qr_mode = 'raster'
+
+
+def read_records(input_path):
+    """Читает записи форм из CSV или JSONL файла"""
+    ext = os.path.splitext(input_path)[1].lower()
+    if ext == '.csv':
+        with open(input_path, encoding='utf-8-sig', newline='') as f:
+            for record in csv.DictReader(f):
+                yield record
+    elif ext in ('.jsonl', '.ndjson'):
+        with open(input_path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"Ошибка в строке {line_number} файла {input_path}: {e}")
+    else:
+        raise ValueError("Поддерживаются только файлы .csv и .jsonl")
+
+
+def _init_worker(template_path, output_dir, backend, qr_mode, templates_dir):
+    # Компилируем шаблоны один раз на процесс, а не на каждую карту; измененный
+    # во время пакета шаблон реестр перечитывает сам
+    global _worker_registry, _worker_output_dir, _worker_render, _worker_qr_mode
+    _worker_registry = TemplateRegistry(templates_dir, template_path)
+    _worker_registry.precompile()
+    _worker_output_dir = output_dir
+    _worker_render = BACKENDS[backend]
+    _worker_qr_mode = qr_mode
+
+
+def _render_record(record):
+    # Метрики процесса-обработчика возвращаются вместе с результатом; карта,
+    # уже лежащая в каталоге с теми же данными, берется готовой и не считается созданной
+    try:
+        hits = output_store.directory_hits()
+        with timed(STAGE_CARD):
+            template_path = _worker_registry.template_for(record.get('family'))
+            output_path = _worker_render(template_path, record, _worker_output_dir, _worker_qr_mode)
+        return output_path, None, METRICS.drain(), output_store.directory_hits() > hits
+    except Exception as e:
+        return None, f"{record.get('cluster_number', '?')}: {e}", METRICS.drain(), False
+
+
+def _render_document(records):
+    # Одна презентация из нескольких карт; пишется в процессе-обработчике
+    try:
+        with timed(STAGE_CARD):
+            template_path = _worker_registry.template_for(records[0].get('family'))
+            outputs = pptx_patcher.render_documents(template_path, records, _worker_output_dir,
+                                                    len(records), _worker_qr_mode)
+        return outputs[0], None, METRICS.drain(), False
+    except Exception as e:
+        return None, f"{records[0].get('cluster_number', '?')}...: {e}", METRICS.drain(), False
+
+
+def generate_batch(records, template_path="ШАБЛОН.pptx", output_dir=".", workers=None, chunksize=8,
+                   backend='pptx', qr_mode='raster', cards_per_file=None, templates_dir=TEMPLATES_DIR):
+    """
+    Создает маршрутные карты для набора записей в пуле процессов.
+    Шаблон карты выбирается по семейству отливки (поле family записи
+    или справочник) из каталога templates_dir, иначе берется template_path.
+    При cards_per_file карты собираются в презентации по cards_per_file
+    слайдов (быстрым способом patch), иначе - по файлу на карту.
+    Возвращает словарь со списком файлов, ошибками и производительностью:
+    cards - созданные карты, cached - карты, уже лежавшие в output_dir с теми же
+    данными (они не рендерятся и в скорость не входят). Длительности этапов
+    из процессов собираются в общий METRICS.
+    """
+    # Семейство нужно, только если в каталоге есть шаблоны семейств. Записи к полям
+    # карты приводятся при рендеринге: поля зависят от спецификации выбранного шаблона
+    cast_families = load_cast_families() if TemplateRegistry(templates_dir, template_path).families else {}
+    records = [dict(record, family=record.get('family') or cast_families.get(str(record.get('cast_number') or '')))
+               for record in records]
+    os.makedirs(output_dir, exist_ok=True)
+
+    if cards_per_file:
+        if cards_per_file < 1:
+            raise ValueError("Количество карт в файле должно быть положительным")
+        backend = 'patch'
+        # В одной презентации - карты одного семейства (одного шаблона)
+        groups = {}
+        for data in records:
+            groups.setdefault(data['family'], []).append(data)
+        tasks = [group[i:i + cards_per_file] for group in groups.values()
+                 for i in range(0, len(group), cards_per_file)]
+        render, chunksize = _render_document, 1
+    else:
+        tasks, render = records, _render_record
+
+    outputs = []
+    errors = []
+    cards = 0
+    cached = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(template_path, output_dir, backend, qr_mode, templates_dir)) as pool:
+        for task, (output_path, error, metrics, hit) in zip(tasks, pool.map(render, tasks, chunksize=chunksize)):
+            METRICS.merge(metrics)
+            if error:
+                errors.append(error)
+                continue
+            outputs.append(output_path)
+            if hit:
+                cached += 1
+            else:
+                cards += len(task) if cards_per_file else 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        'outputs': outputs,
+        'errors': errors,
+        'cards': cards,
+        'cached': cached,
+        'elapsed': elapsed,
+        'cards_per_second': cards / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная генерация маршрутных карт без GUI")
+    parser.add_argument('input', help="CSV или JSONL файл с записями форм")
+    parser.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    parser.add_argument('--templates', default=TEMPLATES_DIR,
+                        help="Каталог шаблонов по семействам отливок (<имя>_ЛГМ.pptx и т.п.)")
+    parser.add_argument('--output-dir', default=".", help="Каталог для готовых карт")
+    parser.add_argument('--workers', type=int, default=None, help="Количество процессов (по умолчанию - число ядер)")
+    parser.add_argument('--chunksize', type=int, default=8, help="Количество карт в одной задаче процесса")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='pptx',
+                        help="Способ рендеринга: pptx (python-pptx), patch (прямая правка XML слайда) "
+                             "или png (картинка для печати без PowerPoint)")
+    parser.add_argument('--qr', choices=card_engine.QR_MODES, default='raster',
+                        help="QR-код картинкой PNG (raster) или векторной фигурой (vector)")
+    parser.add_argument('--cards-per-file', type=int, default=None,
+                        help="Собирать карты в презентации по N слайдов (способом patch) "
+                             "вместо отдельного файла на карту")
+    parser.add_argument('--metrics', help="Файл для длительностей этапов: .json или .prom (Prometheus)")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    try:
+        records = list(read_records(args.input))
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения входного файла: {e}")
+        return 1
+
+    if not records:
+        print("Входной файл не содержит записей.")
+        return 0
+
+    result = generate_batch(records, args.template, args.output_dir, args.workers, args.chunksize,
+                            args.backend, args.qr, args.cards_per_file, args.templates)
+
+    for error in result['errors']:
+        print(f"Ошибка: {error}")
+    print(f"Создано карт: {result['cards']} из {len(records)} "
+          f"за {result['elapsed']:.2f} с ({result['cards_per_second']:.1f} карт/с)")
+    if result['cached']:
+        print(f"Уже были в каталоге с теми же данными: {result['cached']}")
+    if args.cards_per_file:
+        print(f"Файлов: {len(result['outputs'])}")
+    if args.metrics:
+        METRICS.export(args.metrics)
+        print(f"Метрики этапов сохранены: {args.metrics}")
+    return 1 if result['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,606 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import card_engine
+import card_export
+import cast_index
+import create_history_db
+import generate_form
+import generate_form_pptx
+import pptx_patcher
+import print_spooler
+import qr_service
+import reference_import
+
+# Запись формы для замеров
+SAMPLE_RECORD = {
+    'cast_number': 'ЛСКМ.03.01.102-Л1',
+    'cast_name': 'Держатель ригеля',
+    'cluster_number': 'К25/03-001',
+    'gluing_date': '01.03.2025',
+    'gluing_executor': 'Буцик',
+    'gluing_quantity': '12',
+    'gluing_notes': '',
+    'control_date': '01.03.2025',
+    'control_time': '10:15',
+    'control_executor': 'Елхова',
+    'control_quantity': '12',
+    'control_notes': '',
+}
+
+
+def sample_records(count):
+    """Создает записи с разными номерами кластеров"""
+    for i in range(count):
+        record = dict(SAMPLE_RECORD)
+        record['cluster_number'] = f"К25/{i // 999 % 12 + 1:02d}-{i % 999 + 1:03d}"
+        yield record
+
+
+def bench_render_backends(template_path="ШАБЛОН.pptx", count=1000):
+    """Сравнивает скорость рендеринга python-pptx и прямой правки XML слайда"""
+    results = {}
+    for backend, render in (('pptx', card_engine.render_card), ('patch', pptx_patcher.render_card)):
+        with tempfile.TemporaryDirectory() as output_dir, contextlib.redirect_stdout(io.StringIO()):
+            # Прогрев: загрузка шаблона и компиляция плана не входят в замер
+            render(template_path, SAMPLE_RECORD, output_dir)
+            # Оба способа рендеринга начинают с пустым кэшем QR-кодов
+            qr_service.clear_cache()
+            started = time.perf_counter()
+            for record in sample_records(count):
+                render(template_path, record, output_dir)
+            elapsed = time.perf_counter() - started
+        results[backend] = {'cards': count, 'seconds': elapsed, 'cards_per_second': count / elapsed}
+    results['speedup'] = results['pptx']['seconds'] / results['patch']['seconds']
+    return results
+
+
+def bench_batch_document(template_path="ШАБЛОН.pptx", count=200, cards_per_file=200):
+    """
+    Сравнивает карты отдельными файлами и презентациями по cards_per_file слайдов:
+    время и объем на карту, а также добавку одной карты к презентации
+    """
+    records = [card_engine.normalize_form_data(record) for record in sample_records(count)]
+    patcher = pptx_patcher.get_patcher(template_path)
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for mode, render in (
+                ('files', lambda: [pptx_patcher.render_card(template_path, record, output_dir)
+                                   for record in records]),
+                ('document', lambda: pptx_patcher.render_documents(template_path, records, output_dir,
+                                                                   cards_per_file))):
+            qr_service.clear_cache()
+            started = time.perf_counter()
+            outputs = render()
+            elapsed = time.perf_counter() - started
+            size = sum(os.path.getsize(path) for path in outputs)
+            for path in outputs:
+                os.remove(path)
+            results[mode] = {'cards': count, 'files': len(outputs), 'seconds': elapsed,
+                             'ms_per_card': elapsed * 1000 / count, 'kb_per_card': size / 1024 / count}
+
+    # Добавка одной карты: разница между презентациями из 2 и 1 слайда
+    sizes = []
+    for cards in (1, 2):
+        out = io.BytesIO()
+        patcher.render_document(records[:cards], out)
+        sizes.append(len(out.getvalue()))
+    results['marginal_kb'] = (sizes[1] - sizes[0]) / 1024
+    results['single_kb'] = sizes[0] / 1024
+    return results
+
+
+def _allocate_numbers(db_path, date_str, rounds, batch):
+    # Процесс-участник нагрузочной проверки со своим репозиторием
+    repository = create_history_db.HistoryRepository(db_path, pool_size=1)
+    numbers = []
+    try:
+        for _ in range(rounds):
+            numbers.extend(repository.reserve_cluster_numbers(date_str, batch))
+    finally:
+        repository.close()
+    return numbers
+
+
+def stress_cluster_allocation(processes=8, rounds=40, batch=3, date_str="01.03.2025"):
+    """
+    Несколько процессов одновременно резервируют номера кластеров в одной базе.
+    Проверяет, что выданные номера не повторяются и идут без пропусков.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'история_форм.db')
+        repository = create_history_db.HistoryRepository(db_path)
+        try:
+            repository.create_schema()
+        finally:
+            # Открытое соединение WAL не должно достаться процессам пула при fork
+            repository.close()
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(_allocate_numbers, db_path, date_str, rounds, batch)
+                       for _ in range(processes)]
+            numbers = [number for future in futures for number in future.result()]
+        elapsed = time.perf_counter() - started
+
+    sequence = sorted(int(number[-3:]) for number in numbers)
+    return {
+        'allocated': len(numbers),
+        'duplicates': len(numbers) - len(set(numbers)),
+        'gaps': sequence != list(range(1, len(numbers) + 1)),
+        'seconds': elapsed,
+    }
+
+
+def bench_history_bulk_insert(rows=5000, chunk_size=500):
+    """Сравнивает сохранение форм по одной и пачками через save_forms_bulk"""
+    records = []
+    for i in range(rows):
+        record = dict(SAMPLE_RECORD)
+        record['cluster_number'] = f"К{i // 11988 % 100:02d}/{i // 999 % 12 + 1:02d}-{i % 999 + 1:03d}"
+        records.append(record)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('per_row', 'bulk'):
+            repository = create_history_db.HistoryRepository(os.path.join(tmp, f'{mode}.db'))
+            repository.create_schema()
+            started = time.perf_counter()
+            if mode == 'bulk':
+                repository.save_forms_bulk(records, chunk_size)
+            else:
+                for record in records:
+                    repository.save_form(record)
+            elapsed = time.perf_counter() - started
+            repository.close()
+            results[mode] = {'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed}
+    results['speedup'] = results['per_row']['seconds'] / results['bulk']['seconds']
+    return results
+
+
+def bench_cast_typeahead(casts=10000, queries=2000, limit=20):
+    """Замеряет время ответа индекса отливок на один набранный символ"""
+    words = ('Держатель', 'Кронштейн', 'Корпус', 'Фиксатор', 'Вороток', 'Полухомут', 'Накладка')
+    catalog = [(f"ЛСКМ.{i // 1000:02d}.{i // 10 % 100:02d}.{i:03d}-Л", f"{words[i % len(words)]} {i}")
+               for i in range(casts)]
+
+    started = time.perf_counter()
+    index = cast_index.CastIndex(catalog)
+    build_seconds = time.perf_counter() - started
+
+    # Запросы, как при наборе по буквам: начало номера, начало и середина наименования
+    typed = []
+    for i in range(queries):
+        number, name = catalog[i * 7919 % casts]
+        text = (number, name, name[3:])[i % 3]
+        typed.append(text[:i % 8 + 1])
+
+    timings = []
+    for query in typed:
+        started = time.perf_counter()
+        index.search(query, limit)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'casts': casts,
+        'build_seconds': build_seconds,
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'p99_ms': timings[int(len(timings) * 0.99)] * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+def bench_reference_import(castings=50000):
+    """Замеряет загрузку большого каталога отливок и повторную загрузку без изменений"""
+    families = ('ЛГМ', 'ЛПД', 'Прочие')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'отливки.csv')
+        with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Номер', 'Наименование', 'Семейство'])
+            for i in range(castings):
+                writer.writerow([f"ЛСКМ.{i // 1000:02d}.{i % 1000:03d}-Л", f"Отливка {i}", families[i % 3]])
+
+        db_path = os.path.join(tmp, 'справочник.db')
+        for run in ('first', 'repeat'):
+            started = time.perf_counter()
+            report = reference_import.import_file(csv_path, db_path)
+            elapsed = time.perf_counter() - started
+            results[run] = {'seconds': elapsed, 'added': len(report['added']), 'unchanged': report['unchanged']}
+    results['castings'] = castings
+    return results
+
+
+# Заглушка lpr: записывает переданные файлы в журнал, первые FAIL_FIRST вызовов завершаются ошибкой
+_STUB_LPR = '''import os, sys
+log_path, fail_first = sys.argv[1], int(sys.argv[2])
+with open(log_path, 'a', encoding='utf-8') as log:
+    log.write('\\t'.join(sys.argv[3:]) + '\\n')
+calls = sum(1 for _ in open(log_path, encoding='utf-8'))
+if calls <= fail_first:
+    sys.stderr.write('printer offline')
+    sys.exit(1)
+'''
+
+
+def check_print_spooler(jobs=25, fail_first=1, batch_window=0.2, max_batch=10):
+    """
+    Проверяет очередь печати на заглушке lpr: все задания печатаются,
+    файлы объединяются в пачки, ошибки повторяются, а submit не блокирует.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        stub_path = os.path.join(tmp, 'lpr_stub.py')
+        log_path = os.path.join(tmp, 'lpr.log')
+        with open(stub_path, 'w', encoding='utf-8') as f:
+            f.write(_STUB_LPR)
+
+        def stub_command(paths, printer=None, copies=1):
+            return [sys.executable, stub_path, log_path, str(fail_first)] + list(paths)
+
+        spooler = print_spooler.PrintSpooler(command_factory=stub_command, retry_delay=0.05,
+                                             batch_window=batch_window, max_batch=max_batch)
+        submit_seconds = []
+        submitted = []
+        started = time.perf_counter()
+        for i in range(jobs):
+            path = os.path.join(tmp, f'card_{i}.pptx')
+            before = time.perf_counter()
+            submitted.append(spooler.submit(path))
+            submit_seconds.append(time.perf_counter() - before)
+        spooler.shutdown(timeout=60)
+        elapsed = time.perf_counter() - started
+
+        with open(log_path, encoding='utf-8') as f:
+            calls = [line.rstrip('\n').split('\t') for line in f]
+    printed = [path for call in calls[fail_first:] for path in call]
+    return {
+        'jobs': jobs,
+        'done': sum(job.status == print_spooler.JOB_DONE for job in submitted),
+        'commands': len(calls),
+        'retries': fail_first,
+        'all_printed_once': sorted(printed) == sorted(job.path for job in submitted),
+        'max_submit_ms': max(submit_seconds) * 1000,
+        'seconds': elapsed,
+    }
+
+
+def bench_gui_responsiveness(template_path="ШАБЛОН.pptx", cards=10, click_interval=50):
+    """
+    Отзывчивость окна при создании карт: оператор нажимает кнопку каждые
+    click_interval мс. Сравнивается прежняя генерация прямо в обработчике
+    кнопки и очередь генерации в пуле потоков. Отзывчивость - опоздание
+    таймера в потоке GUI (см. ResponsivenessProbe).
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6.QtCore import QEventLoop, QTimer
+    from PySide6.QtWidgets import QApplication
+    from generation_worker import GenerationQueue, ResponsivenessProbe
+
+    app = QApplication.instance() or QApplication([])
+    card_engine.load_template(template_path)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('sync', 'pool'):
+            repo = create_history_db.HistoryRepository(os.path.join(tmp, f'{mode}.db'))
+            output_dir = os.path.join(tmp, mode)
+            os.makedirs(output_dir)
+
+            def render(template, data, output_dir=output_dir):
+                return card_engine.render_card(template, data, output_dir)
+
+            records = list(sample_records(cards))
+            loop = QEventLoop()
+            done = []
+            queue = GenerationQueue(template_path, render=render, save=repo.save_form)
+            queue.signals.finished.connect(lambda job_id, path, data: done.append(path))
+            queue.signals.failed.connect(lambda job_id, message, is_warning: done.append(None))
+
+            def click(record):
+                if mode == 'sync':
+                    # Как прежде: рендеринг и запись в историю в обработчике кнопки
+                    done.append(render(template_path, record))
+                    repo.save_form(record)
+                else:
+                    queue.submit(record)
+
+            def check_done():
+                if len(done) == cards:
+                    loop.quit()
+
+            probe = ResponsivenessProbe()
+            watcher = QTimer()
+            watcher.timeout.connect(check_done)
+            started = time.perf_counter()
+            probe.start()
+            watcher.start(10)
+            for i, record in enumerate(records):
+                QTimer.singleShot(i * click_interval, lambda record=record: click(record))
+            loop.exec()
+            elapsed = time.perf_counter() - started
+            probe.stop()
+            watcher.stop()
+            queue.wait()
+            repo.close()
+            results[mode] = dict(probe.stats(), cards=len(done), seconds=elapsed)
+    app.processEvents()
+    return results
+
+
+# Размеры базы истории для замеров сохранения и выдачи номеров
+SUITE_HISTORY_SIZES = (1, 100, 10000, 1000000)
+
+# Допустимое замедление относительно базового отчета (доля)
+SUITE_THRESHOLD = 0.2
+
+# Годы номеров кластеров для записей, добавляемых во время замеров
+# (заполнение базы использует годы с 00 по 83)
+_SUITE_SAVE_YEAR = 98
+_SUITE_ALLOCATION_YEAR = 99
+
+
+def _history_record(i, year=None):
+    record = dict(SAMPLE_RECORD)
+    year = i // 11988 % 100 if year is None else year
+    record['cluster_number'] = f"К{year:02d}/{i // 999 % 12 + 1:02d}-{i % 999 + 1:03d}"
+    return record
+
+
+def _timings(func, runs):
+    # Длительность каждого вызова, мс
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def _summary(timings):
+    timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'median_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'min_ms': timings[0],
+        'mean_ms': statistics.fmean(timings),
+    }
+
+
+def _bench_renderers(template_path, tmp, runs):
+    results = {}
+    records = list(sample_records(runs + 1))
+    png_template = os.path.join(tmp, 'ШАБЛОН.png')
+    # Шаблон-картинка для PIL-генератора: фон карты, отрисованный card_export
+    card_export.get_rasterizer(template_path, 150).background.save(png_template)
+    out = os.path.join(tmp, 'out')
+    os.makedirs(out)
+    cases = {
+        'generate_form.generate_form_with_qr': lambda i: generate_form.generate_form_with_qr(
+            png_template, os.path.join(out, f'{i}.png'), records[i]['cluster_number']),
+        'generate_form_pptx.generate_form_with_qr': lambda i: generate_form_pptx.generate_form_with_qr(
+            template_path, os.path.join(out, f'{i}.pptx'), records[i]['cluster_number']),
+        # То же, что MainWindow.generate_pptx_with_data
+        'gui.generate_pptx_with_data': lambda i: card_engine.render_card(template_path, records[i], out),
+        # Повторная печать: карта уже создана предыдущим замером
+        'gui.reprint_cached': lambda i: card_engine.render_card(template_path, records[i], out),
+    }
+    for name, func in cases.items():
+        # Прогрев: загрузка шаблона и кэши не входят в замер
+        func(runs)
+        qr_service.clear_cache()
+        results[name] = _summary(_timings(func, runs))
+    return results
+
+
+def _fill_history(repository, start, stop, chunk_size=5000):
+    for offset in range(start, stop, chunk_size):
+        repository.save_forms_bulk([_history_record(i) for i in range(offset, min(stop, offset + chunk_size))],
+                                   chunk_size)
+
+
+def run_suite(template_path="ШАБЛОН.pptx", sizes=SUITE_HISTORY_SIZES, render_runs=20, db_runs=200,
+              progress=None):
+    """
+    Набор замеров для проверки изменений производительности: генераторы карт
+    (PIL, python-pptx, рендеринг окна) и функции истории save_form_data и
+    get_next_cluster_number на базе из sizes записей. Возвращает отчет,
+    пригодный для записи в JSON и сравнения с базовым (check_regressions).
+    """
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': create_history_db.sqlite3.sqlite_version,
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        report['results'].update(_bench_renderers(template_path, tmp, render_runs))
+
+        # Функции истории работают с общим репозиторием; на время замеров
+        # он подменяется репозиторием временной базы
+        repository = create_history_db.HistoryRepository(os.path.join(tmp, 'история_форм.db'))
+        repository.create_schema()
+        saved_repository = create_history_db._repository
+        create_history_db._repository = repository
+        try:
+            filled = 0
+            saved = 0
+            allocated = 0
+            for size in sorted(sizes):
+                if progress:
+                    progress(f"Заполнение истории до {size} записей")
+                _fill_history(repository, filled, size)
+                filled = size
+
+                def save(i):
+                    create_history_db.save_form_data(_history_record(saved + i, _SUITE_SAVE_YEAR))
+
+                def allocate(i):
+                    # Месяц меняется каждые 900 номеров, чтобы не упереться в предел месяца
+                    month = (allocated + i) // 900 % 12 + 1
+                    create_history_db.get_next_cluster_number(f"01.{month:02d}.20{_SUITE_ALLOCATION_YEAR}")
+
+                report['results'][f'save_form_data[{size}]'] = _summary(_timings(save, db_runs))
+                report['results'][f'get_next_cluster_number[{size}]'] = _summary(_timings(allocate, db_runs))
+                saved += db_runs
+                allocated += db_runs
+        finally:
+            create_history_db._repository = saved_repository
+            repository.close()
+    return report
+
+
+def check_regressions(report, baseline, threshold=SUITE_THRESHOLD):
+    """
+    Сравнивает медианы замеров с базовым отчетом. Возвращает список
+    (замер, было мс, стало мс) для замеров, замедлившихся больше чем на threshold.
+    """
+    regressions = []
+    for name, result in report['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        if result['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append((name, base['median_ms'], result['median_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности генерации карт")
+    commands = parser.add_subparsers(dest='command')
+
+    render = commands.add_parser('render', help="Сравнение способов рендеринга карт")
+    render.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    render.add_argument('--cards', type=int, default=1000, help="Количество карт в пакете")
+
+    document = commands.add_parser('document', help="Карты отдельными файлами и одной презентацией")
+    document.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    document.add_argument('--cards', type=int, default=200, help="Количество карт в пакете")
+    document.add_argument('--cards-per-file', type=int, default=200, help="Карт в одной презентации")
+
+    allocation = commands.add_parser('allocation', help="Нагрузочная проверка выдачи номеров кластеров")
+    allocation.add_argument('--processes', type=int, default=8, help="Количество процессов")
+    allocation.add_argument('--rounds', type=int, default=40, help="Резервирований на процесс")
+    allocation.add_argument('--batch', type=int, default=3, help="Номеров в одном резервировании")
+    bulk = commands.add_parser('bulk', help="Сохранение форм по одной и пачками")
+    bulk.add_argument('--rows', type=int, default=5000, help="Количество форм")
+    bulk.add_argument('--chunk-size', type=int, default=500, help="Размер пачки")
+    typeahead = commands.add_parser('typeahead', help="Поиск отливок при вводе")
+    typeahead.add_argument('--casts', type=int, default=10000, help="Количество отливок в справочнике")
+    typeahead.add_argument('--queries', type=int, default=2000, help="Количество запросов")
+    reference = commands.add_parser('reference', help="Загрузка каталога отливок в справочник")
+    reference.add_argument('--castings', type=int, default=50000, help="Количество отливок в файле")
+    spooler = commands.add_parser('spooler', help="Проверка очереди печати на заглушке lpr")
+    spooler.add_argument('--jobs', type=int, default=25, help="Количество заданий")
+    spooler.add_argument('--fail-first', type=int, default=1, help="Сколько первых вызовов lpr завершатся ошибкой")
+    gui = commands.add_parser('gui', help="Отзывчивость окна при создании карт")
+    gui.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    gui.add_argument('--cards', type=int, default=10, help="Количество карт")
+    suite = commands.add_parser('suite', help="Набор замеров с отчетом JSON и проверкой замедлений")
+    suite.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    suite.add_argument('--sizes', default=','.join(map(str, SUITE_HISTORY_SIZES)),
+                       help="Размеры базы истории через запятую")
+    suite.add_argument('--render-runs', type=int, default=20, help="Повторов замеров генераторов")
+    suite.add_argument('--db-runs', type=int, default=200, help="Повторов замеров функций истории")
+    suite.add_argument('--report', default='benchmark_report.json', help="Файл отчета JSON")
+    suite.add_argument('--baseline', help="Базовый отчет для проверки замедлений")
+    suite.add_argument('--threshold', type=float, default=SUITE_THRESHOLD,
+                       help="Допустимое замедление медианы, доля (0.2 - на 20%%)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'suite':
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+        report = run_suite(args.template, sizes, args.render_runs, args.db_runs,
+                           progress=lambda message: print(message, file=sys.stderr))
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        for name, r in report['results'].items():
+            print(f"{name:<45} медиана {r['median_ms']:8.3f} мс, p95 {r['p95_ms']:8.3f} мс ({r['runs']} повторов)")
+        print(f"Отчет сохранен: {args.report}")
+        if not args.baseline:
+            return 0
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = check_regressions(report, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f"Замедление: {name}: {before:.3f} мс -> {after:.3f} мс (+{(after / before - 1) * 100:.0f}%)")
+        if not regressions:
+            print(f"Замедлений больше {args.threshold * 100:.0f}% нет")
+        return 1 if regressions else 0
+
+    if args.command == 'gui':
+        results = bench_gui_responsiveness(args.template, args.cards)
+        for mode in ('sync', 'pool'):
+            r = results[mode]
+            print(f"{mode:>5}: {r['cards']} карт за {r['seconds']:.2f} с; опоздание таймера окна: "
+                  f"медиана {r['median_ms']:.1f} мс, p99 {r['p99_ms']:.1f} мс, максимум {r['max_ms']:.1f} мс")
+        return 0
+
+    if args.command == 'spooler':
+        r = check_print_spooler(args.jobs, args.fail_first)
+        print(f"Напечатано заданий: {r['done']} из {r['jobs']}, вызовов lpr: {r['commands']} "
+              f"(из них с ошибкой: {r['retries']}), каждый файл ровно один раз: "
+              f"{'да' if r['all_printed_once'] else 'нет'}; submit не дольше {r['max_submit_ms']:.2f} мс, "
+              f"всего {r['seconds']:.2f} с")
+        return 0 if r['done'] == r['jobs'] and r['all_printed_once'] else 1
+
+    if args.command == 'reference':
+        results = bench_reference_import(args.castings)
+        for run in ('first', 'repeat'):
+            r = results[run]
+            print(f"{run:>6}: {results['castings']} отливок за {r['seconds']:.2f} с "
+                  f"(добавлено {r['added']}, без изменений {r['unchanged']})")
+        return 0
+
+    if args.command == 'typeahead':
+        r = bench_cast_typeahead(args.casts, args.queries)
+        print(f"Индекс {r['casts']} отливок построен за {r['build_seconds'] * 1000:.0f} мс; "
+              f"запрос: медиана {r['median_ms']:.3f} мс, p99 {r['p99_ms']:.3f} мс, максимум {r['max_ms']:.3f} мс")
+        return 0
+
+    if args.command == 'bulk':
+        results = bench_history_bulk_insert(args.rows, args.chunk_size)
+        for mode in ('per_row', 'bulk'):
+            r = results[mode]
+            print(f"{mode:>8}: {r['rows']} записей за {r['seconds']:.2f} с ({r['rows_per_second']:.0f} записей/с)")
+        print(f"Ускорение: {results['speedup']:.1f}x")
+        return 0
+
+    if args.command == 'document':
+        results = bench_batch_document(args.template, args.cards, args.cards_per_file)
+        for mode in ('files', 'document'):
+            r = results[mode]
+            print(f"{mode:>8}: {r['cards']} карт в {r['files']} файлах за {r['seconds']:.2f} с "
+                  f"({r['ms_per_card']:.2f} мс и {r['kb_per_card']:.1f} КБ на карту)")
+        print(f"Презентация из одной карты: {results['single_kb']:.1f} КБ, "
+              f"каждая следующая карта: {results['marginal_kb']:.1f} КБ")
+        return 0
+
+    if args.command == 'allocation':
+        result = stress_cluster_allocation(args.processes, args.rounds, args.batch)
+        print(f"Выдано номеров: {result['allocated']} за {result['seconds']:.2f} с, "
+              f"повторов: {result['duplicates']}, пропуски: {'есть' if result['gaps'] else 'нет'}")
+        return 1 if result['duplicates'] or result['gaps'] else 0
+
+    results = bench_render_backends(getattr(args, 'template', "ШАБЛОН.pptx"), getattr(args, 'cards', 1000))
+    for backend in ('pptx', 'patch'):
+        r = results[backend]
+        print(f"{backend:>6}: {r['cards']} карт за {r['seconds']:.2f} с ({r['cards_per_second']:.1f} карт/с)")
+    print(f"Ускорение: {results['speedup']:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+from pptx import Presentation
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls
+from pptx.util import Pt
+import hashlib
+import json
+import logging
+import os
+import threading
+from copy import deepcopy
+from functools import lru_cache
+from io import BytesIO
+from instrumentation import (STAGE_QR_ENCODE, STAGE_SAVE, STAGE_TABLE_FILL, STAGE_TEMPLATE_LOAD,
+                             timed)
+from qr_service import QR_CACHE_SIZE, qr_matrix, qr_png, qr_rectangles
+from template_registry import mapping_path_for
+from template_plan import compile_slide_plan, get_template_plan, load_mapping, mapping_fields, mapping_hash
+
+logger = logging.getLogger(__name__)
+
+# Поля формы маршрутной карты, которые вводит оператор и хранит история
+FORM_FIELDS = (
+    'cast_number',
+    'cast_name',
+    'cluster_number',
+    'gluing_date',
+    'gluing_executor',
+    'gluing_quantity',
+    'gluing_notes',
+    'control_date',
+    'control_time',
+    'control_executor',
+    'control_quantity',
+    'control_notes',
+)
+
+
+
+def fields_for_mapping(mapping):
+    """Поля карты: поля формы и поля других операций из спецификации заполнения"""
+    return FORM_FIELDS + tuple(field for field in mapping_fields(mapping) if field not in FORM_FIELDS)
+
+
+# Поля карты по общей спецификации (у шаблона может быть своя, см. template_fields)
+CARD_FIELDS = fields_for_mapping(load_mapping())
+
+# Способы вывода QR-кода: PNG-картинка или векторная фигура
+QR_MODES = ('raster', 'vector')
+
+# Загруженные шаблоны: путь -> (байты файла, спецификация заполнения, версия)
+_templates = {}
+
+# Поля карты по версии шаблона (см. template_fields)
+_template_fields = {}
+
+
+# Сколько символов ключа содержимого добавляется к имени файла карты
+OUTPUT_KEY_LENGTH = 12
+
+
+def normalize_form_data(record, fields=CARD_FIELDS):
+    """Приводит запись к словарю со всеми полями карты (fields) в виде строк"""
+    data = {}
+    for field in fields:
+        value = record.get(field)
+        data[field] = '' if value is None else str(value)
+    return data
+
+
+def _read_template(template_path):
+    if not os.path.exists(template_path):
+        raise FileNotFoundError(f"Файл {template_path} не найден")
+    with open(template_path, 'rb') as f:
+        template_bytes = f.read()
+    mapping_path = mapping_path_for(template_path)
+    mapping = load_mapping(mapping_path, reload=True) if mapping_path else load_mapping()
+    digest = hashlib.sha256(template_bytes)
+    digest.update(mapping_hash(mapping).encode('ascii'))
+    return template_bytes, mapping, digest.hexdigest()
+
+
+def template_entry(template_path):
+    """Шаблон из кэша: (байты файла, спецификация заполнения, версия)"""
+    entry = _templates.get(template_path)
+    if entry is None:
+        entry = _templates[template_path] = _read_template(template_path)
+    return entry
+
+
+def load_template(template_path):
+    """Читает шаблон с диска один раз и возвращает его содержимое из кэша"""
+    return template_entry(template_path)[0]
+
+
+def template_hash(template_path):
+    """Версия шаблона: SHA-256 содержимого файла и его спецификации заполнения"""
+    return template_entry(template_path)[2]
+
+
+def template_fields(template_path):
+    """Поля карты по спецификации заполнения шаблона (общей или его собственной)"""
+    _, mapping, version = template_entry(template_path)
+    fields = _template_fields.get(version)
+    if fields is None:
+        fields = _template_fields[version] = fields_for_mapping(mapping)
+    return fields
+
+
+def reload_template(template_path):
+    """
+    Перечитывает шаблон и его спецификацию заполнения. Возвращает True,
+    если версия изменилась; снимки, патчеры и растеризаторы со старой
+    версией пересоздаются при следующем обращении в своих потоках.
+    """
+    entry = _read_template(template_path)
+    previous = _templates.get(template_path)
+    _templates[template_path] = entry
+    return previous is None or previous[2] != entry[2]
+
+
+def card_key(template_path, data, variant=''):
+    """
+    Ключ содержимого карты: хэш шаблона, способа вывода (variant: формат,
+    вывод QR-кода) и полей карты этого шаблона. Одинаковые карты получают один ключ.
+    """
+    digest = hashlib.sha256(template_hash(template_path).encode('ascii'))
+    digest.update(variant.encode('utf-8'))
+    digest.update(json.dumps([data.get(field, '') for field in template_fields(template_path)],
+                             ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class TemplateSnapshot:
+    """
+    Разобранный один раз шаблон, из которого выпускаются карты.
+    Для новой карты восстанавливается только дерево фигур слайда,
+    остальные части пакета (макеты, тема, медиа) используются повторно.
+    """
+
+    def __init__(self, template_bytes, mapping=None):
+        self.prs = Presentation(BytesIO(template_bytes))
+        if not self.prs.slides:
+            raise ValueError("Презентация не содержит слайдов")
+        self.plan = get_template_plan(template_bytes, mapping)
+        self.version = None
+        self.slide = self.prs.slides[0]
+        self._sp_tree = self.slide.shapes._spTree
+        self._pristine_shapes = [deepcopy(child) for child in self._sp_tree]
+        self._pristine_rids = set(self.slide.part.rels.keys())
+        self._dirty = False
+
+    def new_card(self):
+        """Возвращает слайд шаблона в исходном состоянии"""
+        if self._dirty:
+            # Элемент spTree сохраняем, меняем только его содержимое
+            self._sp_tree[:] = [deepcopy(child) for child in self._pristine_shapes]
+            # Удаляем связи с картинками, добавленными в прошлую карту
+            for rId in list(self.slide.part.rels.keys()):
+                if rId not in self._pristine_rids:
+                    self.slide.part.drop_rel(rId)
+        self._dirty = True
+        return self.slide
+
+    def save(self, output):
+        self.prs.save(output)
+
+
+# Снимки шаблонов отдельно для каждого потока: путь -> TemplateSnapshot
+_snapshots = threading.local()
+
+
+def get_snapshot(template_path):
+    """Возвращает снимок шаблона для текущего потока"""
+    cache = getattr(_snapshots, 'cache', None)
+    if cache is None:
+        cache = _snapshots.cache = {}
+    template_bytes, mapping, version = template_entry(template_path)
+    snapshot = cache.get(template_path)
+    # Шаблон мог измениться на диске: снимок старой версии создается заново
+    if snapshot is None or snapshot.version != version:
+        with timed(STAGE_TEMPLATE_LOAD):
+            snapshot = cache[template_path] = TemplateSnapshot(template_bytes, mapping)
+        snapshot.version = version
+    return snapshot
+
+
+def _write_cell(cell, text):
+    # Записываем текст в первый run ячейки маленьким жирным шрифтом
+    paragraph = cell.text_frame.paragraphs[0]
+    run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
+    if text is not None:
+        run.text = text
+    run.font.size = Pt(9)
+    run.font.bold = True
+
+
+def make_qr_stream(cluster_number):
+    """Создает PNG с QR-кодом номера кластера"""
+    try:
+        logger.debug("Создание QR-кода для значения: %s", cluster_number)
+        png = qr_png(str(cluster_number))  # Явно преобразуем в строку
+    except Exception as e:
+        logger.error("Ошибка при создании QR-кода: %s", e)
+        raise
+    return BytesIO(png)
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_path_xml(payload):
+    """Контур QR-кода для custGeom: один путь из прямоугольников темных модулей"""
+    count = len(qr_matrix(payload))
+    commands = ''.join(
+        f'<a:moveTo><a:pt x="{x}" y="{y}"/></a:moveTo>'
+        f'<a:lnTo><a:pt x="{x + w}" y="{y}"/></a:lnTo>'
+        f'<a:lnTo><a:pt x="{x + w}" y="{y + h}"/></a:lnTo>'
+        f'<a:lnTo><a:pt x="{x}" y="{y + h}"/></a:lnTo>'
+        f'<a:close/>'
+        for x, y, w, h in qr_rectangles(payload)
+    )
+    return f'<a:pathLst><a:path w="{count}" h="{count}" stroke="0">{commands}</a:path></a:pathLst>'
+
+
+def add_vector_qr(slide, payload, left, top, width, height):
+    """Рисует QR-код фигурой DrawingML вместо картинки"""
+    shapes = slide.shapes
+    shape_id = shapes._next_shape_id
+    sp = parse_xml(
+        f'<p:sp {nsdecls("a", "p")}>'
+        f'<p:nvSpPr><p:cNvPr id="{shape_id}" name="QR-код {shape_id - 1}"/><p:cNvSpPr/><p:nvPr/></p:nvSpPr>'
+        f'<p:spPr>'
+        f'<a:xfrm><a:off x="{int(left)}" y="{int(top)}"/><a:ext cx="{int(width)}" cy="{int(height)}"/></a:xfrm>'
+        f'<a:custGeom><a:avLst/><a:gdLst/><a:ahLst/><a:cxnLst/><a:rect l="0" t="0" r="r" b="b"/>'
+        f'{qr_path_xml(payload)}</a:custGeom>'
+        f'<a:solidFill><a:srgbClr val="000000"/></a:solidFill><a:ln><a:noFill/></a:ln>'
+        f'</p:spPr>'
+        f'</p:sp>'
+    )
+    shapes._spTree.insert_element_before(sp, 'p:extLst')
+    return sp
+
+
+def fill_slide(slide, data, plan=None, qr_mode='raster'):
+    """Заполняет слайд маршрутной карты данными формы по плану шаблона"""
+    if plan is None:
+        plan = compile_slide_plan(slide)
+
+    # Добавляем QR-код рядом с "МАРШРУТНАЯ КАРТА"
+    with timed(STAGE_QR_ENCODE):
+        if qr_mode == 'vector':
+            for left, top, width, height in plan['qr_positions']:
+                add_vector_qr(slide, str(data['cluster_number']), left, top, width, height)
+        elif plan['qr_positions']:
+            image_stream = make_qr_stream(data['cluster_number'])
+            for left, top, width, height in plan['qr_positions']:
+                image_stream.seek(0)
+                slide.shapes.add_picture(image_stream, left, top, width=width, height=height)
+
+    # Пишем значения прямо в известные ячейки таблиц
+    with timed(STAGE_TABLE_FILL):
+        shapes = list(slide.shapes)
+        for shape_index, row, col, field in plan['cells']:
+            try:
+                cell = shapes[shape_index].table.cell(row, col)
+                _write_cell(cell, data.get(field, '') if field else None)
+            except Exception as e:
+                logger.error("Ошибка при заполнении ячейки (%s, %s): %s", row, col, e)
+
+
+def build_output_path(cluster_number, output_dir=None, ext='.pptx', key=None):
+    """
+    Формирует имя выходного файла для номера кластера без перебора занятых
+    имен: к имени добавляется начало ключа содержимого key (см. card_key),
+    поэтому разные карты одного кластера не совпадают, а одинаковые - совпадают
+    """
+    # Заменяем недопустимые символы
+    cluster_number = cluster_number.replace('/', '_').replace('\\', '_')
+    name = f"маршрутная_карта_{cluster_number}"
+    if key:
+        name = f"{name}_{key[:OUTPUT_KEY_LENGTH]}"
+    return os.path.join(output_dir or '', f"{name}{ext}")
+
+
+def render_card(template_path, data, output_dir=None, qr_mode='raster'):
+    """
+    Создает маршрутную карту по шаблону и возвращает путь к файлу.
+    Без output_dir карта попадает в хранилище карт (см. output_store),
+    и повторный вызов с теми же данными возвращает готовый файл.
+    """
+    from output_store import write_card
+    data = normalize_form_data(data, template_fields(template_path))
+
+    def write(f):
+        snapshot = get_snapshot(template_path)
+        fill_slide(snapshot.new_card(), data, snapshot.plan, qr_mode)
+        with timed(STAGE_SAVE):
+            snapshot.save(f)
+
+    return write_card(template_path, data, '.pptx', qr_mode, write, output_dir)
@@ -0,0 +1,470 @@
+import argparse
+import logging
+import os
+import sys
+import zlib
+from functools import lru_cache
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.enum.text import MSO_ANCHOR, PP_ALIGN
+from pptx.oxml.ns import qn
+
+import card_engine
+from instrumentation import configure_logging
+from qr_service import qr_image
+from template_plan import get_template_plan
+
+logger = logging.getLogger(__name__)
+
+# Разрешение для печати (точек на дюйм)
+PRINT_DPI = 300
+
+# Раскладка карт на листе PDF: карт на листе -> (столбцов, строк)
+SHEET_LAYOUTS = {1: (1, 1), 2: (2, 1), 4: (2, 2)}
+
+EMU_PER_INCH = 914400
+EMU_PER_POINT = 12700
+
+# Шрифт значений полей, как в fill_slide
+FIELD_FONT_PT = 9
+
+# Размер шрифта ячеек без явного размера
+DEFAULT_FONT_PT = 11
+
+# Во сколько раз можно уменьшить шрифт текста, не помещающегося в ячейку или рамку;
+# то, что не поместится и так, обрезается по границе
+MIN_FONT_SCALE = 0.6
+FONT_SCALE_STEP = 0.9
+
+# Внутренние отступы ячеек таблицы по умолчанию (EMU)
+CELL_MARGIN_X = 91440
+CELL_MARGIN_Y = 45720
+
+# Шрифты с кириллицей; первым берется шрифт из переменной окружения
+FONT_CANDIDATES = (
+    os.environ.get('FORMBUILDER_FONT'),
+    'arial.ttf',
+    'DejaVuSans.ttf',
+    'LiberationSans-Regular.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
+)
+BOLD_FONT_CANDIDATES = (
+    os.environ.get('FORMBUILDER_FONT_BOLD'),
+    'arialbd.ttf',
+    'DejaVuSans-Bold.ttf',
+    'LiberationSans-Bold.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
+)
+
+# Кэш растеризаторов: (путь к шаблону, разрешение) -> CardRasterizer
+_rasterizers = {}
+
+
+@lru_cache(maxsize=64)
+def _font(size_px, bold=False):
+    for candidate in (BOLD_FONT_CANDIDATES if bold else FONT_CANDIDATES):
+        if not candidate:
+            continue
+        try:
+            return ImageFont.truetype(candidate, size_px)
+        except OSError:
+            continue
+    if not bold:
+        logger.warning("Шрифт с кириллицей не найден, используется встроенный. "
+                       "Путь к шрифту можно задать переменной FORMBUILDER_FONT")
+    try:
+        return ImageFont.load_default(size_px)
+    except TypeError:
+        # Pillow до 10.1 не масштабирует встроенный шрифт
+        return ImageFont.load_default()
+
+
+def _wrap(text, font, width):
+    # Перенос по словам; слово длиннее строки переносится по символам
+    lines = []
+    for source_line in text.split('\n'):
+        line = ''
+        for word in source_line.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if font.getlength(candidate) <= width or not line:
+                line = candidate
+            else:
+                lines.append(line)
+                line = word
+            while font.getlength(line) > width and len(line) > 1:
+                cut = len(line) - 1
+                while cut > 1 and font.getlength(line[:cut]) > width:
+                    cut -= 1
+                lines.append(line[:cut])
+                line = line[cut:]
+        lines.append(line)
+    return lines
+
+
+class CardRasterizer:
+    """
+    Отрисовка маршрутной карты в изображение без PowerPoint.
+    Неизменная часть слайда (таблицы, рамки, подписи) рисуется один раз
+    в фон; для каждой карты на копию фона наносятся только значения полей
+    по плану шаблона и QR-код. Шрифты и переносы строк приближают
+    отрисовку PowerPoint, но не повторяют ее до пикселя.
+    """
+
+    def __init__(self, template_bytes, dpi=PRINT_DPI, mapping=None):
+        prs = Presentation(BytesIO(template_bytes))
+        if not prs.slides:
+            raise ValueError("Презентация не содержит слайдов")
+        self.dpi = dpi
+        self.scale = dpi / EMU_PER_INCH
+        self.plan = get_template_plan(template_bytes, mapping)
+        self.fields = card_engine.FORM_FIELDS + self.plan['fields']
+        self.version = None
+        self.size = (self._px(prs.slide_width), self._px(prs.slide_height))
+        self.line_width = max(1, round(dpi / 150))
+
+        self.cell_boxes = {}  # (индекс фигуры, строка, столбец) -> (left, top, right, bottom) в пикселях
+        self.cell_styles = {}  # то же -> (выравнивание, привязка по вертикали)
+        self.background = Image.new('L', self.size, 255)
+        draw = ImageDraw.Draw(self.background)
+        for shape_index, shape in enumerate(prs.slides[0].shapes):
+            self._draw_shape(draw, shape_index, shape, shape.left, shape.top, shape.width, shape.height)
+
+    def _px(self, emu):
+        return int(round(emu * self.scale))
+
+    def _box(self, left, top, width, height):
+        return (self._px(left), self._px(top), self._px(left + width), self._px(top + height))
+
+    def _draw_shape(self, draw, shape_index, shape, left, top, width, height):
+        if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            self._draw_group(draw, shape_index, shape, left, top, width, height)
+        elif shape.has_table:
+            self._draw_table(draw, shape_index, shape, left, top, width, height)
+        elif shape.has_text_frame and shape.text_frame.text.strip():
+            frame = shape.text_frame
+            self._draw_paragraphs(self.background, self._box(left, top, width, height), self._paragraphs(frame),
+                                  frame.vertical_anchor or MSO_ANCHOR.TOP, wrap=frame.word_wrap is not False)
+        elif shape.shape_type == MSO_SHAPE_TYPE.AUTO_SHAPE:
+            # Пустые фигуры шаблона - квадраты для отметок
+            draw.rectangle(self._box(left, top, width, height), outline=0, width=self.line_width)
+
+    def _draw_group(self, draw, shape_index, group, left, top, width, height):
+        # Координаты фигур группы пересчитываются из пространства группы в координаты слайда
+        xfrm = group._element.grpSpPr.find(qn('a:xfrm'))
+        ch_off = xfrm.find(qn('a:chOff'))
+        ch_ext = xfrm.find(qn('a:chExt'))
+        ch_x, ch_y = int(ch_off.get('x')), int(ch_off.get('y'))
+        scale_x = width / int(ch_ext.get('cx')) if int(ch_ext.get('cx')) else 1
+        scale_y = height / int(ch_ext.get('cy')) if int(ch_ext.get('cy')) else 1
+        for child in group.shapes:
+            self._draw_shape(draw, shape_index, child,
+                             left + (child.left - ch_x) * scale_x, top + (child.top - ch_y) * scale_y,
+                             child.width * scale_x, child.height * scale_y)
+
+    def _draw_table(self, draw, shape_index, shape, left, top, width, height):
+        table = shape.table
+        rows = [row.height for row in table.rows]
+        # Строки нулевой высоты PowerPoint растягивает по содержимому:
+        # отдаем им остаток высоты рамки таблицы
+        zero_rows = rows.count(0)
+        if zero_rows:
+            spare = max(0, height - sum(rows)) // zero_rows
+            rows = [row or spare for row in rows]
+        xs = [left]
+        for column in table.columns:
+            xs.append(xs[-1] + column.width)
+        # Высота строк - как в шаблоне: строка, выросшая по тексту, налезла бы
+        # на следующую фигуру; длинный текст уменьшается по ячейке (см. _fit)
+        ys = [top]
+        for row_height in rows:
+            ys.append(ys[-1] + row_height)
+
+        for r in range(len(rows)):
+            for c in range(len(xs) - 1):
+                cell = table.cell(r, c)
+                if cell.is_spanned:
+                    continue
+                span_c = cell.span_width if cell.is_merge_origin else 1
+                span_r = cell.span_height if cell.is_merge_origin else 1
+                box = self._box(xs[c], ys[r], xs[c + span_c] - xs[c], ys[r + span_r] - ys[r])
+                draw.rectangle(box, outline=0, width=self.line_width)
+
+                frame = cell.text_frame
+                alignment = frame.paragraphs[0].alignment
+                anchor = cell.vertical_anchor or MSO_ANCHOR.TOP
+                self.cell_boxes[(shape_index, r, c)] = box
+                self.cell_styles[(shape_index, r, c)] = (alignment, anchor)
+                if frame.text.strip():
+                    tc_pr = cell._tc.tcPr
+                    vertical = tc_pr is not None and tc_pr.get('vert') in ('vert270', 'vert')
+                    self._draw_paragraphs(self.background, box, self._paragraphs(frame), anchor, vertical)
+
+    def _paragraphs(self, frame):
+        paragraphs = []
+        for paragraph in frame.paragraphs:
+            font = paragraph.runs[0].font if paragraph.runs else None
+            size = font.size.pt if font is not None and font.size else DEFAULT_FONT_PT
+            bold = bool(font is not None and font.bold)
+            paragraphs.append((paragraph.text, size, bold, paragraph.alignment))
+        return paragraphs
+
+    def _layout(self, paragraphs, width, wrap=True, scale=1.0):
+        # Строки текста (строка, шрифт, высота строки, выравнивание) и общая высота
+        margin_x = self._px(CELL_MARGIN_X)
+        lines = []
+        for text, size_pt, bold, alignment in paragraphs:
+            size_pt *= scale
+            font = _font(max(1, round(size_pt * self.dpi / 72)), bold)
+            line_height = round(size_pt * self.dpi / 72 * 1.2)
+            text = text.strip()
+            wrapped = _wrap(text, font, max(1, width - 2 * margin_x)) if wrap else text.split('\n')
+            for line in wrapped:
+                lines.append((line, font, line_height, alignment))
+        return lines, sum(line_height for _, _, line_height, _ in lines)
+
+    def _fit(self, paragraphs, width, height, wrap=True):
+        # Раскладка текста, уменьшенного до размеров ячейки или рамки
+        margin_x = self._px(CELL_MARGIN_X)
+        scale = 1.0
+        while True:
+            lines, text_height = self._layout(paragraphs, width, wrap, scale)
+            text_width = max((font.getlength(line) for line, font, _, _ in lines), default=0) + 2 * margin_x
+            if (text_height <= height and text_width <= width) or scale * FONT_SCALE_STEP < MIN_FONT_SCALE:
+                return lines, text_height
+            scale *= FONT_SCALE_STEP
+
+    def _draw_paragraphs(self, image, box, paragraphs, anchor, vertical=False, wrap=True):
+        left, top, right, bottom = box
+        width, height = right - left, bottom - top
+        if vertical:
+            # Текст снизу вверх: рисуем горизонтально и поворачиваем
+            width, height = height, width
+        margin_x, margin_y = self._px(CELL_MARGIN_X), self._px(CELL_MARGIN_Y)
+        lines, text_height = self._fit(paragraphs, width, height, wrap)
+
+        if anchor == MSO_ANCHOR.MIDDLE:
+            y = (height - text_height) // 2
+        elif anchor == MSO_ANCHOR.BOTTOM:
+            y = height - margin_y - text_height
+        else:
+            y = margin_y
+
+        layer = Image.new('L', (width, height), 0)
+        draw = ImageDraw.Draw(layer)
+        for line, font, line_height, alignment in lines:
+            line_width = font.getlength(line)
+            if alignment == PP_ALIGN.CENTER:
+                x = (width - line_width) / 2
+            elif alignment == PP_ALIGN.RIGHT:
+                x = width - margin_x - line_width
+            else:
+                x = margin_x
+            draw.text((x, y), line, font=font, fill=255)
+            y += line_height
+
+        if vertical:
+            layer = layer.rotate(90, expand=True)
+        # Слой служит маской: текст черным поверх рамок, без заливки фона ячейки
+        image.paste(0, (left, top), layer)
+
+    def render(self, data):
+        """Возвращает изображение заполненной карты (оттенки серого)"""
+        data = card_engine.normalize_form_data(data, self.fields)
+        image = self.background.copy()
+        for shape_index, row, col, field in self.plan['cells']:
+            box = self.cell_boxes.get((shape_index, row, col))
+            if not field or box is None or not data.get(field):
+                continue
+            alignment, anchor = self.cell_styles[(shape_index, row, col)]
+            self._draw_paragraphs(image, box, [(data[field], FIELD_FONT_PT, True, alignment)], anchor)
+
+        payload = data['cluster_number']
+        for left, top, width, height in self.plan['qr_positions']:
+            box = self._box(left, top, width, height)
+            size = box[2] - box[0]
+            qr = qr_image(payload, box_size=1).resize((size, size), Image.NEAREST)
+            image.paste(qr.convert('L'), box[:2])
+        return image
+
+
+class PdfWriter:
+    """
+    Потоковая запись многостраничного PDF из изображений: страница пишется
+    в файл сразу, поэтому пакет из тысяч карт не держится в памяти целиком.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self._offsets = {}
+        self._pages = []
+        self._next_object = 3  # 1 - каталог, 2 - дерево страниц (пишутся в конце)
+        self.out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _reserve(self):
+        number = self._next_object
+        self._next_object += 1
+        return number
+
+    def _write_object(self, number, body, stream=None):
+        self._offsets[number] = self.out.tell()
+        self.out.write(f'{number} 0 obj\n'.encode('ascii') + body)
+        if stream is not None:
+            self.out.write(b'\nstream\n' + stream + b'\nendstream')
+        self.out.write(b'\nendobj\n')
+
+    def add_page(self, image, dpi=PRINT_DPI):
+        image = image.convert('L')
+        width, height = image.size
+        page_width, page_height = width * 72 / dpi, height * 72 / dpi
+        data = zlib.compress(image.tobytes(), 6)
+        content = f'q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q'.encode('ascii')
+
+        image_number, content_number, page_number = self._reserve(), self._reserve(), self._reserve()
+        self._write_object(image_number, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode /Length {len(data)} >>'
+        ).encode('ascii'), data)
+        self._write_object(content_number, f'<< /Length {len(content)} >>'.encode('ascii'), content)
+        self._write_object(page_number, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] '
+            f'/Resources << /XObject << /Im0 {image_number} 0 R >> >> /Contents {content_number} 0 R >>'
+        ).encode('ascii'))
+        self._pages.append(page_number)
+
+    def close(self):
+        kids = ' '.join(f'{number} 0 R' for number in self._pages)
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>'.encode('ascii'))
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        xref_offset = self.out.tell()
+        count = self._next_object
+        lines = [f'xref\n0 {count}\n', '0000000000 65535 f \n']
+        lines += [f'{self._offsets[number]:010d} 00000 n \n' for number in range(1, count)]
+        lines.append(f'trailer\n<< /Size {count} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n')
+        self.out.write(''.join(lines).encode('ascii'))
+
+
+def get_rasterizer(template_path, dpi=PRINT_DPI):
+    """Возвращает растеризатор шаблона, отрисовывая фон только при первом обращении"""
+    key = (template_path, dpi)
+    template_bytes, mapping, version = card_engine.template_entry(template_path)
+    rasterizer = _rasterizers.get(key)
+    if rasterizer is None or rasterizer.version != version:
+        rasterizer = _rasterizers[key] = CardRasterizer(template_bytes, dpi, mapping)
+        rasterizer.version = version
+    return rasterizer
+
+
+def export_png(template_path, data, output_dir=None, dpi=PRINT_DPI):
+    """Создает PNG маршрутной карты в разрешении печати и возвращает путь к файлу"""
+    from output_store import write_card
+    data = card_engine.normalize_form_data(data, card_engine.template_fields(template_path))
+
+    def write(f):
+        get_rasterizer(template_path, dpi).render(data).save(f, 'PNG', dpi=(dpi, dpi))
+
+    return write_card(template_path, data, '.png', f'dpi={dpi}', write, output_dir)
+
+
+def render_pdf(template_path, data, out, dpi=PRINT_DPI):
+    """Записывает карту одной страницей PDF в поток out"""
+    writer = PdfWriter(out)
+    writer.add_page(get_rasterizer(template_path, dpi).render(data), dpi)
+    writer.close()
+
+
+def export_card_pdf(template_path, data, output_dir=None, dpi=PRINT_DPI):
+    """Создает PDF маршрутной карты для печати без PowerPoint и возвращает путь к файлу"""
+    from output_store import write_card
+    data = card_engine.normalize_form_data(data, card_engine.template_fields(template_path))
+    return write_card(template_path, data, '.pdf', f'dpi={dpi}',
+                      lambda f: render_pdf(template_path, data, f, dpi), output_dir)
+
+
+def compose_sheet(cards, per_sheet):
+    """
+    Размещает уменьшенные карты на листе того же формата, что и шаблон (A4):
+    2 карты - рядом на листе альбомной ориентации, 4 карты - сеткой 2x2.
+    """
+    columns, rows = SHEET_LAYOUTS[per_sheet]
+    card_width, card_height = cards[0].size
+    if columns > rows:
+        sheet_size = (card_height, card_width)
+    else:
+        sheet_size = (card_width, card_height)
+    cell_width, cell_height = sheet_size[0] // columns, sheet_size[1] // rows
+    scale = min(cell_width / card_width, cell_height / card_height)
+    size = (int(card_width * scale), int(card_height * scale))
+
+    sheet = Image.new('L', sheet_size, 255)
+    for index, card in enumerate(cards):
+        column, row = index % columns, index // columns
+        left = column * cell_width + (cell_width - size[0]) // 2
+        top = row * cell_height + (cell_height - size[1]) // 2
+        sheet.paste(card.resize(size, Image.LANCZOS), (left, top))
+    return sheet
+
+
+def export_pdf(template_path, records, output_path, dpi=PRINT_DPI, per_sheet=1):
+    """
+    Записывает карты для набора записей в один PDF, чтобы пакет уходил
+    на печать одним заданием: по странице на карту или по per_sheet
+    уменьшенных карт на лист A4. Возвращает количество страниц.
+    """
+    if per_sheet not in SHEET_LAYOUTS:
+        raise ValueError(f"Карт на листе может быть: {', '.join(map(str, sorted(SHEET_LAYOUTS)))}")
+    rasterizer = get_rasterizer(template_path, dpi)
+    pages = 0
+    with open(output_path, 'wb') as f:
+        writer = PdfWriter(f)
+        cards = []
+        for record in records:
+            cards.append(rasterizer.render(record))
+            if len(cards) == per_sheet:
+                writer.add_page(cards[0] if per_sheet == 1 else compose_sheet(cards, per_sheet), dpi)
+                pages += 1
+                cards = []
+        if cards:
+            writer.add_page(compose_sheet(cards, per_sheet), dpi)
+            pages += 1
+        writer.close()
+    return pages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Выгрузка маршрутных карт в PDF или PNG без PowerPoint")
+    parser.add_argument('input', help="CSV или JSONL файл с записями форм")
+    parser.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    parser.add_argument('--pdf', help="Один PDF со всеми картами")
+    parser.add_argument('--png-dir', help="Каталог для PNG по карте на файл")
+    parser.add_argument('--dpi', type=int, default=PRINT_DPI, help="Разрешение, точек на дюйм")
+    parser.add_argument('--per-sheet', type=int, choices=sorted(SHEET_LAYOUTS), default=1,
+                        help="Карт на листе PDF: 1, 2 (альбомная ориентация) или 4 (сетка 2x2)")
+    args = parser.parse_args(argv)
+    configure_logging()
+    if not args.pdf and not args.png_dir:
+        parser.error("Укажите --pdf и/или --png-dir")
+
+    from batch_generate import read_records
+    try:
+        records = list(read_records(args.input))
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения входного файла: {e}")
+        return 1
+
+    if args.pdf:
+        pages = export_pdf(args.template, records, args.pdf, args.dpi, args.per_sheet)
+        print(f"PDF создан: {args.pdf} ({pages} стр.)")
+    if args.png_dir:
+        for record in records:
+            export_png(args.template, record, args.png_dir, args.dpi)
+        print(f"PNG создано: {len(records)} в {args.png_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
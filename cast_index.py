@@ -0,0 +1,100 @@
+from bisect import bisect_left
+
+# Длина n-граммы индекса подстрок
+NGRAM = 3
+
+
+def _normalize(text):
+    return ' '.join(str(text).casefold().split())
+
+
+def _trigrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class CastIndex:
+    """
+    Индекс поиска отливок по номеру и наименованию для подсказок при вводе.
+    Начало строки ищется двоичным поиском по отсортированному массиву ключей,
+    подстрока - по самому короткому списку триграмм запроса с проверкой вхождения.
+    Номер -> наименование и номер -> позиция в списке берутся из словарей.
+    """
+
+    def __init__(self, casts):
+        # Отливки (номер, наименование) в порядке справочника
+        self.casts = tuple((str(number), str(name)) for number, name in casts)
+        self.names = {}
+        self.positions = {}
+        for position, (number, name) in enumerate(self.casts):
+            self.names.setdefault(number, name)
+            self.positions.setdefault(number, position)
+
+        self._texts = [_normalize(f'{number} {name}') for number, name in self.casts]
+
+        # Отсортированные пары (ключ, позиция) для поиска по началу номера и наименования
+        prefixes = set()
+        for position, (number, name) in enumerate(self.casts):
+            prefixes.add((_normalize(number), position))
+            prefixes.add((_normalize(name), position))
+        self._prefixes = sorted(prefixes)
+
+        # Триграмма -> позиции отливок, в тексте которых она встречается
+        postings = {}
+        for position, text in enumerate(self._texts):
+            for gram in _trigrams(text):
+                postings.setdefault(gram, []).append(position)
+        self._postings = postings
+
+    def __len__(self):
+        return len(self.casts)
+
+    def name_for(self, number):
+        """Наименование отливки по номеру или None"""
+        return self.names.get(number)
+
+    def position_for(self, number):
+        """Позиция отливки в списке справочника или -1"""
+        return self.positions.get(number, -1)
+
+    def _prefix_matches(self, query):
+        prefixes = self._prefixes
+        for i in range(bisect_left(prefixes, (query, -1)), len(prefixes)):
+            key, position = prefixes[i]
+            if not key.startswith(query):
+                break
+            yield position
+
+    def _substring_matches(self, query):
+        grams = _trigrams(query)
+        if not grams:
+            # Слишком короткий запрос для триграмм: только совпадения по началу
+            return
+        # Кандидаты - самый короткий список триграмм (он уже упорядочен по позиции);
+        # проверка подстрокой отсекает остальные триграммы, поэтому поиск
+        # останавливается, как только набрано нужное количество
+        candidates = min((self._postings.get(gram, ()) for gram in grams), key=len)
+        texts = self._texts
+        for position in candidates:
+            if query in texts[position]:
+                yield position
+
+    def search(self, query, limit=20):
+        """
+        Возвращает до limit отливок (номер, наименование), подходящих к запросу:
+        сначала совпадения по началу номера или наименования, затем по подстроке.
+        """
+        query = _normalize(query)
+        if not query:
+            return list(self.casts[:limit])
+
+        found = []
+        seen = set()
+        for matches in (self._prefix_matches(query), self._substring_matches(query)):
+            for position in matches:
+                if position in seen:
+                    continue
+                seen.add(position)
+                found.append(self.casts[position])
+                if len(found) >= limit:
+                    return found
+        return found
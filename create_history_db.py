@@ -1,45 +1,674 @@
+import logging
 import sqlite3
 import re
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
-def create_history_database():
-    # Добавить обработку ошибок:
+from instrumentation import STAGE_DB_INSERT, timed
+
+logger = logging.getLogger(__name__)
+
+# Путь к базе истории можно переопределить переменной окружения
+DEFAULT_DB_PATH = os.environ.get('FORMBUILDER_HISTORY_DB', 'история_форм.db')
+
+# Режим журнала базы истории: WAL быстрее, но требует общей памяти и не работает
+# для базы в сетевой папке; без переменной для сетевых путей выбирается DELETE
+HISTORY_JOURNAL_MODE = os.environ.get('FORMBUILDER_HISTORY_JOURNAL')
+JOURNAL_MODES = ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST')
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Маршрутные_Карты" (
+        "ИД" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "Номер_Кластера" TEXT NOT NULL,
+        "Номер_Отливки" TEXT,
+        "Наименование_Отливки" TEXT,
+        "Дата_Склейки" TEXT,
+        "Исполнитель_Склейки" TEXT,
+        "Количество_Склейки" TEXT,
+        "Примечание_Склейки" TEXT,
+        "Дата_Контроля" TEXT,
+        "Время_Контроля" TEXT,
+        "Исполнитель_Контроля" TEXT,
+        "Количество_Контроля" TEXT,
+        "Примечание_Контроля" TEXT,
+        "Дата_Создания" TEXT,
+        "Дата_Склейки_ISO" TEXT,
+        "Дата_Контроля_ISO" TEXT,
+        "Дата_Создания_ISO" TEXT
+    )
+'''
+
+# Уникальный индекс для номера кластера
+CREATE_CLUSTER_INDEX_SQL = '''
+    CREATE UNIQUE INDEX IF NOT EXISTS "idx_номер_кластера"
+    ON "Маршрутные_Карты" ("Номер_Кластера")
+'''
+
+INSERT_FORM_SQL = '''
+    INSERT INTO "Маршрутные_Карты" (
+        "Номер_Кластера",
+        "Номер_Отливки",
+        "Наименование_Отливки",
+        "Дата_Склейки",
+        "Исполнитель_Склейки",
+        "Количество_Склейки",
+        "Примечание_Склейки",
+        "Дата_Контроля",
+        "Время_Контроля",
+        "Исполнитель_Контроля",
+        "Количество_Контроля",
+        "Примечание_Контроля",
+        "Дата_Создания",
+        "Дата_Склейки_ISO",
+        "Дата_Контроля_ISO",
+        "Дата_Создания_ISO"
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Счетчик номеров кластеров по месяцам (год - две последние цифры, как в номере)
+CREATE_COUNTER_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Счетчики_Кластеров" (
+        "Год" INTEGER NOT NULL,
+        "Месяц" INTEGER NOT NULL,
+        "Последний_Номер" INTEGER NOT NULL,
+        PRIMARY KEY ("Год", "Месяц")
+    ) WITHOUT ROWID
+'''
+
+SELECT_COUNTER_SQL = '''
+    SELECT "Последний_Номер" FROM "Счетчики_Кластеров" WHERE "Год" = ? AND "Месяц" = ?
+'''
+
+# Счетчик только растет: сохраненный вручную номер не будет выдан повторно
+UPSERT_COUNTER_SQL = '''
+    INSERT INTO "Счетчики_Кластеров" ("Год", "Месяц", "Последний_Номер") VALUES (?, ?, ?)
+    ON CONFLICT ("Год", "Месяц") DO UPDATE
+    SET "Последний_Номер" = max("Последний_Номер", excluded."Последний_Номер")
+'''
+
+# Начальное значение счетчика для месяца, номера которого уже есть в истории
+LAST_CLUSTER_NUMBER_SQL = '''
+    SELECT max(CAST(substr("Номер_Кластера", 8, 3) AS INTEGER))
+    FROM "Маршрутные_Карты"
+    WHERE "Номер_Кластера" LIKE ?
+'''
+
+# Версия схемы истории (PRAGMA user_version):
+# 1 - даты дополнительно хранятся в столбцах ISO-8601
+HISTORY_SCHEMA_VERSION = 1
+
+# Столбцы дат в формате ISO-8601 ('yyyy-MM-dd', для даты создания 'yyyy-MM-ddTHH:MM:SS'),
+# по которым сортировка и выборка по диапазону идут по индексу
+GLUING_DATE_ISO_SQL = '"Дата_Склейки_ISO"'
+CONTROL_DATE_ISO_SQL = '"Дата_Контроля_ISO"'
+CREATED_ISO_SQL = '"Дата_Создания_ISO"'
+
+# Исходный столбец 'dd.MM.yyyy[ HH:MM:SS]' -> столбец ISO и SQL-выражение для заполнения.
+# Строки, не похожие на дату, остаются с NULL
+ISO_DATE_COLUMNS = (
+    ('Дата_Склейки', 'Дата_Склейки_ISO', False),
+    ('Дата_Контроля', 'Дата_Контроля_ISO', False),
+    ('Дата_Создания', 'Дата_Создания_ISO', True),
+)
+
+def _iso_date_sql(column, with_time):
+    date_sql = (f'''substr("{column}", 7, 4) || '-' || substr("{column}", 4, 2) || '-' || '''
+                f'''substr("{column}", 1, 2)''')
+    if with_time:
+        date_sql += f''' || 'T' || substr("{column}", 12, 8)'''
+    return (f'''CASE WHEN "{column}" GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]*' '''
+            f'''THEN {date_sql} END''')
+
+# Индексы для поиска по истории
+CREATE_SEARCH_INDEXES_SQL = (
+    '''CREATE INDEX IF NOT EXISTS "idx_номер_отливки" ON "Маршрутные_Карты" ("Номер_Отливки", "ИД")''',
+    '''CREATE INDEX IF NOT EXISTS "idx_исполнитель_склейки" ON "Маршрутные_Карты" ("Исполнитель_Склейки", "ИД")''',
+    '''CREATE INDEX IF NOT EXISTS "idx_исполнитель_контроля" ON "Маршрутные_Карты" ("Исполнитель_Контроля", "ИД")''',
+    '''CREATE INDEX IF NOT EXISTS "idx_дата_склейки_iso" ON "Маршрутные_Карты" ("Дата_Склейки_ISO", "ИД")''',
+    '''CREATE INDEX IF NOT EXISTS "idx_дата_контроля_iso" ON "Маршрутные_Карты" ("Дата_Контроля_ISO", "ИД")''',
+    '''CREATE INDEX IF NOT EXISTS "idx_дата_создания_iso" ON "Маршрутные_Карты" ("Дата_Создания_ISO", "ИД")''',
+)
+
+# Индексы по выражениям над текстовыми датами, замененные столбцами ISO
+OBSOLETE_INDEXES = ('idx_дата_склейки', 'idx_дата_создания')
+
+# Размер пачки строк при заполнении столбцов ISO
+MIGRATION_CHUNK_SIZE = 5000
+
+# Столбцы истории и соответствующие поля формы
+HISTORY_COLUMNS = (
+    ('ИД', 'id'),
+    ('Номер_Кластера', 'cluster_number'),
+    ('Номер_Отливки', 'cast_number'),
+    ('Наименование_Отливки', 'cast_name'),
+    ('Дата_Склейки', 'gluing_date'),
+    ('Исполнитель_Склейки', 'gluing_executor'),
+    ('Количество_Склейки', 'gluing_quantity'),
+    ('Примечание_Склейки', 'gluing_notes'),
+    ('Дата_Контроля', 'control_date'),
+    ('Время_Контроля', 'control_time'),
+    ('Исполнитель_Контроля', 'control_executor'),
+    ('Количество_Контроля', 'control_quantity'),
+    ('Примечание_Контроля', 'control_notes'),
+    ('Дата_Создания', 'created_at'),
+)
+
+SELECT_HISTORY_SQL = (
+    'SELECT ' + ', '.join(f'"{column}"' for column, _ in HISTORY_COLUMNS) + ' FROM "Маршрутные_Карты"'
+)
+
+# Наибольшее количество кластеров в месяце
+MAX_CLUSTERS_PER_MONTH = 999
+
+def _form_row(data):
+    # Порядок значений соответствует INSERT_FORM_SQL; номер кластера обязателен,
+    # остальные поля могут отсутствовать
+    created = datetime.now()
+    return (
+        data['cluster_number'],
+        data.get('cast_number', ''),
+        data.get('cast_name', ''),
+        data.get('gluing_date', ''),
+        data.get('gluing_executor', ''),
+        data.get('gluing_quantity', ''),
+        data.get('gluing_notes', ''),
+        data.get('control_date', ''),
+        data.get('control_time', ''),
+        data.get('control_executor', ''),
+        data.get('control_quantity', ''),
+        data.get('control_notes', ''),
+        created.strftime("%d.%m.%Y %H:%M:%S"),
+        _iso_date_or_none(data.get('gluing_date')),
+        _iso_date_or_none(data.get('control_date')),
+        created.strftime("%Y-%m-%dT%H:%M:%S")
+    )
+
+def _parse_date(date_str):
+    # Добавить проверку входных данных:
+    if not date_str or len(date_str.split('.')) != 3:
+        raise ValueError("Неверный формат даты. Ожидается dd.MM.yyyy")
+
+    # Разбираем дату
+    day, month, year = map(int, date_str.split('.'))
+    year_short = str(year)[-2:]  # Берем последние 2 цифры года
+    return year_short, month
+
+def _create_schema(conn):
+    conn.execute(CREATE_TABLE_SQL)
+    conn.execute(CREATE_CLUSTER_INDEX_SQL)
+    conn.execute(CREATE_COUNTER_TABLE_SQL)
+    conn.commit()
+    if conn.execute('PRAGMA user_version').fetchone()[0] < HISTORY_SCHEMA_VERSION:
+        # База прежней версии: переносим даты, если этого еще не сделал migrate_history_db.py
+        migrate_iso_dates(conn)
+    for sql in CREATE_SEARCH_INDEXES_SQL:
+        conn.execute(sql)
+    # Без статистики планировщик может выбрать индекс исполнителя вместо индекса даты
+    has_stats = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+    if not has_stats or not conn.execute(
+            "SELECT 1 FROM sqlite_stat1 WHERE tbl = 'Маршрутные_Карты'").fetchone():
+        conn.execute('ANALYZE "Маршрутные_Карты"')
+    conn.commit()
+
+def _iso_date(date_str):
+    # 'dd.MM.yyyy' -> 'yyyy-MM-dd'
+    return datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
+
+def _iso_date_or_none(date_str):
+    # Дата формы в ISO-8601; пустая или неверная дата хранится как NULL
     try:
-        conn = sqlite3.connect('история_форм.db')
-        cursor = conn.cursor()
-
-        # Создаем таблицу для хранения истории форм
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS "Маршрутные_Карты" (
-                "ИД" INTEGER PRIMARY KEY AUTOINCREMENT,
-                "Номер_Кластера" TEXT NOT NULL,
-                "Номер_Отливки" TEXT,
-                "Наименование_Отливки" TEXT,
-                "Дата_Склейки" TEXT,
-                "Исполнитель_Склейки" TEXT,
-                "Количество_Склейки" TEXT,
-                "Примечание_Склейки" TEXT,
-                "Дата_Контроля" TEXT,
-                "Время_Контроля" TEXT,
-                "Исполнитель_Контроля" TEXT,
-                "Количество_Контроля" TEXT,
-                "Примечание_Контроля" TEXT,
-                "Дата_Создания" TEXT
-            )
-        ''')
-
-        # Создаем уникальный индекс для номера кластера
-        cursor.execute('''
-            CREATE UNIQUE INDEX IF NOT EXISTS "idx_номер_кластера" 
-            ON "Маршрутные_Карты" ("Номер_Кластера")
-        ''')
+        return _iso_date(date_str)
+    except (TypeError, ValueError):
+        return None
 
+def migrate_iso_dates(conn, chunk_size=MIGRATION_CHUNK_SIZE, progress=None):
+    """
+    Переводит базу истории на версию HISTORY_SCHEMA_VERSION: добавляет столбцы
+    дат ISO-8601, заполняет их пачками по диапазонам ИД (каждая пачка - своя
+    короткая транзакция, другие станции продолжают работать) и создает индексы.
+    Повторный запуск продолжает с незаполненных строк.
+    progress(обработано_до_ИД, последний_ИД) вызывается после каждой пачки.
+    Возвращает количество обновленных строк.
+    """
+    # Проверка и добавление столбцов - одна транзакция с блокировкой записи: станции,
+    # одновременно открывшие базу прежней версии, не добавляют столбец дважды
+    if conn.in_transaction:
         conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        existing = {row[1] for row in conn.execute('PRAGMA table_info("Маршрутные_Карты")')}
+        for _, iso_column, _ in ISO_DATE_COLUMNS:
+            if iso_column not in existing:
+                conn.execute(f'ALTER TABLE "Маршрутные_Карты" ADD COLUMN "{iso_column}" TEXT')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    assignments = ', '.join(f'"{iso_column}" = {_iso_date_sql(column, with_time)}'
+                            for column, iso_column, with_time in ISO_DATE_COLUMNS)
+    pending = ' OR '.join(f'("{iso_column}" IS NULL AND "{column}" IS NOT NULL)'
+                          for column, iso_column, _ in ISO_DATE_COLUMNS)
+    update_sql = (f'UPDATE "Маршрутные_Карты" SET {assignments} '
+                  f'WHERE "ИД" > ? AND "ИД" <= ? AND ({pending})')
+
+    last_id = conn.execute('SELECT max("ИД") FROM "Маршрутные_Карты"').fetchone()[0] or 0
+    updated = 0
+    start = 0
+    while start < last_id:
+        end = min(start + chunk_size, last_id)
+        with conn:
+            updated += conn.execute(update_sql, (start, end)).rowcount
+        if progress:
+            progress(end, last_id)
+        start = end
+
+    for index_name in OBSOLETE_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+    for sql in CREATE_SEARCH_INDEXES_SQL:
+        conn.execute(sql)
+    conn.execute('ANALYZE "Маршрутные_Карты"')
+    conn.execute(f'PRAGMA user_version = {HISTORY_SCHEMA_VERSION}')
+    conn.commit()
+    return updated
+
+def _history_row(row):
+    return {key: value for (_, key), value in zip(HISTORY_COLUMNS, row)}
+
+def _last_cluster_number(conn, year_short, month):
+    # Последний выданный номер месяца по счетчику
+    row = conn.execute(SELECT_COUNTER_SQL, (int(year_short), month)).fetchone()
+    if row:
+        return row[0]
+    # Первое обращение к месяцу: продолжаем нумерацию из истории
+    row = conn.execute(LAST_CLUSTER_NUMBER_SQL, (f'К{year_short}/{month:02d}-%',)).fetchone()
+    return row[0] or 0
+
+def _format_cluster_number(year_short, month, number):
+    return f'К{year_short}/{month:02d}-{number:03d}'
+
+def default_journal_mode(path):
+    """Режим журнала для базы: из FORMBUILDER_HISTORY_JOURNAL, иначе DELETE для сетевой папки и WAL для локальной"""
+    if HISTORY_JOURNAL_MODE:
+        return HISTORY_JOURNAL_MODE
+    # UNC-путь \\сервер\папка или //сервер/папка
+    return 'DELETE' if path.startswith(('\\\\', '//')) else 'WAL'
+
+class HistoryRepository:
+    """
+    Доступ к базе истории форм через небольшой пул долгоживущих соединений.
+    Соединения открываются в режиме WAL с busy_timeout, поэтому несколько
+    станций не получают сразу "database is locked", а подготовленные
+    запросы переиспользуются кэшем выражений sqlite3 внутри соединения.
+    Для базы в сетевой папке WAL не подходит (нужна общая память),
+    там используется journal_mode='DELETE' (см. default_journal_mode).
+    """
+
+    def __init__(self, path=None, pool_size=4, busy_timeout=5000,
+                 journal_mode=None, synchronous='NORMAL'):
+        self.path = path or DEFAULT_DB_PATH
+        self.busy_timeout = busy_timeout
+        journal_mode = (journal_mode or default_journal_mode(self.path)).upper()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Неизвестный режим журнала: {journal_mode}")
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000,
+                               check_same_thread=False, cached_statements=128)
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        if not self._schema_ready:
+            # Базы, созданные прежними версиями, получают новые таблицы при первом подключении;
+            # потоки, открывающие первые соединения одновременно, обновляют схему по очереди
+            with self._schema_lock:
+                if not self._schema_ready:
+                    _create_schema(conn)
+                    self._schema_ready = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение из пула и возвращает его обратно после работы"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            # Обновляет статистику планировщика, если таблица заметно выросла
+            conn.execute('PRAGMA optimize')
+            conn.close()
+
+    def create_schema(self):
+        """Создает таблицу истории и индексы, если их нет"""
+        with self.connection() as conn:
+            _create_schema(conn)
+
+    def save_form(self, data):
+        """Сохраняет данные формы в базу"""
+        # Проверяем формат номера кластера
+        validate_cluster_number(data['cluster_number'])
+
+        number = data['cluster_number']
+        with self.connection() as conn, timed(STAGE_DB_INSERT):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(INSERT_FORM_SQL, _form_row(data))
+                # Номер, введенный вручную, продвигает счетчик месяца
+                year_short, month = number[1:3], int(number[4:6])
+                last_number = max(_last_cluster_number(conn, year_short, month), int(number[7:10]))
+                conn.execute(UPSERT_COUNTER_SQL, (int(year_short), month, last_number))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise ValueError(f"Кластер с номером {number} уже существует в базе")
+
+    def save_forms_bulk(self, records, chunk_size=500):
+        """
+        Сохраняет много форм пачками: одна транзакция и один executemany на пачку.
+        Ошибочные записи и конфликты по номеру кластера не прерывают загрузку,
+        а попадают в отчет: {'inserted': N, 'invalid': [...], 'conflicts': [...]},
+        где элементы списков - (порядковый номер записи, номер кластера, причина).
+        """
+        report = {'inserted': 0, 'invalid': [], 'conflicts': []}
+        seen = set()
+        chunk = []
+        for index, data in enumerate(records):
+            # Запись без номера, с номером не строкой или не словарь тоже идет в отчет
+            number = data.get('cluster_number') if isinstance(data, dict) else None
+            try:
+                if not isinstance(data, dict):
+                    raise TypeError("Запись должна быть словарем")
+                if not isinstance(number, str):
+                    raise TypeError("Не указан номер кластера")
+                validate_cluster_number(number)
+            except (KeyError, TypeError, ValueError) as e:
+                report['invalid'].append((index, number, str(e)))
+                continue
+            if number in seen:
+                report['conflicts'].append((index, number, "Номер повторяется в загружаемых данных"))
+                continue
+            seen.add(number)
+            chunk.append((index, data))
+            if len(chunk) >= chunk_size:
+                self._insert_chunk(chunk, report)
+                chunk = []
+        if chunk:
+            self._insert_chunk(chunk, report)
+        return report
+
+    def _insert_chunk(self, chunk, report):
+        numbers = [data['cluster_number'] for _, data in chunk]
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # Номера, которые уже есть в базе, отсеиваем до вставки
+            placeholders = ', '.join('?' * len(numbers))
+            existing = {row[0] for row in conn.execute(
+                f'SELECT "Номер_Кластера" FROM "Маршрутные_Карты" WHERE "Номер_Кластера" IN ({placeholders})',
+                numbers)}
+
+            rows = []
+            month_max = {}
+            for index, data in chunk:
+                number = data['cluster_number']
+                if number in existing:
+                    report['conflicts'].append((index, number, f"Кластер с номером {number} уже существует в базе"))
+                    continue
+                try:
+                    rows.append(_form_row(data))
+                except (KeyError, TypeError, ValueError) as e:
+                    report['invalid'].append((index, number, str(e)))
+                    continue
+                key = (number[1:3], int(number[4:6]))
+                month_max[key] = max(month_max.get(key, 0), int(number[7:10]))
+
+            conn.executemany(INSERT_FORM_SQL, rows)
+            for (year_short, month), number in month_max.items():
+                last_number = max(_last_cluster_number(conn, year_short, month), number)
+                conn.execute(UPSERT_COUNTER_SQL, (int(year_short), month, last_number))
+            conn.commit()
+        report['inserted'] += len(rows)
+
+    def search_forms(self, cluster_prefix=None, cast_number=None, executor=None,
+                     date_from=None, date_to=None, created_from=None, created_to=None,
+                     control_from=None, control_to=None, after=None, limit=50):
+        """
+        Ищет карты в истории. Даты передаются как 'dd.MM.yyyy' (date_* - дата
+        склейки, control_* - дата контроля, created_* - дата создания);
+        executor ищется среди исполнителей склейки и контроля.
+        Без фильтра по дате карты идут от новых к старым, с фильтром - по убыванию
+        этой даты, так что порядок всегда берется из индекса и LIMIT не требует
+        сортировки всей выборки. Постраничный вывод по ключу: для следующей
+        страницы передается after из результата предыдущей.
+        Возвращает (список словарей с полями формы, after следующей страницы или None).
+        """
+        conditions = []
+        params = []
+        if cluster_prefix:
+            # Диапазон по уникальному индексу вместо LIKE
+            conditions.append('"Номер_Кластера" >= ? AND "Номер_Кластера" < ?')
+            params += [cluster_prefix, cluster_prefix + '\U0010ffff']
+        if cast_number:
+            conditions.append('"Номер_Отливки" = ?')
+            params.append(cast_number)
+        if date_from:
+            conditions.append(f'{GLUING_DATE_ISO_SQL} >= ?')
+            params.append(_iso_date(date_from))
+        if date_to:
+            conditions.append(f'{GLUING_DATE_ISO_SQL} <= ?')
+            params.append(_iso_date(date_to))
+        if control_from:
+            conditions.append(f'{CONTROL_DATE_ISO_SQL} >= ?')
+            params.append(_iso_date(control_from))
+        if control_to:
+            conditions.append(f'{CONTROL_DATE_ISO_SQL} <= ?')
+            params.append(_iso_date(control_to))
+        if created_from:
+            conditions.append(f'{CREATED_ISO_SQL} >= ?')
+            params.append(_iso_date(created_from))
+        if created_to:
+            # Верхняя граница включает весь день
+            conditions.append(f'{CREATED_ISO_SQL} < ?')
+            params.append(_iso_date(created_to) + 'U')
+
+        # Ключ сортировки и продолжения страниц
+        if date_from or date_to:
+            sort_sql = GLUING_DATE_ISO_SQL
+        elif control_from or control_to:
+            sort_sql = CONTROL_DATE_ISO_SQL
+        elif created_from or created_to:
+            sort_sql = CREATED_ISO_SQL
+        else:
+            sort_sql = None
+        if sort_sql:
+            order_by = f'ORDER BY {sort_sql} DESC, "ИД" DESC'
+            if after is not None:
+                conditions.append(f'({sort_sql}, "ИД") < (?, ?)')
+                params += list(after)
+        else:
+            order_by = 'ORDER BY "ИД" DESC'
+            if after is not None:
+                conditions.append('"ИД" < ?')
+                params.append(after[0])
+
+        select_sql = SELECT_HISTORY_SQL.replace(' FROM ', f', {sort_sql or "NULL"} FROM ', 1)
+        if executor and (cluster_prefix or cast_number):
+            # Номер кластера и номер отливки избирательнее исполнителя:
+            # унарный плюс не дает планировщику взять индекс исполнителя
+            conditions.append('(+"Исполнитель_Склейки" = ? OR +"Исполнитель_Контроля" = ?)')
+            params += [executor, executor]
+            executor = None
+        if executor:
+            # Две ветки по индексам исполнителей вместо OR по двум столбцам
+            branches = []
+            branch_params = []
+            for column in ('Исполнитель_Склейки', 'Исполнитель_Контроля'):
+                where = ' AND '.join([f'"{column}" = ?'] + conditions)
+                branches.append(f'SELECT "ИД" FROM (SELECT "ИД" FROM "Маршрутные_Карты" '
+                                f'WHERE {where} {order_by} LIMIT ?)')
+                branch_params += [executor] + params + [limit]
+            sql = f'{select_sql} WHERE "ИД" IN ({" UNION ".join(branches)}) {order_by} LIMIT ?'
+            params = branch_params
+        else:
+            sql = select_sql
+            if conditions:
+                sql += ' WHERE ' + ' AND '.join(conditions)
+            sql += f' {order_by} LIMIT ?'
+        params.append(limit)
+
+        with self.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        forms = [_history_row(row) for row in rows]
+        if len(rows) < limit:
+            return forms, None
+        last = rows[-1]
+        next_after = (last[-1], last[0]) if sort_sql else (last[0],)
+        return forms, next_after
+
+    def get_form(self, cluster_number):
+        """Возвращает сохраненную карту по номеру кластера или None"""
+        with self.connection() as conn:
+            row = conn.execute(SELECT_HISTORY_SQL + ' WHERE "Номер_Кластера" = ?', (cluster_number,)).fetchone()
+        return _history_row(row) if row else None
+
+    def reserve_cluster_numbers(self, date_str, count=1):
+        """
+        Атомарно резервирует count последовательных номеров кластеров
+        для месяца даты склейки и возвращает их списком.
+        Счетчик месяца увеличивается в транзакции BEGIN IMMEDIATE, поэтому
+        одновременные станции и процессы получают разные номера без пропусков.
+        """
+        if count < 1:
+            raise ValueError("Количество номеров должно быть положительным")
+        year_short, month = _parse_date(date_str)
+        key = (int(year_short), month)
+
+        with self.connection() as conn:
+            # Блокировка на запись берется сразу, до чтения счетчика
+            conn.execute('BEGIN IMMEDIATE')
+            last_number = _last_cluster_number(conn, year_short, month)
+            if last_number + count > MAX_CLUSTERS_PER_MONTH:
+                conn.rollback()
+                raise ValueError("Превышено максимальное количество кластеров для этого месяца (999)")
+
+            conn.execute(UPSERT_COUNTER_SQL, key + (last_number + count,))
+            conn.commit()
+
+        return [_format_cluster_number(year_short, month, number)
+                for number in range(last_number + 1, last_number + count + 1)]
+
+    def next_cluster_number(self, date_str):
+        """
+        Генерирует следующий номер кластера на основе даты склейки
+        date_str: строка в формате dd.MM.yyyy
+        Номер резервируется и другим станциям уже не выдается.
+        """
+        return self.reserve_cluster_numbers(date_str, 1)[0]
+
+    def peek_cluster_number(self, date_str):
+        """
+        Следующий свободный номер кластера для месяца даты склейки без резервирования:
+        номер занимает запись карты в save_form. Если другая станция успеет
+        записать карту с тем же номером, save_form сообщит о повторе номера.
+        """
+        year_short, month = _parse_date(date_str)
+        with self.connection() as conn:
+            last_number = _last_cluster_number(conn, year_short, month)
+            # Чтение без записи: транзакция чтения не остается открытой в пуле
+            if conn.in_transaction:
+                conn.commit()
+        if last_number >= MAX_CLUSTERS_PER_MONTH:
+            raise ValueError("Превышено максимальное количество кластеров для этого месяца (999)")
+        return _format_cluster_number(year_short, month, last_number + 1)
+
+class AsyncHistoryRepository:
+    """Обертка для asyncio: запросы к базе выполняются в отдельных потоках"""
+
+    def __init__(self, repository=None, max_workers=4):
+        self.repository = repository or HistoryRepository(pool_size=max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='history-db')
+
+    async def _run(self, func, *args):
+        # asyncio нужен только этой обертке, окно не тратит время на его импорт
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def save_form(self, data):
+        return await self._run(self.repository.save_form, data)
+
+    async def next_cluster_number(self, date_str):
+        return await self._run(self.repository.next_cluster_number, date_str)
+
+    async def save_forms_bulk(self, records, chunk_size=500):
+        return await self._run(self.repository.save_forms_bulk, list(records), chunk_size)
+
+    async def search_forms(self, **filters):
+        return await self._run(lambda: self.repository.search_forms(**filters))
+
+    async def get_form(self, cluster_number):
+        return await self._run(self.repository.get_form, cluster_number)
+
+    async def reserve_cluster_numbers(self, date_str, count=1):
+        return await self._run(self.repository.reserve_cluster_numbers, date_str, count)
+
+    async def peek_cluster_number(self, date_str):
+        return await self._run(self.repository.peek_cluster_number, date_str)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.repository.close()
+
+# Общий репозиторий для функций модуля
+_repository = None
+_repository_lock = threading.Lock()
+
+def get_repository(journal_mode=None):
+    """
+    Возвращает общий репозиторий истории, создавая его при первом обращении;
+    journal_mode действует только при создании (по умолчанию см. default_journal_mode)
+    """
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = HistoryRepository(journal_mode=journal_mode)
+        return _repository
+
+def create_history_database():
+    """Создает базу истории форм"""
+    try:
+        get_repository().create_schema()
     except Exception as e:
-        print(f"Ошибка при создании базы данных: {e}")
+        logger.error("Ошибка при создании базы данных: %s", e)
         raise
-    finally:
-        conn.close()
 
 def validate_cluster_number(number):
     """Проверяет формат номера кластера"""
@@ -57,95 +686,33 @@ def validate_cluster_number(number):
 
 def save_form_data(data):
     """Сохраняет данные формы в базу"""
-    # Проверяем формат номера кластера
-    validate_cluster_number(data['cluster_number'])
-
-    conn = sqlite3.connect('история_форм.db')
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute('''
-            INSERT INTO "Маршрутные_Карты" (
-                "Номер_Кластера",
-                "Номер_Отливки",
-                "Наименование_Отливки",
-                "Дата_Склейки",
-                "Исполнитель_Склейки",
-                "Количество_Склейки",
-                "Примечание_Склейки",
-                "Дата_Контроля",
-                "Время_Контроля",
-                "Исполнитель_Контроля",
-                "Количество_Контроля",
-                "Примечание_Контроля",
-                "Дата_Создания"
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['cluster_number'],
-            data['cast_number'],
-            data['cast_name'],
-            data['gluing_date'],
-            data['gluing_executor'],
-            data['gluing_quantity'],
-            data['gluing_notes'],
-            data['control_date'],
-            data['control_time'],
-            data['control_executor'],
-            data['control_quantity'],
-            data['control_notes'],
-            datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-        ))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        raise ValueError(f"Кластер с номером {data['cluster_number']} уже существует в базе")
-    finally:
-        conn.close()
+    get_repository().save_form(data)
 
 def get_next_cluster_number(date_str):
     """
     Генерирует следующий номер кластера на основе даты склейки
     date_str: строка в формате dd.MM.yyyy
     """
-    # Добавить проверку входных данных:
-    if not date_str or len(date_str.split('.')) != 3:
-        raise ValueError("Неверный формат даты. Ожидается dd.MM.yyyy")
-    
-    # Разбираем дату
-    day, month, year = map(int, date_str.split('.'))
-    year_short = str(year)[-2:]  # Берем последние 2 цифры года
-    
-    conn = sqlite3.connect('история_форм.db')
-    cursor = conn.cursor()
-    
-    try:
-        # Ищем последний номер для этого месяца и года
-        cursor.execute('''
-            SELECT "Номер_Кластера"
-            FROM "Маршрутные_Карты"
-            WHERE "Номер_Кластера" LIKE ?
-            ORDER BY "Номер_Кластера" DESC
-            LIMIT 1
-        ''', (f'К{year_short}/{month:02d}-%',))
-        
-        result = cursor.fetchone()
-        
-        if result:
-            # Если есть номера для этого месяца, увеличиваем последний на 1
-            last_number = int(result[0][-3:])
-            next_number = last_number + 1
-            if next_number > 999:
-                raise ValueError("Превышено максимальное количество кластеров для этого месяца (999)")
-        else:
-            # Если нет номеров для этого месяца, начинаем с 001
-            next_number = 1
-        
-        # Формируем новый номер кластера
-        new_cluster_number = f'К{year_short}/{month:02d}-{next_number:03d}'
-        return new_cluster_number
-        
-    finally:
-        conn.close()
+    return get_repository().next_cluster_number(date_str)
+
+def peek_next_cluster_number(date_str):
+    """Следующий номер кластера для показа в форме; резервируется он при записи карты"""
+    return get_repository().peek_cluster_number(date_str)
+
+def save_forms_bulk(records, chunk_size=500):
+    """Сохраняет набор форм пачками и возвращает отчет о вставленных и отклоненных записях"""
+    return get_repository().save_forms_bulk(records, chunk_size)
+
+def search_forms(**filters):
+    """Ищет карты в истории; параметры см. HistoryRepository.search_forms"""
+    return get_repository().search_forms(**filters)
+
+def reserve_cluster_numbers(date_str, count):
+    """Резервирует count последовательных номеров кластеров для пакетной печати"""
+    return get_repository().reserve_cluster_numbers(date_str, count)
 
 if __name__ == "__main__":
+    from instrumentation import configure_logging
+    configure_logging()
     create_history_database()
     print("База данных истории форм успешно создана.") 
\ No newline at end of file
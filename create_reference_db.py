@@ -1,113 +1,147 @@
+import logging
 import sqlite3
+import os
 
-def create_reference_database():
+logger = logging.getLogger(__name__)
+
+# Путь к справочнику можно переопределить переменной окружения
+REFERENCE_DB_PATH = os.environ.get('FORMBUILDER_REFERENCE_DB', 'справочник.db')
+
+# Файлы с исходным наполнением справочника
+SEED_FILES = ('справочник_люди.csv', 'справочник_отливки.csv')
+
+# Роли сотрудников
+ROLE_ASSEMBLER = 'Сборщик'
+ROLE_ASSEMBLY_CONTROLLER = 'Контролер сборки'
+
+# Семейства отливок в порядке вывода в списках
+CAST_FAMILIES = ('ЛГМ', 'ЛПД', 'Прочие')
+
+# Таблицы прежней версии справочника: таблица -> роль или семейство
+LEGACY_PEOPLE_TABLES = {
+    'Контролеры_Сборки': ROLE_ASSEMBLY_CONTROLLER,
+    'Сборщики': ROLE_ASSEMBLER,
+    'Старшие_Смены_Плавки': 'Старший смены плавки',
+    'Участники_Плавки': 'Участник плавки',
+    'Специалисты_Термообработка': 'Специалист термообработки',
+    'Специалисты_Дробемет': 'Специалист дробемета',
+    'Специалисты_Резка': 'Специалист резки',
+    'Специалисты_Зачистка': 'Специалист зачистки',
+    'Контролеры': 'Контролер',
+}
+LEGACY_CAST_TABLES = {
+    'ЛГМ_Отливки': 'ЛГМ',
+    'ЛПД_Отливки': 'ЛПД',
+    'Прочие_Отливки': 'Прочие',
+}
+
+# Индекс по роли (семейству) хранит и ИД, поэтому выборка по роли идет
+# по индексу сразу в порядке добавления
+CREATE_REFERENCE_SCHEMA_SQL = (
+    '''CREATE TABLE IF NOT EXISTS "Люди" (
+        "ИД" INTEGER PRIMARY KEY,
+        "ФИО" TEXT NOT NULL,
+        "Роль" TEXT NOT NULL,
+        UNIQUE ("ФИО", "Роль")
+    )''',
+    '''CREATE INDEX IF NOT EXISTS "idx_люди_роль" ON "Люди" ("Роль")''',
+    '''CREATE TABLE IF NOT EXISTS "Отливки" (
+        "ИД" INTEGER PRIMARY KEY,
+        "Номер" TEXT NOT NULL UNIQUE,
+        "Наименование" TEXT NOT NULL,
+        "Семейство" TEXT NOT NULL CHECK ("Семейство" IN ('ЛГМ', 'ЛПД', 'Прочие'))
+    )''',
+    '''CREATE INDEX IF NOT EXISTS "idx_отливки_семейство" ON "Отливки" ("Семейство")''',
+    '''CREATE TABLE IF NOT EXISTS "Типы_Эксперимента" ("Наименование" TEXT)''',
+)
+
+# Типы эксперимента не относятся ни к людям, ни к отливкам
+EXPERIMENT_TYPES = [('Бумага',), ('Волокно',)]
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+def _legacy_rows(conn):
+    # Строки таблиц прежней версии в виде записей нового справочника
+    people = []
+    for table, role in LEGACY_PEOPLE_TABLES.items():
+        if _table_exists(conn, table):
+            people += [{'ФИО': fio, 'Роль': role} for (fio,) in conn.execute(f'SELECT "ФИО" FROM "{table}"')]
+    casts = []
+    for table, family in LEGACY_CAST_TABLES.items():
+        if not _table_exists(conn, table):
+            continue
+        if family == 'Прочие':
+            # У прочих отливок нет номера, номером служит наименование
+            sql = f'SELECT "Наименование", "Наименование" FROM "{table}"'
+        else:
+            sql = f'SELECT "Номер", "Наименование" FROM "{table}"'
+        casts += [{'Номер': number, 'Наименование': name, 'Семейство': family}
+                  for number, name in conn.execute(sql)]
+    return people, casts
+
+def ensure_reference_schema(conn):
+    """
+    Создает таблицы справочника, если их нет. Справочник прежней версии
+    (по таблице на роль и на семейство отливок) переносится в новые таблицы,
+    пока они пусты; старые таблицы остаются без изменений.
+    Возвращает True, если данные были перенесены.
+    """
+    from reference_import import upsert_castings, upsert_people
+
+    for sql in CREATE_REFERENCE_SCHEMA_SQL:
+        conn.execute(sql)
+    conn.commit()
+
+    # Перенос решается по наличию строк, а не по созданию таблиц: если прошлый
+    # запуск прервался после создания таблиц, перенос выполняется снова
+    people, casts = _legacy_rows(conn)
+    if conn.execute('SELECT 1 FROM "Люди" LIMIT 1').fetchone():
+        people = []
+    if conn.execute('SELECT 1 FROM "Отливки" LIMIT 1').fetchone():
+        casts = []
+    if not people and not casts:
+        return False
+    if people:
+        upsert_people(conn, people)
+    if casts:
+        upsert_castings(conn, casts)
+    logger.info("Справочник прежней версии перенесен: людей %s, отливок %s", len(people), len(casts))
+    return True
+
+def create_reference_database(db_path=None):
     # Добавить обработку ошибок:
+    conn = None
     try:
+        from reference_import import import_file
+
         # Подключаемся к базе данных (создаст файл, если его нет)
-        conn = sqlite3.connect('справочник.db')
-        cursor = conn.cursor()
-
-        # Данные для заполнения таблиц
-        data = {
-            'Контролеры_Сборки': [('Елхова',), ('Малых',), ('Романцева',), ('Шестункина',)],
-            'Сборщики': [('Буцик',), ('Минакова',), ('Ротарь',), ('Чернова',), ('Чупахина',)],
-            'ЛГМ_Отливки': [
-                ('ЛСКМ.03.01.102-Л1', 'Держатель ригеля'),
-                ('ЛСКМ.03.51.102-Л', 'Держатель ригеля OPTIMA'),
-                ('ЛСКМ.04.00.004-Л', 'Держатель диагонали'),
-                ('ЛСКМ.04.00.002-Л', 'Держатель диагонали'),
-                ('ОКР-2410.02.000', 'Вороток'),
-                ('ЛСКМ.00.03.202-Л', 'Вороток'),
-                ('ЛСКМ.98.53.101-Л', 'Соединитель угловой'),
-                ('ЛСКМ.98.14.001-Л', 'Адаптер'),
-                ('ЛСКМ.00.06.001-Л U1', 'Накладка для резьбы домкрата'),
-                ('АМ.3509030-130 3Г', 'Блок-картер 2 цилиндра'),
-                ('5У.01.001-V15m1', 'ПНГ'),
-                ('Н2А.03М.01.01-Л', 'Полухомут верхний'),
-                ('Н2А.05М.02.01-Л', 'Полухомут нижний')
-            ],
-            'ЛПД_Отливки': [
-                ('8450090064-Л', 'Корпус шкива опорного'),
-                ('2123-1011371-Л', 'Фиксатор шестерни привода масляного насоса'),
-                ('21214-1011371-Л', 'Фиксатор шестерни привода масляного насоса'),
-                ('11189-1041034-Л', 'Кронштейн генератора'),
-                ('11189-1041034-10-Л', 'Кронштейн генератора'),
-                ('21082-3701652-Л', 'Кронштейн генератора нижний'),
-                ('21214-3701652-Л', 'Кронштейн генератора нижний'),
-                ('8450036497-Л', 'Кронштейн крепления передней защитной крышки'),
-                ('850120774-Л', 'Кронштейн вспомогательных агрегатов')
-            ],
-            'Прочие_Отливки': [
-                ('Чугун',), ('Колесо РИТМ',), ('Скоба',), ('Лопасть',),
-                ('Корпус',), ('Изложница',), ('Защита',), ('Кольцо вкладыш',)
-            ],
-            'Типы_Эксперимента': [('Бумага',), ('Волокно',)],
-            'Старшие_Смены_Плавки': [
-                ('Белков',), ('Валиулин',), ('Ермаков',), ('Карасев',)
-            ],
-            'Участники_Плавки': [
-                ('Беляев',), ('Волков',), ('Исмаилов',), ('Кокшин',),
-                ('Левин',), ('Политов',), ('Рабинович',), ('Семенов',), ('Терентьев',)
-            ],
-            'Специалисты_Термообработка': [('Аюбов',), ('Эгамов',)],
-            'Специалисты_Дробемет': [('Аюбов',), ('Эгамов',)],
-            'Специалисты_Резка': [
-                ('Абдухакимов',), ('Ахмаджонов',), ('Исмаилов',), ('Косимов',),
-                ('Косимов-2',), ('Машрапов',), ('Отаназаров',), ('Самиев',),
-                ('Туичиев',), ('Эргашев',)
-            ],
-            'Специалисты_Зачистка': [
-                ('Абдуллаев',), ('Бурхонов',), ('Матесаев',), ('Отаназаров',), ('Самиев',)
-            ],
-            'Контролеры': [('Елхова',), ('Лабуткина',), ('Рябова',), ('Улитина',)]
-        }
-
-        # Создаем таблицы
-        tables = {
-            'Контролеры_Сборки': ['ФИО'],
-            'Сборщики': ['ФИО'],
-            'ЛГМ_Отливки': ['Номер', 'Наименование'],
-            'ЛПД_Отливки': ['Номер', 'Наименование'],
-            'Прочие_Отливки': ['Наименование'],
-            'Типы_Эксперимента': ['Наименование'],
-            'Старшие_Смены_Плавки': ['ФИО'],
-            'Участники_Плавки': ['ФИО'],
-            'Специалисты_Термообработка': ['ФИО'],
-            'Специалисты_Дробемет': ['ФИО'],
-            'Специалисты_Резка': ['ФИО'],
-            'Специалисты_Зачистка': ['ФИО'],
-            'Контролеры': ['ФИО']
-        }
-
-        # Создаем таблицы, если их нет
-        for table_name, columns in tables.items():
-            columns_sql = ', '.join([f'"{col}" TEXT' for col in columns])
-            cursor.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns_sql})')
-            
-            # Проверяем, есть ли данные в таблице
-            cursor.execute(f'SELECT COUNT(*) FROM "{table_name}"')
-            count = cursor.fetchone()[0]
-            
-            # Заполняем данными только если таблица пустая
-            if count == 0:
-                rows = data[table_name]
-                placeholders = ','.join(['?' for _ in range(len(rows[0]))])
-                cursor.executemany(
-                    f'INSERT INTO "{table_name}" VALUES ({placeholders})',
-                    rows
-                )
-                print(f'Таблица "{table_name}" создана и заполнена.')
-            else:
-                print(f'Таблица "{table_name}" уже содержит данные, пропускаем заполнение.')
-
-        # Сохраняем изменения и закрываем соединение
+        conn = sqlite3.connect(db_path or REFERENCE_DB_PATH)
+        ensure_reference_schema(conn)
+
+        conn.executemany(
+            'INSERT INTO "Типы_Эксперимента" SELECT ? '
+            'WHERE NOT EXISTS (SELECT 1 FROM "Типы_Эксперимента" WHERE "Наименование" = ?)',
+            [(name, name) for (name,) in EXPERIMENT_TYPES])
         conn.commit()
+
+        # Исходное наполнение загружается тем же импортом, что и обновления:
+        # повторный запуск ничего не дублирует, а только дополняет справочник
+        seed_dir = os.path.dirname(os.path.abspath(__file__))
+        for seed_file in SEED_FILES:
+            report = import_file(os.path.join(seed_dir, seed_file), conn=conn, update_existing=False)
+            print(f'{seed_file}: добавлено {len(report["added"])}, '
+                  f'изменено {len(report["updated"])}, без изменений {report["unchanged"]}')
     except Exception as e:
-        print(f"Ошибка при создании базы данных: {e}")
+        logger.error("Ошибка при создании базы данных: %s", e)
         raise
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 if __name__ == "__main__":
+    from instrumentation import configure_logging
+    configure_logging()
     create_reference_database()
-    print("База данных успешно создана и заполнена.") 
\ No newline at end of file
+    print("База данных успешно создана и заполнена.")
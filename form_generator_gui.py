@@ -1,20 +1,179 @@
+import time
+
+# Отметки времени запуска для --profile-startup
+_import_started = time.perf_counter()
+
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                              QHBoxLayout, QLabel, QLineEdit, QPushButton, 
                              QFileDialog, QFormLayout, QMessageBox, QGroupBox,
-                             QDateEdit, QTimeEdit, QComboBox)
-from PySide6.QtCore import Qt, QDate, QTime, QPropertyAnimation, QEasingCurve
+                             QDateEdit, QTimeEdit, QComboBox, QTabWidget, QTableWidget,
+                             QTableWidgetItem, QAbstractItemView, QHeaderView, QCheckBox,
+                             QCompleter, QDialog)
+from PySide6.QtCore import (Qt, QDate, QTime, QTimer, QPropertyAnimation, QEasingCurve, QStringListModel,
+                            QObject, Signal)
 from PySide6.QtGui import QFont
-from pptx import Presentation
-from pptx.util import Pt
-import qrcode
+_qt_imported = time.perf_counter()
+
+import argparse
+import logging
 import os
-from io import BytesIO
 import sys
-from datetime import datetime
-import subprocess  # Добавляем в начало файла
-import time
-import sqlite3
-from create_history_db import save_form_data, validate_cluster_number, get_next_cluster_number
+# pptx, qrcode и PIL загружаются в фоне после показа окна (см. GenerationQueue.warm_up)
+from create_history_db import (validate_cluster_number, peek_next_cluster_number,
+                               get_repository, search_forms, MAX_CLUSTERS_PER_MONTH)
+from reference_cache import ReferenceCache
+from cast_index import CastIndex
+from print_spooler import PrintSpooler, JOB_DONE, JOB_FAILED, JOB_RETRYING
+from generation_worker import GenerationQueue, ResponsivenessProbe
+from template_registry import DEFAULT_TEMPLATE, TemplateRegistry
+from instrumentation import (METRICS, METRICS_JSON_PATH, METRICS_PROMETHEUS_PATH, STAGE_TITLES,
+                             configure_logging)
+_modules_imported = time.perf_counter()
+
+# Столбцы таблицы истории: поле записи -> заголовок
+HISTORY_TABLE_COLUMNS = (
+    ('cluster_number', "Номер кластера"),
+    ('cast_number', "Номер отливки"),
+    ('cast_name', "Наименование"),
+    ('gluing_date', "Дата склейки"),
+    ('gluing_executor', "Исполнитель склейки"),
+    ('control_date', "Дата контроля"),
+    ('control_executor', "Исполнитель контроля"),
+    ('created_at', "Создана"),
+)
+
+# Количество карт на странице истории
+HISTORY_PAGE_SIZE = 50
+
+# Период проверки изменений справочника (мс)
+REFERENCE_POLL_INTERVAL = 5000
+
+# Количество подсказок при поиске отливки
+CAST_SUGGESTIONS = 20
+
+# Сколько ждать допечатывания очереди при закрытии окна (с)
+PRINT_SHUTDOWN_TIMEOUT = 10
+
+# Период выгрузки метрик в файлы (мс)
+METRICS_EXPORT_INTERVAL = 60000
+
+# Столбцы окна диагностики: ключ гистограммы -> заголовок
+DIAGNOSTICS_COLUMNS = (
+    ('count', "Количество"),
+    ('mean', "Среднее, мс"),
+    ('p50', "Медиана, мс"),
+    ('p95', "p95, мс"),
+    ('p99', "p99, мс"),
+    ('max', "Максимум, мс"),
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать создания поставленных в очередь карт при закрытии окна (с)
+GENERATION_SHUTDOWN_TIMEOUT = 60
+
+# Файл шаблона карты, если в каталоге шаблонов нет общего шаблона
+TEMPLATE_PATH = DEFAULT_TEMPLATE
+
+# Формат карты для печати: pptx печатается связанным приложением (PowerPoint),
+# pdf рисуется без PowerPoint (см. card_export) и печатается как документ PDF
+PRINT_FORMAT = 'pdf' if os.environ.get('FORMBUILDER_PRINT_FORMAT', '').lower() == 'pdf' else 'pptx'
+
+# Адрес службы рендеринга (render_service.py); если задан, карты создаются,
+# номера выдаются и история ведется службой, а окно работает как тонкий клиент
+SERVICE_URL = os.environ.get('FORMBUILDER_SERVICE_URL')
+
+# Замер отзывчивости окна включается переменной окружения
+UI_PROBE_ENABLED = os.environ.get('FORMBUILDER_UI_PROBE') == '1'
+
+class StartupProfile:
+    """Длительность этапов запуска окна"""
+
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.phases = []
+
+    def mark(self, name, moment=None):
+        """Завершает этап name (по умолчанию - текущим моментом)"""
+        moment = time.perf_counter() if moment is None else moment
+        self.phases.append((name, moment - self.last))
+        self.last = moment
+
+    def elapsed(self, name):
+        """Время от начала запуска до конца этапа name, с"""
+        total = 0.0
+        for phase, seconds in self.phases:
+            total += seconds
+            if phase == name:
+                return total
+        return None
+
+    def report(self):
+        lines = []
+        total = 0.0
+        for name, seconds in self.phases:
+            total += seconds
+            lines.append(f"{name:<32} {seconds * 1000:8.1f} мс  (с начала {total * 1000:8.1f} мс)")
+        return '\n'.join(lines)
+
+class DiagnosticsDialog(QDialog):
+    """Длительность этапов создания карт с момента запуска"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Диагностика")
+        self.setMinimumWidth(700)
+        layout = QVBoxLayout(self)
+
+        self.table = QTableWidget(0, len(DIAGNOSTICS_COLUMNS))
+        self.table.setHorizontalHeaderLabels([title for _, title in DIAGNOSTICS_COLUMNS])
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        layout.addWidget(self.table)
+
+        buttons = QHBoxLayout()
+        refresh_btn = QPushButton("Обновить")
+        refresh_btn.clicked.connect(self.refresh)
+        export_btn = QPushButton("Сохранить метрики")
+        export_btn.clicked.connect(self.export)
+        close_btn = QPushButton("Закрыть")
+        close_btn.clicked.connect(self.accept)
+        buttons.addWidget(refresh_btn)
+        buttons.addWidget(export_btn)
+        buttons.addStretch()
+        buttons.addWidget(close_btn)
+        layout.addLayout(buttons)
+        self.refresh()
+
+    def refresh(self):
+        stages = METRICS.snapshot()
+        # Сначала этапы в порядке конвейера, затем остальные
+        order = [stage for stage in STAGE_TITLES if stage in stages]
+        order += sorted(stage for stage in stages if stage not in STAGE_TITLES)
+        self.table.setRowCount(len(order))
+        self.table.setVerticalHeaderLabels([STAGE_TITLES.get(stage, stage) for stage in order])
+        for row, stage in enumerate(order):
+            data = stages[stage]
+            for col, (key, _) in enumerate(DIAGNOSTICS_COLUMNS):
+                value = str(data[key]) if key == 'count' else f"{data[key] * 1000:.1f}"
+                item = QTableWidgetItem(value)
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+
+    def export(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Сохранить метрики", METRICS_JSON_PATH,
+                                              "JSON (*.json);;Prometheus (*.prom)")
+        if not path:
+            return
+        try:
+            METRICS.export(path)
+        except OSError as e:
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось сохранить метрики: {e}")
+
+class PrintStatusBridge(QObject):
+    """Передает состояние заданий печати из потока очереди в поток GUI"""
+    job_updated = Signal(object)
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -91,16 +250,25 @@ class MainWindow(QMainWindow):
             }
         """)
 
+        # Создаем вкладки: новая карта и история
+        self.tabs = QTabWidget()
+        self.setCentralWidget(self.tabs)
+
         # Создаем центральный виджет и основной layout
         central_widget = QWidget()
-        self.setCentralWidget(central_widget)
+        self.tabs.addTab(central_widget, "Новая карта")
         main_layout = QVBoxLayout(central_widget)
         main_layout.setSpacing(20)
         main_layout.setContentsMargins(20, 20, 20, 20)
 
-        # Подключаемся к базе данных
-        self.db_conn = sqlite3.connect('справочник.db')
-        self.db_cursor = self.db_conn.cursor()
+        # Справочник читается в память и перечитывается только после изменений
+        self.reference = ReferenceCache()
+
+        # Клиент службы рендеринга загружается, только если служба настроена
+        self.service = None
+        if SERVICE_URL:
+            from render_service import RenderServiceClient
+            self.service = RenderServiceClient(SERVICE_URL)
 
         # Создаем группы полей
         self.create_cast_group()
@@ -117,7 +285,13 @@ class MainWindow(QMainWindow):
 
         # Добавляем кнопки
         button_layout = QHBoxLayout()
+        self.generation_label = QLabel("")
+        button_layout.addWidget(self.generation_label)
         button_layout.addStretch()
+        self.cancel_generation_btn = QPushButton("Отменить очередь")
+        self.cancel_generation_btn.setFixedHeight(40)
+        self.cancel_generation_btn.setEnabled(False)
+        button_layout.addWidget(self.cancel_generation_btn)
         self.generate_btn = QPushButton("Сгенерировать")
         self.generate_btn.setFixedWidth(200)
         self.generate_btn.setFixedHeight(40)
@@ -128,6 +302,59 @@ class MainWindow(QMainWindow):
         # Устанавливаем текущую дату и время
         self.set_current_datetime()
 
+        # Вкладка истории
+        self.create_history_tab()
+
+        # Очередь печати работает в фоне, окно не ждет отправки на принтер
+        self.print_bridge = PrintStatusBridge(self)
+        self.print_bridge.job_updated.connect(self.on_print_job_updated)
+        self.spooler = PrintSpooler(on_update=self.print_bridge.job_updated.emit)
+
+        # Шаблоны по семействам отливок; измененный на диске шаблон
+        # перечитывается при следующей карте без перезапуска окна
+        self.templates = TemplateRegistry(default_path=TEMPLATE_PATH)
+
+        # Данные поставленных в очередь карт: номер задания -> данные формы;
+        # если карту не удалось сохранить, форма заполняется ими снова
+        self.submitted_forms = {}
+        # Состояние формы сразу после отправки карты: изменилась ли форма с тех пор
+        self.cleared_form = None
+
+        # Карты создаются в пуле потоков: кнопку можно нажимать, не дожидаясь
+        # предыдущей карты, а окно не подвисает на заполнении шаблона
+        if self.service:
+            # Служба записывает карту в историю при рендеринге, отдельная запись не нужна
+            self.generation = GenerationQueue(
+                TEMPLATE_PATH, render=lambda template_path, data: self.service.render_to_file(
+                    template_path, data, fmt=PRINT_FORMAT),
+                save=lambda data: None, render_saves=True, parent=self)
+        else:
+            self.generation = GenerationQueue(TEMPLATE_PATH, render=self.generate_pptx_with_data, parent=self)
+        self.generation.signals.progress.connect(self.on_generation_progress)
+        self.generation.signals.finished.connect(self.on_generation_finished)
+        self.generation.signals.failed.connect(self.on_generation_failed)
+        self.generation.signals.cancelled.connect(self.on_generation_cancelled)
+        self.generation.signals.pending_changed.connect(self.on_generation_pending_changed)
+        self.cancel_generation_btn.clicked.connect(self.generation.cancel_all)
+
+        # Метрики этапов периодически выгружаются в файлы JSON и Prometheus
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.export_metrics)
+        self.metrics_timer.start(METRICS_EXPORT_INTERVAL)
+        self.diagnostics_btn = QPushButton("Диагностика")
+        self.diagnostics_btn.clicked.connect(self.show_diagnostics)
+        self.statusBar().addPermanentWidget(self.diagnostics_btn)
+
+        self.probe = None
+        if UI_PROBE_ENABLED:
+            self.probe = ResponsivenessProbe(parent=self)
+            self.probe.start()
+
+        # Периодически проверяем, не изменили ли справочник
+        self.reference_timer = QTimer(self)
+        self.reference_timer.timeout.connect(self.refresh_reference_data)
+        self.reference_timer.start(REFERENCE_POLL_INTERVAL)
+
     def create_cast_group(self):
         self.cast_group = QGroupBox("Информация об отливке")
         layout = QFormLayout()
@@ -135,7 +362,21 @@ class MainWindow(QMainWindow):
         layout.setContentsMargins(20, 20, 20, 20)
 
         self.fields = {}
-        
+        self.cast_index = CastIndex(())
+
+        # Поиск отливки по части номера или наименования
+        self.cast_search = QLineEdit()
+        self.cast_search.setPlaceholderText("Начните вводить номер или наименование")
+        self.cast_suggestions = {}  # Текст подсказки -> номер отливки
+        self.cast_completer_model = QStringListModel(self)
+        self.cast_completer = QCompleter(self.cast_completer_model, self)
+        # Список уже отфильтрован индексом, QCompleter только показывает его
+        self.cast_completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.cast_completer.setMaxVisibleItems(CAST_SUGGESTIONS)
+        self.cast_completer.activated.connect(self.select_suggested_cast)
+        self.cast_search.setCompleter(self.cast_completer)
+        self.cast_search.textEdited.connect(self.update_cast_suggestions)
+
         # Создаем выпадающие списки для номера и наименования отливки
         self.fields['cast_number'] = QComboBox()
         self.fields['cast_name'] = QComboBox()
@@ -158,6 +399,7 @@ class MainWindow(QMainWindow):
         self.generate_number_btn.clicked.connect(self.generate_cluster_number)
         number_layout.addWidget(self.generate_number_btn)
 
+        layout.addRow(self.create_label("Поиск отливки:"), self.cast_search)
         layout.addRow(self.create_label("Номер отливки (модели):"), self.fields['cast_number'])
         layout.addRow(self.create_label("Наименование отливки (модели):"), self.fields['cast_name'])
         layout.addRow(self.create_label("Номер кластера:"), number_layout)
@@ -262,6 +504,33 @@ class MainWindow(QMainWindow):
         # Обновляем текущую дату и время
         self.set_current_datetime()
 
+    def collect_fields(self):
+        """Данные формы из полей окна"""
+        data = {}
+        for field, widget in self.fields.items():
+            if isinstance(widget, QDateEdit):
+                data[field] = widget.date().toString("dd.MM.yyyy")
+            elif isinstance(widget, QTimeEdit):
+                data[field] = widget.time().toString("HH:mm")
+            elif isinstance(widget, QComboBox):
+                data[field] = widget.currentText()
+            else:
+                data[field] = widget.text()
+        return data
+
+    def restore_fields(self, data):
+        """Заполняет форму данными карты"""
+        for field, widget in self.fields.items():
+            value = data.get(field) or ''
+            if isinstance(widget, QDateEdit):
+                widget.setDate(QDate.fromString(value, "dd.MM.yyyy"))
+            elif isinstance(widget, QTimeEdit):
+                widget.setTime(QTime.fromString(value, "HH:mm"))
+            elif isinstance(widget, QComboBox):
+                widget.setCurrentIndex(widget.findText(value))
+            else:
+                widget.setText(value)
+
     def generate_form(self):
         try:
             # Валидация полей
@@ -270,240 +539,240 @@ class MainWindow(QMainWindow):
                 QMessageBox.warning(self, "Предупреждение", error_message)
                 return
 
-            # Проверяем наличие файла шаблона
-            if not os.path.exists("ШАБЛОН.pptx"):
-                raise FileNotFoundError("Файл ШАБЛОН.pptx не найден в текущей директории")
-            
             # Получаем данные из полей
-            data = {}
-            for field, widget in self.fields.items():
-                if isinstance(widget, QDateEdit):
-                    data[field] = widget.date().toString("dd.MM.yyyy")
-                elif isinstance(widget, QTimeEdit):
-                    data[field] = widget.time().toString("HH:mm")
-                elif isinstance(widget, QComboBox):
-                    data[field] = widget.currentText()
-                else:
-                    data[field] = widget.text()
-            
-            # Генерируем форму и получаем путь к файлу
-            output_path = self.generate_pptx_with_data("ШАБЛОН.pptx", data)
-            
-            # Сохраняем данные в базу истории
-            try:
-                save_form_data(data)
-            except ValueError as e:
-                QMessageBox.warning(self, "Предупреждение", str(e))
-                return
+            data = self.collect_fields()
+
+            # Шаблон карты - по семейству отливки (при работе через службу шаблон у нее)
+            data['family'] = self.cast_family(data['cast_number'])
+            template_path = self.templates.template_for(data['family'])
+            if not self.service and not os.path.exists(template_path):
+                raise FileNotFoundError(f"Файл {template_path} не найден в текущей директории")
             
-            # Печатаем файл
-            try:
-                if sys.platform == 'win32':  # Для Windows
-                    # Используем команду для прямой печати файла
-                    subprocess.run(['powershell', 'Start-Process', '-FilePath', output_path, 
-                                  '-Verb', 'Print', '-WindowStyle', 'Hidden'], shell=True)
-                    # Даем время на отправку на печать и закрываем PowerPoint
-                    time.sleep(2)  # Ждем 2 секунды
-                    try:
-                        subprocess.run(['taskkill', '/F', '/IM', 'POWERPNT.EXE'], 
-                                     shell=True, 
-                                     stderr=subprocess.DEVNULL,
-                                     stdout=subprocess.DEVNULL)
-                    except:
-                        pass  # Игнорируем ошибку, если PowerPoint уже закрыт
-                else:  # Для Linux/Mac
-                    subprocess.run(['lpr', output_path])
-            except Exception as e:
-                print(f"Ошибка при печати: {str(e)}")
-                QMessageBox.warning(self, "Предупреждение", 
-                                  "Файл создан, но не удалось отправить на печать автоматически.\n"
-                                  f"Файл сохранен как: {output_path}")
+            # Карта создается и сохраняется в истории в фоне, результат
+            # приходит сигналами очереди генерации
+            job_id = self.generation.submit(data, template_path)
+            self.submitted_forms[job_id] = data
             
-            # Очищаем поля после успешной генерации и печати
+            # Очищаем поля сразу, чтобы можно было вводить следующую карту
             self.clear_fields()
             
             # Устанавливаем текущую дату и время после очистки
             self.set_current_datetime()
+            self.cleared_form = self.collect_fields()
             
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Неожиданная ошибка: {str(e)}")
 
+    def on_generation_progress(self, job_id, percent, text):
+        self.statusBar().showMessage(f"Карта {job_id}: {text} ({percent}%)")
+
+    def on_generation_finished(self, job_id, output_path, data):
+        self.submitted_forms.pop(job_id, None)
+        self.statusBar().showMessage(f"Карта {data['cluster_number']} создана", 5000)
+        self.print_file(output_path)
+
+    def on_generation_failed(self, job_id, message, is_warning):
+        data = self.submitted_forms.pop(job_id, None)
+        if is_warning:
+            QMessageBox.warning(self, "Предупреждение", message)
+        else:
+            QMessageBox.critical(self, "Ошибка", message)
+        if data is None:
+            return
+        # Данные несохраненной карты возвращаются в форму для исправления. Если оператор
+        # уже вводит следующую карту, его ввод заменяется только с его согласия
+        if self.collect_fields() == self.cleared_form:
+            self.restore_fields(data)
+        elif QMessageBox.question(
+                self, "Карта не сохранена",
+                f"Карта {data['cluster_number']} не сохранена.\n"
+                "Вернуть ее данные в форму? Введенные сейчас данные будут заменены."
+        ) == QMessageBox.StandardButton.Yes:
+            self.restore_fields(data)
+
+    def on_generation_cancelled(self, job_id):
+        self.submitted_forms.pop(job_id, None)
+        self.statusBar().showMessage(f"Карта {job_id} отменена", 5000)
+
+    def on_generation_pending_changed(self, pending):
+        self.generation_label.setText(f"В очереди: {pending}" if pending else "")
+        self.cancel_generation_btn.setEnabled(pending > 0)
+
+    def show_diagnostics(self):
+        DiagnosticsDialog(self).exec()
+
+    def export_metrics(self):
+        """Выгружает метрики этапов в файлы для сборщика метрик"""
+        if not METRICS.snapshot():
+            return
+        for path in (METRICS_JSON_PATH, METRICS_PROMETHEUS_PATH):
+            try:
+                METRICS.export(path)
+            except OSError as e:
+                logger.warning("Не удалось выгрузить метрики в %s: %s", path, e)
+
+    def print_file(self, output_path):
+        """Ставит файл карты в очередь печати"""
+        try:
+            self.spooler.submit(output_path)
+        except Exception as e:
+            logger.error("Ошибка при печати: %s", e)
+            self.show_print_error(output_path)
+
+    def on_print_job_updated(self, job):
+        """Показывает состояние задания печати (вызывается в потоке GUI)"""
+        name = os.path.basename(job.path)
+        if job.status == JOB_DONE:
+            self.statusBar().showMessage(f"Отправлено на печать: {name}", 5000)
+        elif job.status == JOB_FAILED:
+            self.statusBar().showMessage(f"Ошибка печати: {name}", 5000)
+            self.show_print_error(job.path)
+        elif job.status == JOB_RETRYING:
+            self.statusBar().showMessage(f"Повтор печати ({job.attempts}): {name}")
+        else:
+            self.statusBar().showMessage(f"Печать: {name} (в очереди: {self.spooler.pending()})")
+
+    def show_print_error(self, output_path):
+        QMessageBox.warning(self, "Предупреждение", 
+                          "Файл создан, но не удалось отправить на печать автоматически.\n"
+                          f"Файл сохранен как: {output_path}")
+
+    def cast_family(self, cast_number):
+        """Семейство отливки по справочнику или None"""
+        try:
+            return self.reference.snapshot().cast_families.get(cast_number)
+        except Exception as e:
+            logger.error("Ошибка при определении семейства отливки: %s", e)
+            return None
+
     def generate_pptx_with_data(self, template_path, data):
-        # Открываем шаблон
-        prs = Presentation(template_path)
-        
-        # Проверяем наличие слайдов
-        if not prs.slides:
-            raise ValueError("Презентация не содержит слайдов")
-            
-        slide = prs.slides[0]
-        
-        # Создаем QR-код с обработкой ошибок
+        # Рендеринг вынесен в card_engine, чтобы работать без GUI;
+        # модуль загружается при первом обращении, а не при запуске окна.
+        # Через службу карта только создается: повторная печать не пишет историю
+        if self.service:
+            return self.service.render_to_file(template_path, data, save=False, fmt=PRINT_FORMAT)
+        if PRINT_FORMAT == 'pdf':
+            from card_export import export_card_pdf
+            return export_card_pdf(template_path, data)
+        from card_engine import render_card
+        return render_card(template_path, data)
+
+    def create_history_tab(self):
+        """Создает вкладку поиска по истории и повторной печати карт"""
+        history_widget = QWidget()
+        layout = QVBoxLayout(history_widget)
+        layout.setSpacing(15)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        filter_group = QGroupBox("Поиск по истории")
+        filter_layout = QFormLayout()
+        filter_layout.setSpacing(10)
+        filter_layout.setContentsMargins(20, 20, 20, 20)
+
+        self.history_filters = {
+            'cluster_prefix': QLineEdit(),
+            'cast_number': QLineEdit(),
+            'executor': QLineEdit(),
+        }
+        self.history_filters['cluster_prefix'].setPlaceholderText("Начало номера, например: К25/03")
+        self.history_filters['cast_number'].setPlaceholderText("Номер отливки полностью")
+        self.history_filters['executor'].setPlaceholderText("Исполнитель склейки или контроля")
+        for widget in self.history_filters.values():
+            widget.returnPressed.connect(self.search_history)
+
+        # Период по дате склейки
+        self.history_date_check = QCheckBox("с")
+        self.history_date_from = QDateEdit()
+        self.history_date_to = QDateEdit()
+        for widget, date in ((self.history_date_from, QDate.currentDate().addMonths(-1)),
+                             (self.history_date_to, QDate.currentDate())):
+            widget.setCalendarPopup(True)
+            widget.setDisplayFormat("dd.MM.yyyy")
+            widget.setDate(date)
+        date_layout = QHBoxLayout()
+        date_layout.addWidget(self.history_date_check)
+        date_layout.addWidget(self.history_date_from)
+        date_layout.addWidget(QLabel("по"))
+        date_layout.addWidget(self.history_date_to)
+        date_layout.addStretch()
+
+        filter_layout.addRow(self.create_label("Номер кластера:"), self.history_filters['cluster_prefix'])
+        filter_layout.addRow(self.create_label("Номер отливки:"), self.history_filters['cast_number'])
+        filter_layout.addRow(self.create_label("Исполнитель:"), self.history_filters['executor'])
+        filter_layout.addRow(self.create_label("Дата склейки:"), date_layout)
+        filter_group.setLayout(filter_layout)
+        layout.addWidget(filter_group)
+
+        # Результаты поиска
+        self.history_table = QTableWidget(0, len(HISTORY_TABLE_COLUMNS))
+        self.history_table.setHorizontalHeaderLabels([title for _, title in HISTORY_TABLE_COLUMNS])
+        self.history_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.history_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.history_table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.history_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.history_table.doubleClicked.connect(self.reprint_selected)
+        layout.addWidget(self.history_table)
+
+        button_layout = QHBoxLayout()
+        self.history_search_btn = QPushButton("Найти")
+        self.history_search_btn.clicked.connect(self.search_history)
+        self.history_next_btn = QPushButton("Далее")
+        self.history_next_btn.setEnabled(False)
+        self.history_next_btn.clicked.connect(self.next_history_page)
+        self.reprint_btn = QPushButton("Перепечатать")
+        self.reprint_btn.clicked.connect(self.reprint_selected)
+        button_layout.addWidget(self.history_search_btn)
+        button_layout.addWidget(self.history_next_btn)
+        button_layout.addStretch()
+        button_layout.addWidget(self.reprint_btn)
+        layout.addLayout(button_layout)
+
+        self.history_rows = []
+        self.history_query = {}
+        self.history_after = None
+        self.tabs.addTab(history_widget, "История")
+
+    def search_history(self):
+        """Выполняет поиск по истории с первой страницы"""
+        query = {name: widget.text().strip() for name, widget in self.history_filters.items()}
+        if self.history_date_check.isChecked():
+            query['date_from'] = self.history_date_from.date().toString("dd.MM.yyyy")
+            query['date_to'] = self.history_date_to.date().toString("dd.MM.yyyy")
+        self.history_query = query
+        self.load_history_page(None)
+
+    def next_history_page(self):
+        """Показывает следующую страницу результатов"""
+        if self.history_after is not None:
+            self.load_history_page(self.history_after)
+
+    def load_history_page(self, after):
         try:
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=1,
-            )
-            print(f"Создание QR-кода для значения: {data['cluster_number']}")
-            qr.add_data(str(data['cluster_number']))  # Явно преобразуем в строку
-            qr.make(fit=True)
-            qr_image = qr.make_image(fill_color="black", back_color="white")
+            search = self.service.search_forms if self.service else search_forms
+            rows, self.history_after = search(after=after, limit=HISTORY_PAGE_SIZE, **self.history_query)
         except Exception as e:
-            print(f"Ошибка при создании QR-кода: {str(e)}")
-            raise
-
-        # Сохраняем QR-код во временный буфер
-        image_stream = BytesIO()
-        qr_image.save(image_stream, format='PNG')
-        image_stream.seek(0)
-
-        # Добавляем QR-код рядом с "МАРШРУТНАЯ КАРТА"
-        for shape in slide.shapes:
-            if hasattr(shape, "text") and "МАРШРУТНАЯ КАРТА" in shape.text:
-                qr_width = 400000
-                qr_height = 400000
-                left = shape.left + shape.width + 200000
-                top = shape.top + (shape.height - qr_height) / 2
-                slide.shapes.add_picture(
-                    image_stream,
-                    left,
-                    top,
-                    width=qr_width,
-                    height=qr_height
-                )
-
-        # Работаем с таблицами
-        tables_found = False
-        for shape in slide.shapes:
-            if shape.has_table:
-                tables_found = True
-                table = shape.table
-                print(f"Найдена таблица: {len(table.rows)} строк, {len(table.columns)} столбцов")
-                
-                # Проверяем первую ячейку таблицы, чтобы определить тип таблицы
-                table_header = table.cell(0, 0).text.strip()
-                print(f"Заголовок таблицы: '{table_header}'")
-
-                # Если это таблица с номером отливки
-                if "Номер" in table_header:
-                    print("Обрабатываем таблицу с номером отливки")
-                    try:
-                        # Заполняем данные отливки с маленьким жирным шрифтом
-                        for col in range(3):
-                            cell = table.cell(1, col)
-                            paragraph = cell.text_frame.paragraphs[0]
-                            run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                            if col == 0:
-                                run.text = data['cast_number']
-                            elif col == 1:
-                                run.text = data['cast_name']
-                            else:
-                                run.text = data['cluster_number']
-                            run.font.size = Pt(9)
-                            run.font.bold = True  # Делаем шрифт жирным
-                    except Exception as e:
-                        print(f"Ошибка при заполнении данных отливки: {str(e)}")
-                    continue  # Переходим к следующей таблице
-
-                # Если это таблица операций
-                try:
-                    # Сначала найдем индексы нужных столбцов
-                    column_indices = {}
-                    print("\nЗаголовки столбцов:")
-                    for col in range(len(table.columns)):
-                        header = table.cell(0, col).text.strip()
-                        print(f"Столбец {col}: '{header}'")
-                        if header == "Дата":
-                            column_indices['date'] = col
-                        elif header == "Время":
-                            column_indices['time'] = col
-                        elif header == "Исполнитель":
-                            column_indices['executor'] = col
-                        elif header == "Количество":
-                            column_indices['quantity'] = col
-                        elif header == "Примечание":
-                            column_indices['notes'] = col
-                    
-                    print("\nНайденные индексы столбцов:", column_indices)
-
-                    # Теперь найдем строки операций и заполним данные
-                    print("\nСодержимое первого столбца:")
-                    for row in range(len(table.rows)):
-                        try:
-                            operation = table.cell(row, 0).text.strip()
-                            print(f"Строка {row}: '{operation}'")
-                            
-                            # Заполняем данные для Склейки
-                            if "Склейка элементов п/м" in operation:
-                                print("Найдена строка Склейки")
-                                for col_name, col_idx in column_indices.items():
-                                    cell = table.cell(row, col_idx)
-                                    paragraph = cell.text_frame.paragraphs[0]
-                                    run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                                    if col_name == 'date':
-                                        run.text = data['gluing_date']
-                                    elif col_name == 'executor':
-                                        run.text = data['gluing_executor']
-                                    elif col_name == 'quantity':
-                                        run.text = data['gluing_quantity']
-                                    elif col_name == 'notes':
-                                        run.text = data['gluing_notes']
-                                    run.font.size = Pt(9)
-                                    run.font.bold = True  # Делаем шрифт жирным
-                            
-                            # Заполняем данные для Контроля
-                            if "Контроль сборки кластера" in operation:
-                                print("Найдена строка Контроля")
-                                for col_name, col_idx in column_indices.items():
-                                    cell = table.cell(row, col_idx)
-                                    paragraph = cell.text_frame.paragraphs[0]
-                                    run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                                    if col_name == 'date':
-                                        run.text = data['control_date']
-                                    elif col_name == 'executor':
-                                        run.text = data['control_executor']
-                                    elif col_name == 'quantity':
-                                        run.text = data['control_quantity']
-                                    elif col_name == 'notes':
-                                        run.text = data['control_notes']
-                                    run.font.size = Pt(9)
-                                    run.font.bold = True  # Делаем шрифт жирным
-                                
-                                # Для времени контроля
-                                for r in range(len(table.rows)):
-                                    for c in range(len(table.columns)):
-                                        if table.cell(r, c).text.strip() == "Время:":
-                                            cell = table.cell(r, c + 1)
-                                            paragraph = cell.text_frame.paragraphs[0]
-                                            run = paragraph.runs[0] if paragraph.runs else paragraph.add_run()
-                                            run.text = data['control_time']
-                                            run.font.size = Pt(9)
-                                            run.font.bold = True  # Делаем шрифт жирным
-
-                        except Exception as e:
-                            print(f"Ошибка при обработке строки {row}: {str(e)}")
-                            
-                except Exception as e:
-                    print(f"Ошибка при обработке таблицы: {str(e)}")
-        
-        if not tables_found:
-            print("На слайде не найдено ни одной таблицы!")
-
-        # Формируем имя выходного файла, заменяя недопустимые символы
-        cluster_number = data['cluster_number'].replace('/', '_').replace('\\', '_')
-        output_path = f"маршрутная_карта_{cluster_number}.pptx"
-        counter = 1
-        while os.path.exists(output_path):
-            output_path = f"маршрутная_карта_{cluster_number}_{counter}.pptx"
-            counter += 1
-
-        # Сохраняем результат
-        prs.save(output_path)
-        
-        # Возвращаем путь к сохраненному файлу
-        return output_path
+            QMessageBox.warning(self, "Предупреждение", f"Ошибка поиска по истории: {str(e)}")
+            return
+
+        self.history_rows = rows
+        self.history_table.setRowCount(len(rows))
+        for row_index, row in enumerate(rows):
+            for col_index, (key, _) in enumerate(HISTORY_TABLE_COLUMNS):
+                self.history_table.setItem(row_index, col_index, QTableWidgetItem(row.get(key) or ''))
+        self.history_next_btn.setEnabled(self.history_after is not None)
+
+    def reprint_selected(self):
+        """Заново создает и печатает выбранную в истории карту"""
+        row_index = self.history_table.currentRow()
+        if row_index < 0 or row_index >= len(self.history_rows):
+            QMessageBox.warning(self, "Предупреждение", "Выберите карту в списке")
+            return
+        data = dict(self.history_rows[row_index])
+        data['family'] = self.cast_family(data.get('cast_number'))
+        # Карта создается в очереди генерации, как новая, но без записи в историю;
+        # готовая карта печатается обработчиком on_generation_finished
+        self.generation.submit(data, self.templates.template_for(data['family']),
+                               render=self.generate_pptx_with_data, save=lambda data: None)
 
     def show(self):
         self.setWindowOpacity(1.0)  # Устанавливаем непрозрачность сразу
@@ -512,54 +781,64 @@ class MainWindow(QMainWindow):
     def load_reference_data(self):
         """Загрузка справочных данных из базы"""
         try:
-            # Загружаем данные отливок
-            self.db_cursor.execute('SELECT "Номер", "Наименование" FROM "ЛГМ_Отливки"')
-            lgm_casts = self.db_cursor.fetchall()
-            self.db_cursor.execute('SELECT "Номер", "Наименование" FROM "ЛПД_Отливки"')
-            lpd_casts = self.db_cursor.fetchall()
-            self.db_cursor.execute('SELECT "Наименование" FROM "Прочие_Отливки"')
-            other_casts = self.db_cursor.fetchall()
-
-            # Заполняем выпадающие списки номеров и наименований отливок
-            self.cast_numbers_data = {}  # Словарь для хранения соответствия номер-наименование
-            
-            # Очищаем списки перед заполнением
-            self.fields['cast_number'].clear()
-            self.fields['cast_name'].clear()
-            
-            # Добавляем ЛГМ и ЛПД отливки
-            for number, name in lgm_casts + lpd_casts:
-                self.fields['cast_number'].addItem(number)
-                self.fields['cast_name'].addItem(name)
-                self.cast_numbers_data[number] = name
-            
-            # Добавляем прочие отливки
-            for (name,) in other_casts:
-                self.fields['cast_number'].addItem(name)
-                self.fields['cast_name'].addItem(name)
-                self.cast_numbers_data[name] = name
-
-            # Загружаем сборщиков
-            self.db_cursor.execute('SELECT "ФИО" FROM "Сборщики"')
-            assemblers = [row[0] for row in self.db_cursor.fetchall()]
-            self.fields['gluing_executor'].addItems(assemblers)
-
-            # Загружаем контролеров сборки
-            self.db_cursor.execute('SELECT "ФИО" FROM "Контролеры_Сборки"')
-            controllers = [row[0] for row in self.db_cursor.fetchall()]
-            self.fields['control_executor'].addItems(controllers)
+            self.apply_reference_snapshot(self.reference.snapshot())
+        except Exception as e:
+            logger.error("Ошибка при загрузке справочных данных: %s", e)
 
+    def refresh_reference_data(self):
+        """Перезаполняет списки, только если справочник изменился"""
+        try:
+            if self.reference.refresh():
+                self.apply_reference_snapshot(self.reference.snapshot())
         except Exception as e:
-            print(f"Ошибка при загрузке справочных данных: {e}")
+            logger.error("Ошибка при обновлении справочных данных: %s", e)
+
+    def apply_reference_snapshot(self, snapshot):
+        """Заполняет выпадающие списки из снимка справочника, сохраняя выбор"""
+        combos = ('cast_number', 'cast_name', 'gluing_executor', 'control_executor')
+        selected = {key: self.fields[key].currentText() for key in combos}
+
+        # Индекс поиска и соответствие номер-наименование
+        self.cast_index = CastIndex(snapshot.casts)
+
+        # Очищаем списки перед заполнением
+        for key in combos:
+            self.fields[key].clear()
+
+        # Отливки ЛГМ, ЛПД и прочие
+        for number, name in snapshot.casts:
+            self.fields['cast_number'].addItem(number)
+            self.fields['cast_name'].addItem(name)
+
+        self.fields['gluing_executor'].addItems(list(snapshot.assemblers))
+        self.fields['control_executor'].addItems(list(snapshot.controllers))
+
+        # Возвращаем выбор пользователя, если значение осталось в справочнике
+        for key, text in selected.items():
+            index = self.fields[key].findText(text) if text else -1
+            if index >= 0:
+                self.fields[key].setCurrentIndex(index)
 
     def update_cast_name(self, index):
         """Обновляет поле наименования при выборе номера отливки"""
-        current_number = self.fields['cast_number'].currentText()
-        if current_number in self.cast_numbers_data:
-            name = self.cast_numbers_data[current_number]
-            index = self.fields['cast_name'].findText(name)
-            if index >= 0:
-                self.fields['cast_name'].setCurrentIndex(index)
+        # Списки номеров и наименований заполняются параллельно, поэтому
+        # позиция номера в справочнике совпадает с позицией его наименования
+        position = self.cast_index.position_for(self.fields['cast_number'].currentText())
+        if position >= 0:
+            self.fields['cast_name'].setCurrentIndex(position)
+
+    def update_cast_suggestions(self, text):
+        """Обновляет подсказки поиска отливки при вводе"""
+        matches = self.cast_index.search(text, CAST_SUGGESTIONS)
+        self.cast_suggestions = {f"{number} — {name}" if number != name else number: number
+                                 for number, name in matches}
+        self.cast_completer_model.setStringList(list(self.cast_suggestions))
+
+    def select_suggested_cast(self, text):
+        """Выбирает отливку из подсказки поиска"""
+        position = self.cast_index.position_for(self.cast_suggestions.get(text))
+        if position >= 0:
+            self.fields['cast_number'].setCurrentIndex(position)
 
     def generate_cluster_number(self):
         """Генерирует и устанавливает номер кластера на основе даты склейки"""
@@ -567,8 +846,20 @@ class MainWindow(QMainWindow):
             # Получаем дату склейки
             gluing_date = self.fields['gluing_date'].date().toString("dd.MM.yyyy")
             
-            # Генерируем следующий номер кластера
-            next_number = get_next_cluster_number(gluing_date)
+            # Следующий номер только показывается: занимает его запись карты в историю,
+            # поэтому повторные нажатия и несохраненные карты не оставляют пропусков
+            if self.service:
+                next_number = self.service.peek_cluster_number(gluing_date)
+            else:
+                next_number = peek_next_cluster_number(gluing_date)
+            # Карты в очереди еще не записаны в историю, их номера не предлагаем повторно
+            pending = [data['cluster_number'] for data in self.submitted_forms.values()
+                       if data['cluster_number'][:7] == next_number[:7]]
+            if pending and max(pending) >= next_number:
+                last_number = int(max(pending)[7:])
+                if last_number >= MAX_CLUSTERS_PER_MONTH:
+                    raise ValueError("Превышено максимальное количество кластеров для этого месяца (999)")
+                next_number = f"{next_number[:7]}{last_number + 1:03d}"
             
             # Устанавливаем номер в поле
             self.fields['cluster_number'].setText(next_number)
@@ -579,16 +870,66 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         """Закрываем соединение с базой при закрытии приложения"""
         try:
-            if hasattr(self, 'db_conn'):
-                self.db_conn.close()
+            if hasattr(self, 'generation'):
+                # Поставленные карты уже введены оператором, дожидаемся их
+                if not self.generation.wait(GENERATION_SHUTDOWN_TIMEOUT * 1000):
+                    logger.warning("Не все карты из очереди успели создаться")
+                # Готовые карты отправляются на печать до остановки очереди печати
+                QApplication.processEvents()
+            if getattr(self, 'probe', None) is not None:
+                stats = self.probe.stats()
+                logger.info("Отзывчивость окна: медиана %.1f мс, p99 %.1f мс, максимум %.1f мс",
+                            stats['median_ms'], stats['p99_ms'], stats['max_ms'])
+            if hasattr(self, 'reference'):
+                self.reference.close()
+            if hasattr(self, 'spooler'):
+                self.spooler.shutdown(timeout=PRINT_SHUTDOWN_TIMEOUT)
+            if hasattr(self, 'metrics_timer'):
+                self.export_metrics()
+            get_repository().close()
         except Exception as e:
-            print(f"Ошибка при закрытии соединения с БД: {e}")
+            logger.error("Ошибка при закрытии соединения с БД: %s", e)
         event.accept()
 
 def main():
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Генератор маршрутных карт")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Вывести время этапов запуска и закрыть окно после прогрева")
+    parser.add_argument('--startup-budget', type=float, default=None,
+                        help="Допустимое время до первой отрисовки окна, мс (с --profile-startup)")
+    args, qt_args = parser.parse_known_args()
+    configure_logging()
+
+    profile = StartupProfile(_import_started)
+    profile.mark("Импорт Qt", _qt_imported)
+    profile.mark("Импорт модулей приложения", _modules_imported)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    profile.mark("Создание QApplication")
     window = MainWindow()
+    profile.mark("Создание окна и справочника")
     window.show()
+    profile.mark("Показ окна")
+
+    def first_paint():
+        profile.mark("Первая отрисовка")
+        # Шаблон и QR-коды готовятся в фоне, когда окно уже на экране
+        window.generation.warm_up(window.templates.paths())
+
+    def warmed_up(seconds):
+        profile.mark("Прогрев шаблона и QR (в фоне)")
+        if not args.profile_startup:
+            return
+        print(profile.report())
+        first_paint_ms = profile.elapsed("Первая отрисовка") * 1000
+        if args.startup_budget is not None and first_paint_ms > args.startup_budget:
+            print(f"Превышен бюджет запуска: {first_paint_ms:.0f} мс > {args.startup_budget:.0f} мс")
+            app.exit(1)
+        else:
+            app.exit(0)
+
+    window.generation.signals.warmed_up.connect(warmed_up)
+    QTimer.singleShot(0, first_paint)
     sys.exit(app.exec())
 
 if __name__ == "__main__":
@@ -1,25 +1,15 @@
 from PIL import Image
-import qrcode
 import os
+from qr_service import module_size_for, qr_image
 
 def generate_form_with_qr(template_path, output_path, qr_data):
     # Открываем шаблон
     template = Image.open(template_path)
     
-    # Создаем QR-код
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=1,  # Еще немного уменьшаем отступы
-    )
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    qr_image = qr.make_image(fill_color="black", back_color="white")
-    
-    # Уменьшаем размер QR-кода до 50 пикселей
+    # Создаем QR-код не больше 50 пикселей сразу в итоговом размере модуля
     qr_size = 50
-    qr_image = qr_image.resize((qr_size, qr_size))
+    qr = qr_image(qr_data, box_size=module_size_for(qr_data, qr_size))
+    qr_size = qr.width
     
     # Вычисляем позицию для QR-кода в правом верхнем углу
     # Оставляем отступ в 20 пикселей от правого края и 10 пикселей сверху
@@ -32,13 +22,26 @@ def generate_form_with_qr(template_path, output_path, qr_data):
     result = template.copy()
     
     # Вставляем QR-код
-    result.paste(qr_image, (x_position, y_position))
+    result.paste(qr, (x_position, y_position))
     
     # Сохраняем результат
     result.save(output_path)
 
+def prepare_template_image(template_path):
+    # Картинки шаблона нет в поставке: рисуем ее один раз из шаблона презентации
+    if not os.path.exists(template_path):
+        from card_export import get_rasterizer
+        from template_registry import get_registry
+        get_rasterizer(get_registry().template_for()).background.save(template_path)
+    return template_path
+
 def main():
     template_path = "ШАБЛОН.png"
+    try:
+        prepare_template_image(template_path)
+    except Exception as e:
+        print(f"Не удалось подготовить шаблон {template_path}: {str(e)}")
+        return
     
     while True:
         # Получаем данные от пользователя
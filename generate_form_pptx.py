@@ -1,27 +1,15 @@
 from pptx import Presentation
-import qrcode
 import os
 from io import BytesIO
+from qr_service import qr_png
+from template_registry import get_registry
 
 def generate_form_with_qr(template_path, output_path, qr_data):
     # Открываем шаблон презентации
     prs = Presentation(template_path)
     
-    # Создаем QR-код
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=1,
-    )
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    qr_image = qr.make_image(fill_color="black", back_color="white")
-    
-    # Сохраняем QR-код во временный буфер
-    image_stream = BytesIO()
-    qr_image.save(image_stream, format='PNG')
-    image_stream.seek(0)
+    # Создаем QR-код (PNG берется из общего кэша)
+    image_stream = BytesIO(qr_png(qr_data))
     
     # Добавляем QR-код на первый слайд
     slide = prs.slides[0]
@@ -72,7 +60,8 @@ def generate_form_with_qr(template_path, output_path, qr_data):
     prs.save(output_path)
 
 def main():
-    template_path = "ШАБЛОН.pptx"
+    # Общий шаблон из каталога шаблонов (или ШАБЛОН.pptx рядом с программой)
+    template_path = get_registry().template_for()
     
     while True:
         print("\nГенератор QR-кодов для презентаций")
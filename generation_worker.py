@@ -0,0 +1,250 @@
+import itertools
+import logging
+import threading
+import time
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
+
+from instrumentation import STAGE_CARD, METRICS
+
+logger = logging.getLogger(__name__)
+
+# Этапы генерации карты: этап -> (процент готовности, описание)
+STAGE_RENDER = 'render'
+STAGE_SAVE = 'save'
+STAGES = {
+    STAGE_RENDER: (10, "Заполнение шаблона"),
+    STAGE_SAVE: (80, "Сохранение в историю"),
+}
+
+# Номер кластера для прогрева генератора QR-кодов
+WARM_UP_QR_PAYLOAD = 'К00/00-000'
+
+# Период проверки отзывчивости окна (мс)
+PROBE_INTERVAL = 20
+
+_generation_ids = itertools.count(1)
+
+
+class GenerationSignals(QObject):
+    """
+    Сигналы очереди генерации. Объект живет в потоке GUI, поэтому сигналы,
+    отправленные из потоков пула, доставляются в поток GUI через очередь событий.
+    """
+    # номер задания, процент, описание этапа
+    progress = Signal(int, int, str)
+    # номер задания, путь к файлу, данные формы
+    finished = Signal(int, str, object)
+    # номер задания, сообщение, True - ошибка проверки данных (ValueError)
+    failed = Signal(int, str, bool)
+    cancelled = Signal(int)
+    # шаблон и QR-коды подготовлены; время прогрева, с
+    warmed_up = Signal(float)
+    # количество незавершенных заданий
+    pending_changed = Signal(int)
+
+
+class GenerationTask(QRunnable):
+    """
+    Создание одной карты: заполнение шаблона и запись в историю.
+    render_saves - render сам записывает карту в историю (служба рендеринга),
+    после него задание уже не отменить.
+    """
+
+    def __init__(self, job_id, template_path, data, signals, render, save, render_saves=False):
+        super().__init__()
+        # Задание удаляется вместе с очередью, а не пулом потоков
+        self.setAutoDelete(False)
+        self.job_id = job_id
+        self.template_path = template_path
+        self.data = data
+        self.signals = signals
+        self.render = render
+        self.save = save
+        self.render_saves = render_saves
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Отменяет задание до начала следующего этапа"""
+        self._cancel.set()
+
+    def _stage(self, stage):
+        if self._cancel.is_set():
+            return False
+        percent, text = STAGES[stage]
+        self.signals.progress.emit(self.job_id, percent, text)
+        return True
+
+    def run(self):
+        try:
+            # Модули рендеринга и истории загружаются в потоке пула при первой
+            # карте (или при прогреве), а не при запуске окна
+            render, save = self.render, self.save
+            if render is None:
+                from card_engine import render_card as render
+            if save is None:
+                from create_history_db import save_form_data as save
+            started = time.perf_counter()
+            if not self._stage(STAGE_RENDER):
+                self.signals.cancelled.emit(self.job_id)
+                return
+            output_path = render(self.template_path, self.data)
+            # Отмена после заполнения шаблона еще не дает записи в истории.
+            # Файл карты не удаляем: он лежит в общем хранилище карт, на него
+            # могут ссылаться другие карты и очередь печати (его удалит вытеснение)
+            if not self.render_saves and not self._stage(STAGE_SAVE):
+                self.signals.cancelled.emit(self.job_id)
+                return
+            if self.render_saves:
+                self.signals.progress.emit(self.job_id, *STAGES[STAGE_SAVE])
+            save(self.data)
+            METRICS.observe(STAGE_CARD, time.perf_counter() - started)
+            self.signals.progress.emit(self.job_id, 100, "Готово")
+            self.signals.finished.emit(self.job_id, output_path, self.data)
+        except ValueError as e:
+            self.signals.failed.emit(self.job_id, str(e), True)
+        except Exception as e:
+            logger.exception("Ошибка при создании карты %s", self.data.get('cluster_number'))
+            self.signals.failed.emit(self.job_id, f"Неожиданная ошибка: {e}", False)
+
+
+class WarmUpTask(QRunnable):
+    """Загрузка шаблонов и библиотек рендеринга до первой карты"""
+
+    def __init__(self, template_paths, signals):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.template_paths = template_paths
+        self.signals = signals
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            import card_engine
+            import qr_service
+            # Снимок шаблона хранится по потокам, поэтому прогрев идет
+            # в том же потоке пула, где затем создаются карты
+            for template_path in self.template_paths:
+                card_engine.get_snapshot(template_path)
+            qr_service.qr_png(WARM_UP_QR_PAYLOAD)
+        except Exception as e:
+            # Ошибка повторится и будет показана при создании карты
+            logger.warning("Ошибка при подготовке шаблона: %s", e)
+        self.signals.warmed_up.emit(time.perf_counter() - started)
+
+
+class GenerationQueue(QObject):
+    """
+    Очередь генерации карт в пуле потоков. По умолчанию карты создаются
+    по одной в порядке постановки, чтобы номера в истории шли так же,
+    как их вводил оператор; окно при этом не ждет завершения.
+    render_saves - render сам записывает карту в историю (см. GenerationTask).
+    """
+
+    def __init__(self, template_path, render=None, save=None, max_threads=1, render_saves=False, parent=None):
+        super().__init__(parent)
+        self.template_path = template_path
+        self.render = render
+        self.save = save
+        self.render_saves = render_saves
+        self.signals = GenerationSignals(self)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        # Поток пула не завершается при простое и сохраняет подготовленный шаблон
+        self.pool.setExpiryTimeout(-1)
+        self.tasks = {}
+        self._warm_up = None
+        self.signals.finished.connect(lambda job_id, output_path, data: self._forget(job_id))
+        self.signals.failed.connect(lambda job_id, message, is_warning: self._forget(job_id))
+        self.signals.cancelled.connect(self._forget)
+
+    def warm_up(self, template_paths=None):
+        """Готовит шаблоны и генератор QR-кодов в потоке пула, не задерживая окно"""
+        self._warm_up = WarmUpTask(template_paths or [self.template_path], self.signals)
+        self.pool.start(self._warm_up)
+
+    def submit(self, data, template_path=None, render=None, save=None):
+        """
+        Ставит карту в очередь и сразу возвращает номер задания;
+        без template_path карта создается по шаблону очереди. render и save
+        заменяют функции очереди для этого задания (например, повторная
+        печать без записи в историю).
+        """
+        job_id = next(_generation_ids)
+        # Своя функция render записывает историю только через save
+        render_saves = self.render_saves if render is None else False
+        task = GenerationTask(job_id, template_path or self.template_path, dict(data), self.signals,
+                              render or self.render, save or self.save, render_saves)
+        self.tasks[job_id] = task
+        self.pool.start(task)
+        self.signals.pending_changed.emit(len(self.tasks))
+        return job_id
+
+    def pending(self):
+        """Количество незавершенных заданий"""
+        return len(self.tasks)
+
+    def cancel(self, job_id):
+        """
+        Отменяет задание: еще не начатое снимается с очереди сразу,
+        выполняющееся останавливается перед следующим этапом
+        """
+        task = self.tasks.get(job_id)
+        if task is None:
+            return
+        task.cancel()
+        if self.pool.tryTake(task):
+            self.signals.cancelled.emit(job_id)
+
+    def cancel_all(self):
+        for job_id in list(self.tasks):
+            self.cancel(job_id)
+
+    def wait(self, msecs=-1):
+        """Ждет завершения всех заданий; True, если дождались"""
+        return self.pool.waitForDone(msecs)
+
+    def _forget(self, job_id):
+        if self.tasks.pop(job_id, None) is not None:
+            self.signals.pending_changed.emit(len(self.tasks))
+
+
+class ResponsivenessProbe(QObject):
+    """
+    Замер отзывчивости окна: таймер в потоке GUI срабатывает каждые
+    interval мс, а опоздание срабатывания показывает, сколько цикл событий
+    был занят. Большие опоздания - это подвисания окна.
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.interval = interval
+        self.delays = []
+        self._last = None
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._tick)
+
+    def start(self):
+        self.delays = []
+        self._last = time.perf_counter()
+        self._timer.start(self.interval)
+
+    def stop(self):
+        self._timer.stop()
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.delays.append(max(0.0, (now - self._last) * 1000 - self.interval))
+        self._last = now
+
+    def stats(self):
+        """Опоздания таймера, мс: медиана, p99 и максимум"""
+        delays = sorted(self.delays)
+        if not delays:
+            return {'ticks': 0, 'median_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+        return {
+            'ticks': len(delays),
+            'median_ms': delays[len(delays) // 2],
+            'p99_ms': delays[min(len(delays) - 1, int(len(delays) * 0.99))],
+            'max_ms': delays[-1],
+        }
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Уровень и файл журнала можно задать переменными окружения
+LOG_LEVEL = os.environ.get('FORMBUILDER_LOG_LEVEL', 'INFO')
+LOG_FILE = os.environ.get('FORMBUILDER_LOG_FILE')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Файлы выгрузки метрик: JSON и текстовый формат Prometheus
+METRICS_JSON_PATH = os.environ.get('FORMBUILDER_METRICS_JSON', 'метрики.json')
+METRICS_PROMETHEUS_PATH = os.environ.get('FORMBUILDER_METRICS_PROM', 'метрики.prom')
+
+# Этапы создания карты
+STAGE_TEMPLATE_LOAD = 'template_load'
+STAGE_QR_ENCODE = 'qr_encode'
+STAGE_TABLE_FILL = 'table_fill'
+STAGE_SAVE = 'save'
+STAGE_DB_INSERT = 'db_insert'
+STAGE_PRINT_SUBMIT = 'print_submit'
+STAGE_CARD = 'card'
+STAGE_TITLES = {
+    STAGE_TEMPLATE_LOAD: "Загрузка шаблона",
+    STAGE_QR_ENCODE: "Создание QR-кода",
+    STAGE_TABLE_FILL: "Заполнение таблиц",
+    STAGE_SAVE: "Сохранение файла",
+    STAGE_DB_INSERT: "Запись в историю",
+    STAGE_PRINT_SUBMIT: "Отправка на печать",
+    STAGE_CARD: "Карта целиком",
+}
+
+# Верхние границы корзин гистограммы, с
+HISTOGRAM_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+PROMETHEUS_METRIC = 'formbuilder_stage_duration_seconds'
+
+
+def configure_logging(level=None, log_file=None):
+    """Настраивает журнал приложения: уровень и, при необходимости, файл"""
+    level = (level or LOG_LEVEL).upper()
+    handlers = [logging.StreamHandler()]
+    log_file = log_file or LOG_FILE
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    logging.basicConfig(level=getattr(logging, level, logging.INFO), format=LOG_FORMAT,
+                        handlers=handlers, force=True)
+
+
+class Histogram:
+    """Гистограмма длительностей одного этапа"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(HISTOGRAM_BUCKETS) and seconds > HISTOGRAM_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, data):
+        for index, value in enumerate(data['buckets']):
+            self.buckets[index] += value
+        self.count += data['count']
+        self.sum += data['sum']
+        self.max = max(self.max, data['max'])
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (линейно внутри корзины), с"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for index, value in enumerate(self.buckets):
+            upper = HISTOGRAM_BUCKETS[index] if index < len(HISTOGRAM_BUCKETS) else self.max
+            if value and seen + value >= rank:
+                return min(self.max, lower + (upper - lower) * (rank - seen) / value)
+            seen += value
+            lower = upper
+        return self.max
+
+    def to_dict(self):
+        return {
+            'buckets': list(self.buckets),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MetricsCollector:
+    """
+    Гистограммы длительностей этапов создания карты. Запись идет из любых
+    потоков; процессы пакетной генерации передают свои значения основному
+    процессу через drain() и merge().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Замеряет длительность блока with как этап stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Состояние гистограмм: этап -> словарь (см. Histogram.to_dict)"""
+        with self._lock:
+            return {stage: histogram.to_dict() for stage, histogram in self._histograms.items()}
+
+    def drain(self):
+        """Возвращает накопленные значения и очищает сборщик"""
+        with self._lock:
+            data = {stage: histogram.to_dict() for stage, histogram in self._histograms.items()}
+            self._histograms = {}
+        return data
+
+    def merge(self, data):
+        """Добавляет значения, полученные от drain() другого сборщика"""
+        with self._lock:
+            for stage, values in data.items():
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    histogram = self._histograms[stage] = Histogram()
+                histogram.merge(values)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def to_prometheus(self):
+        """Гистограммы в текстовом формате Prometheus"""
+        lines = [f'# HELP {PROMETHEUS_METRIC} Duration of route card pipeline stages',
+                 f'# TYPE {PROMETHEUS_METRIC} histogram']
+        for stage, data in sorted(self.snapshot().items()):
+            cumulative = 0
+            for index, value in enumerate(data['buckets']):
+                cumulative += value
+                bound = repr(HISTOGRAM_BUCKETS[index]) if index < len(HISTOGRAM_BUCKETS) else '+Inf'
+                lines.append(f'{PROMETHEUS_METRIC}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PROMETHEUS_METRIC}_sum{{stage="{stage}"}} {data["sum"]!r}')
+            lines.append(f'{PROMETHEUS_METRIC}_count{{stage="{stage}"}} {data["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Записывает метрики в файл: .prom - формат Prometheus, иначе JSON"""
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps({'buckets': HISTOGRAM_BUCKETS, 'stages': self.snapshot()},
+                                 ensure_ascii=False, indent=2)
+        # Запись через временный файл, чтобы сборщик метрик не прочитал половину
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return path
+
+
+# Общий сборщик метрик процесса
+METRICS = MetricsCollector()
+
+
+def timed(stage):
+    """Контекстный менеджер замера этапа в общем сборщике"""
+    return METRICS.timer(stage)
@@ -0,0 +1,40 @@
+import argparse
+import sqlite3
+import sys
+import time
+
+from create_history_db import (DEFAULT_DB_PATH, HISTORY_SCHEMA_VERSION, MIGRATION_CHUNK_SIZE,
+                               migrate_iso_dates)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Перевод базы истории форм на хранение дат в формате ISO-8601")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="Путь к базе истории")
+    parser.add_argument('--chunk-size', type=int, default=MIGRATION_CHUNK_SIZE,
+                        help="Количество строк в одной транзакции заполнения")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        conn.execute('PRAGMA busy_timeout = 30000')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        print(f"Версия схемы: {version}, целевая: {HISTORY_SCHEMA_VERSION}")
+
+        def progress(done, total):
+            print(f"\rОбработано записей до ИД {done} из {total}", end='', flush=True)
+
+        started = time.perf_counter()
+        updated = migrate_iso_dates(conn, args.chunk_size, progress)
+        print()
+        print(f"Обновлено строк: {updated} за {time.perf_counter() - started:.1f} с")
+    except sqlite3.Error as e:
+        print(f"Ошибка миграции базы данных: {e}")
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import card_engine
+
+logger = logging.getLogger(__name__)
+
+# Каталог хранилища готовых карт и его предельный объем
+OUTPUT_DIR = os.environ.get('FORMBUILDER_OUTPUT_DIR', 'карты')
+OUTPUT_LIMIT_MB = int(os.environ.get('FORMBUILDER_OUTPUT_LIMIT_MB', '1024'))
+
+# При переполнении старые карты удаляются, пока объем не станет меньше этой доли предела
+EVICT_TARGET = 0.9
+
+# Каталог для карт без даты склейки и контроля
+UNDATED_SHARD = 'без_даты'
+
+_store = None
+_store_lock = threading.Lock()
+# Сколько файлов store_file с каталогом output_dir вернул готовыми, без записи
+_directory_hits = 0
+
+
+def _shard(data):
+    # Карты раскладываются по каталогам год/месяц даты склейки (или контроля)
+    for field in ('gluing_date', 'control_date'):
+        try:
+            date = datetime.strptime(data.get(field) or '', '%d.%m.%Y')
+        except ValueError:
+            continue
+        return os.path.join(f'{date.year:04d}', f'{date.month:02d}')
+    return UNDATED_SHARD
+
+
+def _write_file(path, write):
+    # Запись через временный файл: другой поток или процесс не увидит половину карты
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class OutputStore:
+    """
+    Хранилище готовых карт по ключу содержимого (хэш шаблона и данных формы).
+    Имя файла вычисляется из ключа без перебора занятых имен, поэтому
+    повторная печать неизмененной карты сразу возвращает уже созданный файл.
+    Карты лежат в каталогах год/месяц; при превышении max_bytes удаляются
+    карты, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, root=OUTPUT_DIR, max_bytes=OUTPUT_LIMIT_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # путь -> [время последнего обращения, размер]; читается с диска при первом обращении
+        self._index = None
+        self._total = 0
+
+    def path_for(self, key, data, ext='.pptx'):
+        """Путь карты в хранилище"""
+        return card_engine.build_output_path(data['cluster_number'], os.path.join(self.root, _shard(data)),
+                                             ext, key)
+
+    def _load_index(self):
+        self._index = {}
+        self._total = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                self._index[path] = [stat.st_mtime, stat.st_size]
+                self._total += stat.st_size
+
+    def fetch(self, key, data, ext, write):
+        """
+        Возвращает путь к карте с ключом key; если карты еще нет,
+        создает ее вызовом write(f) с открытым на запись файлом
+        """
+        path = self.path_for(key, data, ext)
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+        if os.path.exists(path):
+            # Время изменения отмечает последнее обращение для вытеснения
+            now = time.time()
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+                if path in self._index:
+                    self._index[path][0] = now
+            logger.debug("Карта %s взята из хранилища", path)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_file(path, write)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.misses += 1
+            previous = self._index.get(path)
+            if previous:
+                self._total -= previous[1]
+            self._index[path] = [time.time(), size]
+            self._total += size
+            if self._total > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        # Удаляем карты, к которым дольше всего не обращались
+        target = self.max_bytes * EVICT_TARGET
+        removed = 0
+        for path, (_, size) in sorted(self._index.items(), key=lambda item: item[1][0]):
+            if self._total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Не удалось удалить карту %s из хранилища: %s", path, e)
+                continue
+            del self._index[path]
+            self._total -= size
+            removed += 1
+            # Пустой каталог месяца больше не нужен
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        logger.info("Из хранилища карт удалено файлов: %s, занято %.1f МБ", removed, self._total / 1024 / 1024)
+
+    def stats(self):
+        """Попадания, промахи и занятый объем"""
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            return {'hits': self.hits, 'misses': self.misses, 'files': len(self._index), 'bytes': self._total}
+
+
+def get_store():
+    """Общее хранилище карт процесса"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = OutputStore()
+        return _store
+
+
+def store_file(key, data, ext, write, output_dir=None):
+    """
+    Возвращает путь к файлу карты с ключом содержимого key. Без output_dir
+    файл берется из общего хранилища; с output_dir - кладется в этот каталог.
+    write(f) вызывается, только если такого файла еще нет.
+    """
+    global _directory_hits
+    if not output_dir:
+        return get_store().fetch(key, data, ext, write)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = card_engine.build_output_path(data['cluster_number'], output_dir, ext, key)
+    if os.path.exists(output_path):
+        with _store_lock:
+            _directory_hits += 1
+    else:
+        _write_file(output_path, write)
+    return output_path
+
+
+def directory_hits():
+    """Количество файлов, которые store_file взял готовыми из каталогов output_dir"""
+    with _store_lock:
+        return _directory_hits
+
+
+def write_card(template_path, data, ext, variant, write, output_dir=None):
+    """То же, что store_file, с ключом по шаблону и данным формы (см. card_engine.card_key)"""
+    return store_file(card_engine.card_key(template_path, data, variant), data, ext, write, output_dir)
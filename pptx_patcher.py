@@ -0,0 +1,412 @@
+import argparse
+import hashlib
+import os
+import re
+import struct
+import sys
+import zipfile
+import zlib
+from io import BytesIO
+
+from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+
+import card_engine
+from instrumentation import STAGE_QR_ENCODE, STAGE_SAVE, STAGE_TABLE_FILL, STAGE_TEMPLATE_LOAD, timed
+from qr_service import qr_png
+
+# Маркер места подстановки значения поля в XML слайда
+_SLOT_PATTERN = re.compile(r'@@FBX:(\w+)@@')
+
+# Управляющие символы экранируются так же, как в python-pptx ("_x0007_")
+_CTRL_CHARS = re.compile(r'([\x00-\x08\x0B-\x1F])')
+
+SLIDE_PART = 'ppt/slides/slide1.xml'
+SLIDE_RELS_PART = 'ppt/slides/_rels/slide1.xml.rels'
+PRESENTATION_PART = 'ppt/presentation.xml'
+PRESENTATION_RELS_PART = 'ppt/_rels/presentation.xml.rels'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+APP_PROPERTIES_PART = 'docProps/app.xml'
+
+# Количество карт в одном файле пакета по умолчанию
+DEFAULT_CARDS_PER_FILE = 100
+
+# Маркер контура векторного QR-кода (вставляется как XML, без экранирования)
+QR_PATH_SLOT = 'qr_path'
+
+# Кэш компиляций шаблонов: (путь, вывод QR-кода) -> SlidePatcher
+_patchers = {}
+
+
+def _slot(field):
+    return f'@@FBX:{field}@@'
+
+
+def _escape_text(text):
+    text = _CTRL_CHARS.sub(lambda m: "_x%04X_" % ord(m.group(1)), text)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _read_raw_entries(zip_bytes):
+    """Читает записи архива вместе с уже сжатыми данными, без распаковки"""
+    entries = []
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as zf:
+        for info in zf.infolist():
+            # Локальный заголовок: 30 байт + имя + дополнительное поле
+            offset = info.header_offset
+            name_len, extra_len = struct.unpack('<HH', zip_bytes[offset + 26:offset + 30])
+            start = offset + 30 + name_len + extra_len
+            entries.append({
+                'name': info.filename,
+                'method': info.compress_type,
+                'crc': info.CRC,
+                'size': info.file_size,
+                'data': zip_bytes[start:start + info.compress_size],
+                'date_time': info.date_time,
+            })
+    return entries
+
+
+def _entry_payload(entry):
+    """Распакованное содержимое записи архива"""
+    if entry['method'] == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(entry['data'], -15)
+    return entry['data']
+
+
+def _deflate_entry(name, payload, date_time, compress=True):
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        data = compressor.compress(payload) + compressor.flush()
+        method = zipfile.ZIP_DEFLATED
+    else:
+        data = payload
+        method = zipfile.ZIP_STORED
+    return {
+        'name': name,
+        'method': method,
+        'crc': zlib.crc32(payload),
+        'size': len(payload),
+        'data': data,
+        'date_time': date_time,
+    }
+
+
+def _write_zip(out, entries):
+    """Записывает архив из готовых (уже сжатых) записей"""
+    central = []
+    position = 0
+    # entries может быть генератором: записи пишутся по мере готовности
+    for entry in entries:
+        name = entry['name'].encode('utf-8')
+        flags = 0x800 if not entry['name'].isascii() else 0
+        year, month, day, hour, minute, second = entry['date_time']
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+        header = struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, flags, entry['method'],
+                             dos_time, dos_date, entry['crc'], len(entry['data']),
+                             entry['size'], len(name), 0)
+        out.write(header)
+        out.write(name)
+        out.write(entry['data'])
+        central.append(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, flags, entry['method'],
+                                   dos_time, dos_date, entry['crc'], len(entry['data']),
+                                   entry['size'], len(name), 0, 0, 0, 0, 0, position) + name)
+        position += len(header) + len(name) + len(entry['data'])
+
+    directory = b''.join(central)
+    out.write(directory)
+    out.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(central), len(central),
+                          len(directory), position, 0))
+
+
+class SlidePatcher:
+    """
+    Быстрый рендеринг карты без python-pptx на каждую карту.
+    При компиляции шаблон один раз заполняется через python-pptx маркерами
+    вместо значений; на каждую карту в XML слайда подставляются значения,
+    добавляется PNG (или контур векторного) QR-кода, а остальные записи
+    архива копируются в сжатом виде без повторной упаковки.
+    """
+
+    def __init__(self, template_bytes, qr_mode='raster', mapping=None):
+        snapshot = card_engine.TemplateSnapshot(template_bytes, mapping)
+        self.plan = snapshot.plan
+        self.qr_mode = qr_mode
+        self.version = None
+
+        # Заполняем шаблон маркерами полей тем же кодом, что и основной рендеринг
+        slots = {field: _slot(field) for field in card_engine.FORM_FIELDS + self.plan['fields']}
+        slide = snapshot.new_card()
+        template_rids = set(slide.part.rels.keys())
+        card_engine.fill_slide(slide, slots, self.plan, qr_mode)
+
+        # Определяем часть с картинкой QR-кода
+        self.image_part = None
+        for rel in slide.part.rels.values():
+            if rel.reltype == RT.IMAGE and rel.rId not in template_rids:
+                self.image_part = rel.target_part.partname.lstrip('/')
+
+        prototype = BytesIO()
+        snapshot.save(prototype)
+
+        self._entries = []
+        self._slide_segments = None
+        self._slide_index = self._image_index = None
+        for entry in _read_raw_entries(prototype.getvalue()):
+            if entry['name'] == SLIDE_PART:
+                self._slide_index = len(self._entries)
+                xml = zlib.decompress(entry['data'], -15).decode('utf-8')
+                if qr_mode == 'vector':
+                    # Контур векторного QR-кода тоже подставляется на каждую карту
+                    xml = xml.replace(card_engine.qr_path_xml(slots['cluster_number']), _slot(QR_PATH_SLOT))
+                # Чередование: статический текст, поле, статический текст...
+                self._slide_segments = _SLOT_PATTERN.split(xml)
+            elif entry['name'] == self.image_part:
+                self._image_index = len(self._entries)
+            self._entries.append(entry)
+
+        if self._slide_segments is None:
+            raise ValueError(f"В шаблоне нет части {SLIDE_PART}")
+        self._document_parts = None
+
+    def render_slide_xml(self, data):
+        """Собирает XML слайда с подставленными значениями полей"""
+        parts = self._slide_segments[:]
+        for i in range(1, len(parts), 2):
+            if parts[i] == QR_PATH_SLOT:
+                parts[i] = card_engine.qr_path_xml(data['cluster_number'])
+            else:
+                parts[i] = _escape_text(data.get(parts[i], ''))
+        return ''.join(parts).encode('utf-8')
+
+    def _card_entries(self, data, slide_name, image_name, date_time):
+        # Записи одной карты: XML слайда и PNG QR-кода (для растрового режима)
+        with timed(STAGE_TABLE_FILL):
+            entries = [_deflate_entry(slide_name, self.render_slide_xml(data), date_time)]
+        if image_name is not None:
+            with timed(STAGE_QR_ENCODE):
+                png = qr_png(data['cluster_number'])
+            # PNG уже сжат, поэтому храним его без повторного сжатия
+            entries.append(_deflate_entry(image_name, png, date_time, compress=False))
+        return entries
+
+    def _prepare_document(self):
+        # Части шаблона, которые меняются при добавлении слайдов, в распакованном виде
+        parts = {}
+        for entry in self._entries:
+            if entry['name'] in (SLIDE_RELS_PART, PRESENTATION_PART, PRESENTATION_RELS_PART,
+                                 CONTENT_TYPES_PART, APP_PROPERTIES_PART):
+                parts[entry['name']] = _entry_payload(entry).decode('utf-8')
+        missing = {SLIDE_RELS_PART, PRESENTATION_PART, PRESENTATION_RELS_PART, CONTENT_TYPES_PART} - set(parts)
+        if missing:
+            raise ValueError(f"В шаблоне нет частей {', '.join(sorted(missing))}")
+
+        # Связь презентации со слайдом и его запись в списке слайдов
+        rels = parts[PRESENTATION_RELS_PART]
+        match = re.search(r'<Relationship [^>]*Target="slides/slide1\.xml"[^>]*/>', rels)
+        slide_id = re.search(r'<p:sldId [^>]*/>', parts[PRESENTATION_PART])
+        override = re.search(r'<Override PartName="/%s"[^>]*/>' % re.escape(SLIDE_PART),
+                             parts[CONTENT_TYPES_PART])
+        if not match or not slide_id or not override:
+            raise ValueError("Не удалось найти слайд в структуре шаблона")
+        parts['slide_rel'] = re.sub(r'Id="[^"]*"', 'Id="{rid}"', match.group(0)).replace('slide1.xml', '{slide}')
+        parts['slide_id'] = slide_id.group(0)
+        parts['slide_override'] = override.group(0)
+        parts['slide_rel_source'] = match.group(0)
+        # Новые идентификаторы связей начинаются после уже занятых
+        parts['first_rid'] = max(int(n) for n in re.findall(r'Id="rId(\d+)"', rels)) + 1
+        self._document_parts = parts
+        return parts
+
+    def _document_entries(self, records):
+        parts = self._document_parts or self._prepare_document()
+        count = len(records)
+        first_rid = parts['first_rid']
+        slide_rels = parts[SLIDE_RELS_PART]
+        image_target = None
+        if self.image_part is not None:
+            image_target = '../media/' + self.image_part.rsplit('/', 1)[-1]
+
+        # Общие части шаблона пишутся один раз на файл
+        changed = {
+            PRESENTATION_RELS_PART: parts[PRESENTATION_RELS_PART].replace(parts['slide_rel_source'], ''.join(
+                parts['slide_rel'].format(rid=f'rId{first_rid + i}', slide=f'slide{i}.xml')
+                for i in range(1, count + 1))),
+            PRESENTATION_PART: parts[PRESENTATION_PART].replace(parts['slide_id'], ''.join(
+                f'<p:sldId id="{255 + i}" r:id="rId{first_rid + i}"/>' for i in range(1, count + 1))),
+            CONTENT_TYPES_PART: parts[CONTENT_TYPES_PART].replace(parts['slide_override'], ''.join(
+                parts['slide_override'].replace('slide1.xml', f'slide{i}.xml') for i in range(1, count + 1))),
+        }
+        if APP_PROPERTIES_PART in parts:
+            changed[APP_PROPERTIES_PART] = re.sub(r'<Slides>\d+</Slides>', f'<Slides>{count}</Slides>',
+                                                  parts[APP_PROPERTIES_PART])
+        per_card = (SLIDE_PART, SLIDE_RELS_PART, self.image_part)
+        date_time = self._entries[self._slide_index]['date_time']
+        for entry in self._entries:
+            if entry['name'] in per_card:
+                continue
+            if entry['name'] in changed:
+                yield _deflate_entry(entry['name'], changed[entry['name']].encode('utf-8'), entry['date_time'])
+            else:
+                yield entry
+
+        # На каждую карту: XML слайда, его связи и PNG QR-кода
+        for i, data in enumerate(records, 1):
+            image_name = None
+            rels = slide_rels
+            if self.image_part is not None:
+                image_name = f'ppt/media/fbx_qr{i}.png'
+                rels = slide_rels.replace(f'"{image_target}"', f'"../media/fbx_qr{i}.png"')
+            yield from self._card_entries(data, f'ppt/slides/slide{i}.xml', image_name, date_time)
+            yield _deflate_entry(f'ppt/slides/_rels/slide{i}.xml.rels', rels.encode('utf-8'), date_time)
+
+    def render_document(self, records, out):
+        """Записывает в поток out одну презентацию со слайдом на каждую карту"""
+        if not records:
+            raise ValueError("Нет карт для записи")
+        _write_zip(out, self._document_entries(records))
+
+    def render(self, data, out):
+        """Записывает карту в поток out"""
+        entries = self._entries[:]
+        slide_entry = entries[self._slide_index]
+        with timed(STAGE_TABLE_FILL):
+            entries[self._slide_index] = _deflate_entry(
+                SLIDE_PART, self.render_slide_xml(data), slide_entry['date_time'])
+        if self._image_index is not None:
+            image_entry = entries[self._image_index]
+            with timed(STAGE_QR_ENCODE):
+                png = qr_png(data['cluster_number'])
+            # PNG уже сжат, поэтому храним его без повторного сжатия
+            entries[self._image_index] = _deflate_entry(
+                image_entry['name'], png, image_entry['date_time'], compress=False)
+        with timed(STAGE_SAVE):
+            _write_zip(out, entries)
+
+
+def get_patcher(template_path, qr_mode='raster'):
+    """Возвращает скомпилированный патчер для шаблона"""
+    key = (template_path, qr_mode)
+    template_bytes, mapping, version = card_engine.template_entry(template_path)
+    patcher = _patchers.get(key)
+    # Шаблон мог измениться на диске: патчер старой версии компилируется заново
+    if patcher is None or patcher.version != version:
+        with timed(STAGE_TEMPLATE_LOAD):
+            patcher = _patchers[key] = SlidePatcher(template_bytes, qr_mode, mapping)
+        patcher.version = version
+    return patcher
+
+
+def render_card(template_path, data, output_dir=None, qr_mode='raster'):
+    """Создает маршрутную карту прямой правкой XML слайда и возвращает путь к файлу"""
+    from output_store import write_card
+    data = card_engine.normalize_form_data(data, card_engine.template_fields(template_path))
+    patcher = get_patcher(template_path, qr_mode)
+    # Ключ тот же, что у card_engine.render_card: карты обоих способов равнозначны
+    return write_card(template_path, data, '.pptx', qr_mode, lambda f: patcher.render(data, f), output_dir)
+
+
+def render_documents(template_path, records, output_dir=None, cards_per_file=DEFAULT_CARDS_PER_FILE,
+                     qr_mode='raster'):
+    """
+    Записывает карты пакетом: по cards_per_file слайдов в одной презентации.
+    Шаблон (мастер, макеты, тема) хранится в файле один раз, поэтому каждая
+    следующая карта добавляет только XML слайда и QR-код. Возвращает пути файлов.
+    """
+    if cards_per_file < 1:
+        raise ValueError("Количество карт в файле должно быть положительным")
+    fields = card_engine.template_fields(template_path)
+    records = [card_engine.normalize_form_data(record, fields) for record in records]
+    patcher = get_patcher(template_path, qr_mode)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    outputs = []
+    for start in range(0, len(records), cards_per_file):
+        chunk = records[start:start + cards_per_file]
+        name = chunk[0]['cluster_number']
+        if len(chunk) > 1:
+            name = f"{name}-{chunk[-1]['cluster_number']}"
+        key = hashlib.sha256(''.join(card_engine.card_key(template_path, data, qr_mode)
+                                     for data in chunk).encode('ascii')).hexdigest()
+        output_path = card_engine.build_output_path(name, output_dir, key=key)
+        with open(output_path, 'wb') as f:
+            with timed(STAGE_SAVE):
+                patcher.render_document(chunk, f)
+        outputs.append(output_path)
+    return outputs
+
+
+def _describe_cells(pptx_source):
+    # Текст и форматирование первого run каждой ячейки каждой таблицы
+    prs = Presentation(pptx_source)
+    cells = {}
+    pictures = []
+    for shape_index, shape in enumerate(prs.slides[0].shapes):
+        if shape.shape_type == MSO_SHAPE_TYPE.PICTURE:
+            pictures.append((shape.left, shape.top, shape.width, shape.height, shape.image.blob))
+        elif shape.shape_type == MSO_SHAPE_TYPE.FREEFORM:
+            pictures.append((shape.left, shape.top, shape.width, shape.height, shape._element.spPr.xml))
+        if not shape.has_table:
+            continue
+        table = shape.table
+        for r in range(len(table.rows)):
+            for c in range(len(table.columns)):
+                cell = table.cell(r, c)
+                runs = cell.text_frame.paragraphs[0].runs
+                font = (runs[0].font.size, runs[0].font.bold) if runs else None
+                cells[(shape_index, r, c)] = (cell.text, font)
+    return cells, pictures
+
+
+def check_parity(template_path, records, qr_mode='raster'):
+    """
+    Сравнивает карты обоих способов рендеринга ячейка за ячейкой.
+    Возвращает список расхождений (пустой, если результаты совпадают).
+    """
+    mismatches = []
+    patcher = get_patcher(template_path, qr_mode)
+    fields = card_engine.template_fields(template_path)
+    for record in records:
+        data = card_engine.normalize_form_data(record, fields)
+
+        expected = BytesIO()
+        snapshot = card_engine.get_snapshot(template_path)
+        card_engine.fill_slide(snapshot.new_card(), data, snapshot.plan, qr_mode)
+        snapshot.save(expected)
+
+        actual = BytesIO()
+        patcher.render(data, actual)
+
+        expected_cells, expected_pictures = _describe_cells(expected)
+        actual_cells, actual_pictures = _describe_cells(actual)
+        for key in sorted(set(expected_cells) | set(actual_cells)):
+            if expected_cells.get(key) != actual_cells.get(key):
+                mismatches.append(f"{data['cluster_number']}: ячейка {key}: "
+                                  f"{expected_cells.get(key)!r} != {actual_cells.get(key)!r}")
+        if expected_pictures != actual_pictures:
+            mismatches.append(f"{data['cluster_number']}: QR-код отличается")
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка совпадения быстрого рендеринга с python-pptx")
+    parser.add_argument('input', help="CSV или JSONL файл с записями форм")
+    parser.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    parser.add_argument('--qr', choices=card_engine.QR_MODES, default='raster',
+                        help="QR-код картинкой PNG (raster) или векторной фигурой (vector)")
+    args = parser.parse_args(argv)
+
+    from batch_generate import read_records
+    records = list(read_records(args.input))
+    mismatches = check_parity(args.template, records, args.qr)
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f"Проверено карт: {len(records)}, расхождений: {len(mismatches)}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
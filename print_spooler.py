@@ -0,0 +1,207 @@
+import itertools
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from instrumentation import STAGE_PRINT_SUBMIT, timed
+
+logger = logging.getLogger(__name__)
+
+# Команда печати для Linux/Mac; переменная окружения позволяет подставить
+# другую программу (например, заглушку lpr для проверки)
+LPR_COMMAND = os.environ.get('FORMBUILDER_LPR', 'lpr')
+
+# Состояния задания печати
+JOB_QUEUED = 'queued'
+JOB_PRINTING = 'printing'
+JOB_RETRYING = 'retrying'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Сколько ждать отправки процессом печати (с)
+PRINT_COMMAND_TIMEOUT = 60
+
+# Сколько завершенных заданий хранить для просмотра состояния
+FINISHED_JOBS_LIMIT = 500
+
+_job_ids = itertools.count(1)
+
+
+class PrintJob:
+    """Задание печати одного файла карты"""
+
+    def __init__(self, path, copies=1):
+        self.id = next(_job_ids)
+        self.path = path
+        self.copies = copies
+        self.status = JOB_QUEUED
+        self.attempts = 0
+        self.error = None
+        self.batch_size = 0
+        self.created = time.time()
+        self.finished = None
+
+    def __repr__(self):
+        return f"PrintJob({self.id}, {self.path!r}, {self.status})"
+
+
+def default_print_command(paths, printer=None, copies=1):
+    """Команда отправки набора файлов на печать одним заданием"""
+    if sys.platform == 'win32':
+        # Печать через связанное приложение; PowerPoint больше не закрывается
+        # принудительно, чтобы не потерять открытые оператором презентации.
+        # У -Verb Print нет числа копий: файл отправляется copies раз
+        script = '; '.join("Start-Process -FilePath '{}' -Verb Print -WindowStyle Hidden"
+                           .format(os.path.abspath(path).replace("'", "''"))
+                           for path in paths for _ in range(copies))
+        return ['powershell', '-NoProfile', '-Command', script]
+    command = [LPR_COMMAND]
+    if printer:
+        command += ['-P', printer]
+    if copies > 1:
+        command += ['-#', str(copies)]
+    return command + list(paths)
+
+
+class PrintSpooler:
+    """
+    Очередь печати с фоновым потоком.
+    Задания, поступившие в течение batch_window секунд, отправляются одной
+    командой (до max_batch файлов). При ошибке команда повторяется
+    max_retries раз с паузой retry_delay. С per_file (по умолчанию в Windows,
+    где команда - цепочка Start-Process и часть файлов могла уже уйти
+    на печать) каждый файл отправляется и повторяется отдельной командой.
+    Об изменении состояния задания сообщает on_update(job), вызываемый
+    из потока очереди.
+    """
+
+    def __init__(self, on_update=None, printer=None, command_factory=None,
+                 max_retries=2, retry_delay=2.0, batch_window=0.5, max_batch=10, per_file=None):
+        self.on_update = on_update
+        self.printer = printer
+        self.command_factory = command_factory or default_print_command
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.per_file = sys.platform == 'win32' if per_file is None else per_file
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='print-spooler', daemon=True)
+        self._thread.start()
+
+    def submit(self, path, copies=1):
+        """Ставит файл в очередь печати и сразу возвращает задание"""
+        if self._stopping:
+            raise RuntimeError("Очередь печати остановлена")
+        job = PrintJob(path, copies)
+        with self._lock:
+            self.jobs[job.id] = job
+        self._notify(job)
+        self._queue.put(job)
+        return job
+
+    def status(self, job_id):
+        """Возвращает задание по номеру или None"""
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def pending(self):
+        """Количество еще не завершенных заданий"""
+        with self._lock:
+            return sum(job.status not in (JOB_DONE, JOB_FAILED) for job in self.jobs.values())
+
+    def shutdown(self, wait=True, timeout=None):
+        """Допечатывает очередь и останавливает поток"""
+        self._stopping = True
+        self._queue.put(None)
+        if wait:
+            self._thread.join(timeout)
+
+    def _notify(self, job):
+        if self.on_update:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                logger.error("Ошибка обработчика состояния печати: %s", e)
+
+    def _collect_batch(self, first):
+        # Добираем задания, пришедшие за время batch_window
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                # Сигнал остановки обрабатывается после текущей пачки
+                self._queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = self._collect_batch(job)
+            # Одна команда печатает файлы с одинаковым числом копий
+            for copies in dict.fromkeys(job.copies for job in batch):
+                jobs = [job for job in batch if job.copies == copies]
+                if self.per_file:
+                    # Повтор после ошибки не печатает заново уже отправленные файлы
+                    for job in jobs:
+                        self._print_batch([job], copies)
+                else:
+                    self._print_batch(jobs, copies)
+
+    def _print_batch(self, batch, copies):
+        for job in batch:
+            job.status = JOB_PRINTING
+            job.batch_size = len(batch)
+            self._notify(job)
+
+        error = None
+        for attempt in range(1, self.max_retries + 2):
+            for job in batch:
+                job.attempts = attempt
+            try:
+                command = self.command_factory([job.path for job in batch], self.printer, copies)
+                with timed(STAGE_PRINT_SUBMIT):
+                    result = subprocess.run(command, capture_output=True, text=True,
+                                            timeout=PRINT_COMMAND_TIMEOUT)
+                if result.returncode == 0:
+                    error = None
+                    break
+                error = (result.stderr or result.stdout).strip() or f"код завершения {result.returncode}"
+            except (OSError, subprocess.SubprocessError) as e:
+                error = str(e)
+            logger.warning("Ошибка при печати (попытка %s): %s", attempt, error)
+            if attempt <= self.max_retries:
+                for job in batch:
+                    job.status = JOB_RETRYING
+                    job.error = error
+                    self._notify(job)
+                time.sleep(self.retry_delay)
+
+        for job in batch:
+            job.status = JOB_FAILED if error else JOB_DONE
+            job.error = error
+            job.finished = time.time()
+            self._notify(job)
+
+        with self._lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+            for job_id in finished[:-FINISHED_JOBS_LIMIT]:
+                del self.jobs[job_id]
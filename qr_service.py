@@ -0,0 +1,108 @@
+import qrcode
+from PIL import Image
+from functools import lru_cache
+from io import BytesIO
+
+# Максимальное количество QR-кодов в кэше
+QR_CACHE_SIZE = 4096
+
+# Уровни коррекции ошибок
+ERROR_CORRECTION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+def qr_matrix(payload, ecc='L', border=1):
+    """Возвращает матрицу модулей QR-кода с рамкой (True - темный модуль)"""
+    # Кэш вызывается с полным набором аргументов, чтобы ключ не зависел от формы вызова
+    return _qr_matrix(payload, ecc, border)
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _qr_matrix(payload, ecc, border):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=ERROR_CORRECTION[ecc],
+        border=border,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+
+def module_size_for(payload, size_px, ecc='L', border=1):
+    """Подбирает размер модуля в пикселях, чтобы код не превышал size_px"""
+    return max(1, size_px // len(qr_matrix(payload, ecc, border)))
+
+
+def qr_image(payload, box_size=10, ecc='L', border=1):
+    """Растрирует QR-код сразу в нужном размере модуля, без уменьшения"""
+    matrix = qr_matrix(payload, ecc, border)
+    count = len(matrix)
+    padding = '1' * (-count % 8)
+    # Одна строка модулей -> байты 1-битного изображения (1 - белый пиксель)
+    raw = b''.join(
+        int(''.join('0' if module else '1' for module in row) + padding, 2).to_bytes((count + 7) // 8, 'big')
+        for row in matrix
+    )
+    image = Image.frombytes('1', (count, count), raw)
+    return image.resize((count * box_size, count * box_size), Image.NEAREST)
+
+
+def qr_png(payload, box_size=10, ecc='L', border=1):
+    """Возвращает PNG с QR-кодом; результат кэшируется"""
+    return _qr_png(payload, box_size, ecc, border)
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _qr_png(payload, box_size, ecc, border):
+    image_stream = BytesIO()
+    qr_image(payload, box_size, ecc, border).save(image_stream, format='PNG')
+    return image_stream.getvalue()
+
+
+def qr_rectangles(payload, ecc='L', border=1):
+    """
+    Темные модули, объединенные в прямоугольники (x, y, ширина, высота).
+    Подряд идущие модули строки сливаются в отрезок, а одинаковые отрезки
+    соседних строк - в один прямоугольник.
+    """
+    return _qr_rectangles(payload, ecc, border)
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _qr_rectangles(payload, ecc, border):
+    rectangles = []
+    open_runs = {}  # (x0, x1) -> индекс прямоугольника, продолжающегося до текущей строки
+    for y, row in enumerate(qr_matrix(payload, ecc, border)):
+        runs = {}
+        x = 0
+        count = len(row)
+        while x < count:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < count and row[x]:
+                x += 1
+            key = (start, x)
+            if key in open_runs:
+                index = open_runs[key]
+                left, top, width, height = rectangles[index]
+                rectangles[index] = (left, top, width, height + 1)
+            else:
+                index = len(rectangles)
+                rectangles.append((start, y, x - start, 1))
+            runs[key] = index
+        open_runs = runs
+    return tuple(rectangles)
+
+
+def clear_cache():
+    """Очищает кэши QR-кодов"""
+    _qr_matrix.cache_clear()
+    _qr_png.cache_clear()
+    _qr_rectangles.cache_clear()
@@ -0,0 +1,105 @@
+import logging
+import sqlite3
+import threading
+
+from create_reference_db import (REFERENCE_DB_PATH, ROLE_ASSEMBLER, ROLE_ASSEMBLY_CONTROLLER,
+                                 ensure_reference_schema)
+
+logger = logging.getLogger(__name__)
+
+# Запросы к таблицам справочника: раздел снимка -> (SQL, параметры).
+# Выборки по семейству и роли идут по индексам в порядке добавления записей
+_CASTS_SQL = 'SELECT "Номер", "Наименование" FROM "Отливки" WHERE "Семейство" = ? ORDER BY "ИД"'
+_PEOPLE_SQL = 'SELECT "ФИО" FROM "Люди" WHERE "Роль" = ? ORDER BY "ИД"'
+REFERENCE_QUERIES = {
+    'lgm_casts': (_CASTS_SQL, ('ЛГМ',)),
+    'lpd_casts': (_CASTS_SQL, ('ЛПД',)),
+    'other_casts': (_CASTS_SQL, ('Прочие',)),
+    'assemblers': (_PEOPLE_SQL, (ROLE_ASSEMBLER,)),
+    'controllers': (_PEOPLE_SQL, (ROLE_ASSEMBLY_CONTROLLER,)),
+}
+
+
+class ReferenceSnapshot:
+    """Неизменяемый снимок справочника в памяти"""
+
+    def __init__(self, version, tables):
+        self.version = version
+        # Отливки ЛГМ, ЛПД и прочие: (номер, наименование); у прочих номер совпадает с наименованием
+        self.casts = tuple(tables.get('lgm_casts', ()) + tables.get('lpd_casts', ()) +
+                           tables.get('other_casts', ()))
+        self.cast_names = {number: name for number, name in self.casts}
+        # Номер отливки -> семейство (для выбора шаблона карты)
+        self.cast_families = {}
+        for key in ('lgm_casts', 'lpd_casts', 'other_casts'):
+            family = REFERENCE_QUERIES[key][1][0]
+            self.cast_families.update((number, family) for number, _ in tables.get(key, ()))
+        self.assemblers = tuple(row[0] for row in tables.get('assemblers', ()))
+        self.controllers = tuple(row[0] for row in tables.get('controllers', ()))
+
+
+class ReferenceCache:
+    """
+    Кэш справочника: все таблицы читаются одной транзакцией чтения в снимок,
+    а изменения определяются по PRAGMA data_version. Значение меняется,
+    только когда базу изменило другое соединение (в том числе с другой
+    станции при базе в сетевой папке), поэтому проверка ничего не читает
+    из таблиц и подходит для частого опроса.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or REFERENCE_DB_PATH
+        self._conn = None
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Справочник прежней версии переносится в новые таблицы при первом подключении
+            ensure_reference_schema(self._conn)
+        return self._conn
+
+    def _data_version(self, conn):
+        return conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _load(self):
+        conn = self._connection()
+        tables = {}
+        # Одна транзакция чтения: все разделы снимка согласованы между собой
+        conn.execute('BEGIN')
+        try:
+            version = self._data_version(conn)
+            for key, (sql, params) in REFERENCE_QUERIES.items():
+                try:
+                    tables[key] = conn.execute(sql, params).fetchall()
+                except sqlite3.OperationalError as e:
+                    logger.error("Ошибка при загрузке справочных данных (%s): %s", key, e)
+        finally:
+            conn.rollback()
+        return ReferenceSnapshot(version, tables)
+
+    def snapshot(self):
+        """Возвращает текущий снимок, загружая справочник при первом обращении"""
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._load()
+            return self._snapshot
+
+    def refresh(self):
+        """
+        Перечитывает справочник, если его изменили с момента прошлой загрузки.
+        Возвращает True, если снимок обновился.
+        """
+        with self._lock:
+            if self._snapshot is not None and \
+                    self._data_version(self._connection()) == self._snapshot.version:
+                return False
+            self._snapshot = self._load()
+            return True
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,250 @@
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+
+from create_reference_db import CAST_FAMILIES, REFERENCE_DB_PATH, ensure_reference_schema
+from instrumentation import configure_logging
+
+# Количество строк в одном executemany
+IMPORT_CHUNK_SIZE = 1000
+
+# Описание разделов справочника: ключевые столбцы, остальные столбцы
+PEOPLE_SPEC = {
+    'table': 'Люди',
+    'key': ('ФИО', 'Роль'),
+    'values': (),
+}
+CASTINGS_SPEC = {
+    'table': 'Отливки',
+    'key': ('Номер',),
+    'values': ('Наименование', 'Семейство'),
+}
+
+
+def _clean(value):
+    return ' '.join(str(value).split()) if value is not None else ''
+
+
+def _person_row(record):
+    fio = _clean(record.get('ФИО'))
+    role = _clean(record.get('Роль'))
+    if not fio or not role:
+        raise ValueError("Не указаны ФИО или роль")
+    return (fio, role)
+
+
+def _casting_row(record):
+    name = _clean(record.get('Наименование'))
+    family = _clean(record.get('Семейство'))
+    # У прочих отливок номера нет, номером служит наименование
+    number = _clean(record.get('Номер')) or name
+    if not name:
+        raise ValueError("Не указано наименование отливки")
+    if family not in CAST_FAMILIES:
+        raise ValueError(f"Неизвестное семейство отливки '{family}', ожидается одно из: {', '.join(CAST_FAMILIES)}")
+    return (number, name, family)
+
+
+def read_csv_rows(path):
+    """Построчно читает CSV (разделитель - запятая, точка с запятой или табуляция)"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        for record in csv.DictReader(f, dialect=dialect):
+            yield record
+
+
+def read_xlsx_rows(path):
+    """Построчно читает первый лист XLSX; первая строка - заголовки"""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Для загрузки файлов .xlsx установите пакет openpyxl")
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [_clean(cell) for cell in next(rows, ())]
+        for row in rows:
+            if any(cell is not None for cell in row):
+                yield dict(zip(header, row))
+    finally:
+        workbook.close()
+
+
+def read_rows(path):
+    """Читает записи справочника из CSV или XLSX файла"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.csv':
+        return read_csv_rows(path)
+    if ext == '.xlsx':
+        return read_xlsx_rows(path)
+    raise ValueError("Поддерживаются только файлы .csv и .xlsx")
+
+
+def _upsert(conn, spec, make_row, records, prune=False, update_existing=True, dry_run=False):
+    """
+    Загружает записи в таблицу справочника одной транзакцией и возвращает отчет:
+    {'added': [...], 'updated': [(ключ, было, стало)], 'unchanged': N,
+     'removed': [...], 'invalid': [(номер строки, причина)]}.
+    prune удаляет строки, которых нет в файле; если в файле есть ошибочные строки,
+    удаление не выполняется (их ключ неизвестен). dry_run только считает отличия.
+    """
+    table = spec['table']
+    key_columns = spec['key']
+    value_columns = spec['values']
+    key_size = len(key_columns)
+    columns = key_columns + value_columns
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    conflict_list = ', '.join(f'"{column}"' for column in key_columns)
+    if value_columns:
+        update_list = ', '.join(f'"{column}" = excluded."{column}"' for column in value_columns)
+        on_conflict = f'DO UPDATE SET {update_list}'
+    else:
+        on_conflict = 'DO NOTHING'
+    upsert_sql = (f'INSERT INTO "{table}" ({column_list}) VALUES ({", ".join("?" * len(columns))}) '
+                  f'ON CONFLICT ({conflict_list}) {on_conflict}')
+
+    report = {'added': [], 'updated': [], 'unchanged': 0, 'removed': [], 'invalid': []}
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Текущее содержимое таблицы: ключ -> значения (тысячи строк помещаются в память)
+        existing = {row[:key_size]: row[key_size:]
+                    for row in conn.execute(f'SELECT {column_list} FROM "{table}"')}
+        seen = set()
+        chunk = []
+        # Строка 1 - заголовок
+        for line_number, record in enumerate(records, 2):
+            try:
+                row = make_row(record)
+            except ValueError as e:
+                report['invalid'].append((line_number, str(e)))
+                continue
+            key, values = row[:key_size], row[key_size:]
+            if key in seen:
+                report['invalid'].append((line_number, f"Повтор записи {' / '.join(key)}"))
+                continue
+            seen.add(key)
+
+            if key not in existing:
+                report['added'].append(key)
+            elif existing[key] == values:
+                report['unchanged'] += 1
+                continue
+            elif update_existing:
+                report['updated'].append((key, existing[key], values))
+            else:
+                report['unchanged'] += 1
+                continue
+            chunk.append(row)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                if not dry_run:
+                    conn.executemany(upsert_sql, chunk)
+                chunk = []
+        if chunk and not dry_run:
+            conn.executemany(upsert_sql, chunk)
+
+        # Ошибочная строка могла описывать существующую запись: без ее ключа удаление
+        # стерло бы запись, которую файл оставляет
+        if prune and not report['invalid']:
+            report['removed'] = [key for key in existing if key not in seen]
+            if not dry_run and report['removed']:
+                where = ' AND '.join(f'"{column}" = ?' for column in key_columns)
+                conn.executemany(f'DELETE FROM "{table}" WHERE {where}', report['removed'])
+
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return report
+
+
+def upsert_people(conn, records, **options):
+    """Загружает сотрудников (ФИО, Роль); параметры см. _upsert"""
+    return _upsert(conn, PEOPLE_SPEC, _person_row, records, **options)
+
+
+def upsert_castings(conn, records, **options):
+    """Загружает отливки (Номер, Наименование, Семейство); параметры см. _upsert"""
+    return _upsert(conn, CASTINGS_SPEC, _casting_row, records, **options)
+
+
+def detect_kind(header):
+    """Определяет раздел справочника по заголовкам столбцов"""
+    header = set(header)
+    if {'ФИО', 'Роль'} <= header:
+        return 'people'
+    if {'Наименование', 'Семейство'} <= header:
+        return 'castings'
+    raise ValueError("Не удалось определить раздел: нужны столбцы ФИО, Роль "
+                     "или Номер, Наименование, Семейство")
+
+
+def import_file(path, db_path=None, conn=None, prune=False, update_existing=True, dry_run=False):
+    """Загружает CSV или XLSX файл в справочник и возвращает отчет об изменениях"""
+    records = iter(read_rows(path))
+    first = next(records, None)
+    if first is None:
+        return {'added': [], 'updated': [], 'unchanged': 0, 'removed': [], 'invalid': []}
+    upsert = upsert_people if detect_kind(first) == 'people' else upsert_castings
+
+    def all_records():
+        yield first
+        yield from records
+
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(db_path or REFERENCE_DB_PATH, timeout=30)
+    try:
+        ensure_reference_schema(conn)
+        return upsert(conn, all_records(), prune=prune, update_existing=update_existing, dry_run=dry_run)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Загрузка сотрудников и отливок в справочник из CSV или XLSX")
+    parser.add_argument('input', help="CSV или XLSX файл со столбцами ФИО, Роль или Номер, Наименование, Семейство")
+    parser.add_argument('--db', default=REFERENCE_DB_PATH, help="Путь к справочнику")
+    parser.add_argument('--prune', action='store_true', help="Удалить записи, которых нет в файле")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать отличия, не изменяя справочник")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    started = time.perf_counter()
+    try:
+        report = import_file(args.input, args.db, prune=args.prune, dry_run=args.dry_run)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Ошибка загрузки справочника: {e}")
+        return 1
+    elapsed = time.perf_counter() - started
+
+    for key in report['added']:
+        print(f"+ {' / '.join(key)}")
+    for key, old, new in report['updated']:
+        print(f"~ {' / '.join(key)}: {' / '.join(old)} -> {' / '.join(new)}")
+    for key in report['removed']:
+        print(f"- {' / '.join(key)}")
+    for line_number, reason in report['invalid']:
+        print(f"! строка {line_number}: {reason}")
+    if args.prune and report['invalid']:
+        print("Удаление не выполнено: в файле есть ошибочные строки")
+    print(f"Добавлено: {len(report['added'])}, изменено: {len(report['updated'])}, "
+          f"удалено: {len(report['removed'])}, без изменений: {report['unchanged']}, "
+          f"ошибок: {len(report['invalid'])} ({elapsed:.2f} с)"
+          + (" - пробный запуск, справочник не изменен" if args.dry_run else ""))
+    return 1 if report['invalid'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
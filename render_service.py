@@ -0,0 +1,538 @@
+import argparse
+import asyncio
+import hashlib
+import http.client
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from io import BytesIO
+from urllib.parse import parse_qsl, quote, unquote, urlencode, urlsplit
+
+import create_history_db
+from instrumentation import METRICS, STAGE_CARD, configure_logging, timed
+from template_registry import TEMPLATES_DIR, TemplateRegistry, load_cast_families
+
+logger = logging.getLogger(__name__)
+
+# Адрес службы; если переменная задана, окно работает через службу
+SERVICE_URL = os.environ.get('FORMBUILDER_SERVICE_URL')
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Ограничения запроса
+MAX_BODY_SIZE = 1024 * 1024
+MAX_HEADERS = 100
+
+# Форматы выдачи карты: формат -> (расширение, Content-Type)
+RENDER_FORMATS = {
+    'pptx': ('.pptx', 'application/vnd.openxmlformats-officedocument.presentationml.presentation'),
+    'png': ('.png', 'image/png'),
+    'pdf': ('.pdf', 'application/pdf'),
+}
+
+# Способы рендеринга pptx (см. batch_generate.BACKENDS)
+RENDER_BACKENDS = ('pptx', 'patch')
+
+# Параметры поиска по истории, которые принимает /history
+HISTORY_FILTERS = ('cluster_prefix', 'cast_number', 'executor', 'date_from', 'date_to',
+                   'created_from', 'created_to', 'control_from', 'control_to')
+MAX_HISTORY_LIMIT = 500
+
+# Сколько ждать, пока все потоки пула возьмут задание прогрева (с)
+WARM_UP_TIMEOUT = 30
+
+# Запись для прогрева шаблона
+WARM_UP_RECORD = {'cluster_number': 'К00/00-000'}
+
+
+class HttpError(Exception):
+    """Ошибка запроса с кодом ответа HTTP"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _json_response(status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return status, 'application/json; charset=utf-8', body, {}
+
+
+class RenderService:
+    """
+    Служба рендеринга для нескольких станций: владеет базой истории
+    и прогретыми шаблоном и QR-кодами. Карты рендерятся в пуле потоков
+    (снимок шаблона у каждого потока свой), запросы к базе идут через
+    AsyncHistoryRepository, так что цикл событий не блокируется.
+    С cache готовые карты кладутся в хранилище карт (см. output_store),
+    и повторный запрос той же карты отдается из него без рендеринга.
+    Шаблон выбирается по семейству отливки из каталога templates_dir.
+    """
+
+    def __init__(self, template_path="ШАБЛОН.pptx", workers=4, backend='patch', repository=None, cache=True,
+                 templates_dir=None):
+        if backend not in RENDER_BACKENDS:
+            raise ValueError(f"Неизвестный способ рендеринга: {backend}")
+        self.template_path = template_path
+        self.registry = TemplateRegistry(templates_dir, template_path)
+        self.cast_families = load_cast_families() if self.registry.families else {}
+        self.workers = workers
+        self.backend = backend
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.history = create_history_db.AsyncHistoryRepository(
+            repository or create_history_db.HistoryRepository(pool_size=workers), max_workers=workers)
+        self.in_flight = 0
+        self.served = 0
+        self.started = time.time()
+
+    def render_bytes(self, data, fmt='pptx', cache=None, template_path=None):
+        """Рендерит карту в память (или берет из хранилища); выполняется в потоке пула"""
+        template_path = template_path or self.registry.template_for()
+        if not (self.cache if cache is None else cache):
+            out = BytesIO()
+            self._render_into(data, fmt, out, template_path)
+            return out.getvalue()
+        import card_export
+        from output_store import write_card
+        variant = f'dpi={card_export.PRINT_DPI}' if fmt in ('png', 'pdf') else 'raster'
+        path = write_card(template_path, data, RENDER_FORMATS[fmt][0], variant,
+                          lambda f: self._render_into(data, fmt, f, template_path))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _render_into(self, data, fmt, out, template_path):
+        import card_engine
+        with timed(STAGE_CARD):
+            if fmt == 'png':
+                import card_export
+                image = card_export.get_rasterizer(template_path).render(data)
+                image.save(out, 'PNG', dpi=(card_export.PRINT_DPI, card_export.PRINT_DPI))
+            elif fmt == 'pdf':
+                import card_export
+                card_export.render_pdf(template_path, data, out)
+            elif self.backend == 'patch':
+                import pptx_patcher
+                pptx_patcher.get_patcher(template_path).render(data, out)
+            else:
+                snapshot = card_engine.get_snapshot(template_path)
+                card_engine.fill_slide(snapshot.new_card(), data, snapshot.plan)
+                snapshot.save(out)
+
+    def warm_up(self):
+        """Загружает шаблоны в каждом потоке пула до первых запросов"""
+        barrier = threading.Barrier(self.workers)
+
+        def task():
+            # Барьер держит поток, пока остальные задания не разойдутся по своим потокам
+            try:
+                barrier.wait(WARM_UP_TIMEOUT)
+            except threading.BrokenBarrierError:
+                pass
+            import card_engine
+            for template_path in self.registry.paths():
+                self.render_bytes(card_engine.normalize_form_data(WARM_UP_RECORD), cache=False,
+                                  template_path=template_path)
+
+        for future in [self.executor.submit(task) for _ in range(self.workers)]:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.history.close()
+
+    async def handle(self, method, path, query, body):
+        """Обрабатывает запрос; возвращает (код, Content-Type, тело, доп. заголовки)"""
+        if path == '/health' and method == 'GET':
+            return _json_response(HTTPStatus.OK, {
+                'status': 'ok', 'workers': self.workers, 'backend': self.backend,
+                'in_flight': self.in_flight, 'served': self.served,
+                'uptime': round(time.time() - self.started, 1)})
+        if path == '/metrics' and method == 'GET':
+            return HTTPStatus.OK, 'text/plain; version=0.0.4', METRICS.to_prometheus().encode('utf-8'), {}
+        if path == '/render' and method == 'POST':
+            return await self._render(query, self._json_body(body))
+        if path == '/cluster-numbers' and method == 'POST':
+            return await self._allocate(self._json_body(body))
+        if path == '/cluster-numbers' and method == 'GET':
+            return await self._peek(query)
+        if path == '/history' and method == 'GET':
+            return await self._search(query)
+        if path.startswith('/history/') and method == 'GET':
+            form = await self.history.get_form(unquote(path[len('/history/'):]))
+            if form is None:
+                raise HttpError(HTTPStatus.NOT_FOUND, "Карта не найдена")
+            return _json_response(HTTPStatus.OK, form)
+        raise HttpError(HTTPStatus.NOT_FOUND, f"Нет обработчика {method} {path}")
+
+    def _json_body(self, body):
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Тело запроса - не JSON")
+        if not isinstance(payload, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Ожидается объект JSON")
+        return payload
+
+    async def _render(self, query, data):
+        fmt = query.get('format', 'pptx')
+        if fmt not in RENDER_FORMATS:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"Неизвестный формат: {fmt}")
+        save = query.get('save', '1') != '0'
+        # Семейство отливки передает станция, иначе оно берется из справочника
+        family = data.get('family') or self.cast_families.get(str(data.get('cast_number') or ''))
+        template_path = self.registry.template_for(family)
+        # Все поля формы в виде строк, как их передает окно
+        # Поля карты - по спецификации заполнения выбранного шаблона
+        from card_engine import normalize_form_data, template_fields
+        try:
+            fields = template_fields(template_path)
+        except (OSError, ValueError) as e:
+            raise HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, f"Шаблон недоступен: {e}")
+        data = normalize_form_data(data, fields)
+        if not data['cluster_number']:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Не указан номер кластера")
+        if save:
+            try:
+                create_history_db.validate_cluster_number(data['cluster_number'])
+            except ValueError as e:
+                raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(self.executor, self.render_bytes, data, fmt, None, template_path)
+        if save:
+            # Карта уходит станции только после записи в историю
+            try:
+                await self.history.save_form(data)
+            except ValueError as e:
+                raise HttpError(HTTPStatus.CONFLICT, str(e))
+
+        ext, content_type = RENDER_FORMATS[fmt]
+        filename = f"маршрутная_карта_{data['cluster_number'].replace('/', '_')}{ext}"
+        return HTTPStatus.OK, content_type, content, {
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+
+    async def _allocate(self, payload):
+        try:
+            count = int(payload.get('count', 1))
+            numbers = await self.history.reserve_cluster_numbers(payload.get('date', ''), count)
+        except (TypeError, ValueError) as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        return _json_response(HTTPStatus.OK, {'numbers': numbers})
+
+    async def _peek(self, query):
+        try:
+            number = await self.history.peek_cluster_number(query.get('date', ''))
+        except (TypeError, ValueError) as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        return _json_response(HTTPStatus.OK, {'number': number})
+
+    async def _search(self, query):
+        filters = {key: query[key] for key in HISTORY_FILTERS if query.get(key)}
+        try:
+            limit = min(MAX_HISTORY_LIMIT, int(query.get('limit', 50)))
+            after = json.loads(query['after']) if query.get('after') else None
+            # Курсор - список значений, который служба вернула в next_after
+            if after is not None and not isinstance(after, list):
+                raise ValueError("Параметр after должен быть списком")
+            forms, next_after = await self.history.search_forms(after=after, limit=limit, **filters)
+        except (TypeError, ValueError) as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        return _json_response(HTTPStatus.OK, {'forms': forms, 'next_after': next_after})
+
+    async def handle_connection(self, reader, writer):
+        """Соединение HTTP/1.1 с поддержкой keep-alive"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    if len(headers) >= MAX_HEADERS:
+                        raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, "Слишком много заголовков")
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close')
+
+                # Без верной длины тело запроса не отделить от следующего: отвечаем и закрываем соединение
+                try:
+                    length = int(headers.get('content-length') or 0)
+                except ValueError:
+                    raise HttpError(HTTPStatus.BAD_REQUEST, "Неверный заголовок Content-Length")
+                if length < 0:
+                    raise HttpError(HTTPStatus.BAD_REQUEST, "Неверный заголовок Content-Length")
+                if length > MAX_BODY_SIZE:
+                    response = _json_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': "Слишком большой запрос"})
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    response = await self._dispatch(method, target, body)
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HttpError as e:
+            await self._write_response(writer, _json_response(e.status, {'error': e.message}), False)
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, body):
+        parts = urlsplit(target)
+        query = dict(parse_qsl(parts.query))
+        self.in_flight += 1
+        try:
+            return await self.handle(method, parts.path, query, body)
+        except HttpError as e:
+            return _json_response(e.status, {'error': e.message})
+        except Exception as e:
+            logger.exception("Ошибка обработки %s %s", method, parts.path)
+            return _json_response(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f"Ошибка службы: {e}"})
+        finally:
+            self.in_flight -= 1
+            self.served += 1
+
+    async def _write_response(self, writer, response, keep_alive):
+        status, content_type, body, extra_headers = response
+        status = HTTPStatus(status)
+        lines = [f'HTTP/1.1 {status.value} {status.phrase}',
+                 f'Content-Type: {content_type}',
+                 f'Content-Length: {len(body)}',
+                 f'Connection: {"keep-alive" if keep_alive else "close"}']
+        lines += [f'{name}: {value}' for name, value in extra_headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, ready=None):
+    """Запускает службу и работает до отмены задачи"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, service.warm_up)
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    logger.info("Служба рендеринга: http://%s:%s (потоков: %s, рендеринг: %s)",
+                host, port, service.workers, service.backend)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+class ServiceError(RuntimeError):
+    """Ошибка службы (код 5xx или недоступность)"""
+
+
+class RenderServiceClient:
+    """
+    Клиент службы рендеринга для окна и нагрузочной проверки.
+    Соединение keep-alive свое у каждого потока. Ошибки данных (коды 4xx)
+    поднимаются как ValueError, как и при работе напрямую с базой.
+    """
+
+    def __init__(self, url=None, timeout=30):
+        parts = urlsplit(url or SERVICE_URL or f'http://{DEFAULT_HOST}:{DEFAULT_PORT}')
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def request(self, method, path, payload=None):
+        """Выполняет запрос; возвращает (ответ, тело)"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                content = response.read()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # Служба могла закрыть простаивающее соединение: один повтор с новым
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise ServiceError(f"Служба рендеринга недоступна: {e}")
+        if response.status >= 400:
+            try:
+                message = json.loads(content)['error']
+            except (ValueError, KeyError):
+                message = content.decode('utf-8', 'replace')
+            if response.status >= 500:
+                raise ServiceError(message)
+            if response.status == HTTPStatus.NOT_FOUND and path.startswith('/history/'):
+                return response, None
+            raise ValueError(message)
+        return response, content
+
+    def health(self):
+        return json.loads(self.request('GET', '/health')[1])
+
+    def render(self, data, save=True, fmt='pptx'):
+        """Возвращает содержимое файла карты; save - записать карту в историю"""
+        query = urlencode({'format': fmt, 'save': '1' if save else '0'})
+        return self.request('POST', f'/render?{query}', dict(data))[1]
+
+    def render_to_file(self, template_path, data, output_dir=None, save=True, fmt='pptx'):
+        """
+        Рендерит карту службой и сохраняет файл локально; подходит как
+        render для GenerationQueue (template_path определяет служба)
+        """
+        from card_engine import normalize_form_data
+        from output_store import store_file
+        content = self.render(data, save, fmt)
+        # Шаблон есть только у службы, поэтому ключом служит хэш полученного файла
+        key = hashlib.sha256(content).hexdigest()
+        return store_file(key, normalize_form_data(data), RENDER_FORMATS[fmt][0], lambda f: f.write(content),
+                          output_dir)
+
+    def reserve_cluster_numbers(self, date_str, count=1):
+        return json.loads(self.request('POST', '/cluster-numbers', {'date': date_str, 'count': count})[1])['numbers']
+
+    def next_cluster_number(self, date_str):
+        return self.reserve_cluster_numbers(date_str, 1)[0]
+
+    def peek_cluster_number(self, date_str):
+        """То же, что create_history_db.peek_next_cluster_number"""
+        return json.loads(self.request('GET', f'/cluster-numbers?{urlencode({"date": date_str})}')[1])['number']
+
+    def search_forms(self, after=None, limit=50, **filters):
+        """То же, что create_history_db.search_forms"""
+        query = {key: value for key, value in filters.items() if value}
+        query['limit'] = limit
+        if after is not None:
+            query['after'] = json.dumps(list(after))
+        result = json.loads(self.request('GET', f'/history?{urlencode(query)}')[1])
+        return result['forms'], result['next_after']
+
+    def get_form(self, cluster_number):
+        content = self.request('GET', f'/history/{quote(cluster_number, safe="")}')[1]
+        return json.loads(content) if content is not None else None
+
+
+def load_test(url=None, clients=8, requests=200, mode='station', date_str='01.03.2025'):
+    """
+    Нагрузочная проверка службы: clients потоков выполняют всего requests
+    операций. mode: station - номер и карта с записью в историю (как станция),
+    render - только рендеринг, allocate - только номера, history - поиск.
+    """
+    from benchmarks import sample_records
+
+    client = RenderServiceClient(url)
+    records = list(sample_records(requests))
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def operation(i):
+        started = time.perf_counter()
+        try:
+            if mode == 'station':
+                record = dict(records[i], cluster_number=client.next_cluster_number(date_str))
+                client.render(record)
+            elif mode == 'render':
+                client.render(records[i], save=False)
+            elif mode == 'allocate':
+                client.next_cluster_number(date_str)
+            else:
+                client.search_forms(limit=50)
+        except (ValueError, ServiceError) as e:
+            with lock:
+                errors.append(str(e))
+            return
+        with lock:
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(operation, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {'mode': mode, 'clients': clients, 'requests': requests, 'ok': len(latencies),
+              'errors': errors, 'seconds': elapsed, 'per_second': len(latencies) / elapsed}
+    if latencies:
+        result.update({
+            'median_ms': statistics.median(latencies),
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'max_ms': latencies[-1],
+        })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Служба рендеринга маршрутных карт для нескольких станций")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="Запустить службу")
+    serve_parser.add_argument('--host', default=DEFAULT_HOST, help="Адрес для подключений")
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Порт")
+    serve_parser.add_argument('--workers', type=int, default=4, help="Потоков рендеринга")
+    serve_parser.add_argument('--template', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    serve_parser.add_argument('--templates', default=TEMPLATES_DIR,
+                              help="Каталог шаблонов по семействам отливок (<имя>_ЛГМ.pptx и т.п.)")
+    serve_parser.add_argument('--backend', choices=RENDER_BACKENDS, default='patch',
+                              help="Рендеринг pptx: python-pptx или прямая правка XML слайда")
+    serve_parser.add_argument('--no-cache', action='store_true',
+                              help="Не хранить готовые карты, рендерить каждый запрос заново")
+
+    load_parser = commands.add_parser('loadtest', help="Нагрузочная проверка запущенной службы")
+    load_parser.add_argument('--url', default=SERVICE_URL or f'http://{DEFAULT_HOST}:{DEFAULT_PORT}',
+                             help="Адрес службы")
+    load_parser.add_argument('--clients', type=int, default=8, help="Одновременных клиентов")
+    load_parser.add_argument('--requests', type=int, default=200, help="Всего операций")
+    load_parser.add_argument('--mode', choices=('station', 'render', 'allocate', 'history'), default='station',
+                             help="Операция: station - номер и карта с записью в историю")
+    load_parser.add_argument('--date', default='01.03.2025', help="Дата склейки для выдачи номеров")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    if args.command == 'loadtest':
+        r = load_test(args.url, args.clients, args.requests, args.mode, args.date)
+        for error in r['errors'][:10]:
+            print(f"Ошибка: {error}")
+        print(f"{r['mode']}: {r['ok']} из {r['requests']} за {r['seconds']:.2f} с ({r['per_second']:.1f} в секунду), "
+              f"клиентов {r['clients']}, ошибок {len(r['errors'])}")
+        if r['ok']:
+            print(f"Задержка: медиана {r['median_ms']:.1f} мс, p95 {r['p95_ms']:.1f} мс, "
+                  f"p99 {r['p99_ms']:.1f} мс, максимум {r['max_ms']:.1f} мс")
+        return 1 if r['errors'] else 0
+
+    default_template = TemplateRegistry(args.templates, args.template).default
+    if not os.path.exists(default_template):
+        print(f"Файл {default_template} не найден")
+        return 1
+    service = RenderService(args.template, args.workers, args.backend, cache=not args.no_cache,
+                            templates_dir=args.templates)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+from pptx import Presentation
+import argparse
+import logging
+import hashlib
+import json
+import os
+import sys
+from io import BytesIO
+
+from instrumentation import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Спецификация заполнения шаблона: где QR-код и какие ячейки каких таблиц
+# заполняются какими полями формы (см. field_mapping.json)
+DEFAULT_MAPPING_PATH = os.environ.get(
+    'FORMBUILDER_FIELD_MAPPING', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'field_mapping.json'))
+
+# Кэш скомпилированных планов: (хэш шаблона, хэш спецификации) -> план
+_plan_cache = {}
+
+# Кэш прочитанных спецификаций: путь -> спецификация
+_mappings = {}
+
+
+def template_hash(template_bytes):
+    """Возвращает хэш содержимого шаблона"""
+    return hashlib.sha256(template_bytes).hexdigest()
+
+
+def mapping_hash(mapping):
+    """Возвращает хэш спецификации заполнения"""
+    return hashlib.sha256(json.dumps(mapping, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def validate_mapping(mapping):
+    """Проверяет структуру спецификации; при ошибке выбрасывает ValueError"""
+    if not isinstance(mapping, dict):
+        raise ValueError("Спецификация должна быть словарем")
+    qr = mapping.get('qr', {})
+    if not isinstance(qr, dict) or not isinstance(qr.get('anchor', ''), str):
+        raise ValueError("Раздел qr: нужен текст anchor")
+    tables = mapping.get('tables')
+    if not isinstance(tables, list) or not tables:
+        raise ValueError("Спецификация должна содержать непустой список tables")
+    for index, table in enumerate(tables, 1):
+        name = table.get('name', index) if isinstance(table, dict) else index
+        if not isinstance(table, dict) or not ('cells' in table or 'rows' in table):
+            raise ValueError(f"Таблица {name}: нужен список cells или rows")
+        for cell in table.get('cells', ()):
+            if not all(isinstance(cell.get(key), int) for key in ('row', 'col')) or not cell.get('field'):
+                raise ValueError(f"Таблица {name}: у ячейки нужны row, col и field")
+        if 'rows' in table and not isinstance(table.get('columns'), dict):
+            raise ValueError(f"Таблица {name}: для rows нужен словарь columns")
+        for row in table.get('rows', ()):
+            if not row.get('text') or not row.get('prefix'):
+                raise ValueError(f"Таблица {name}: у строки нужны text и prefix")
+            for neighbor in row.get('neighbors', ()):
+                if not neighbor.get('text') or not neighbor.get('field'):
+                    raise ValueError(f"Таблица {name}: у соседней ячейки нужны text и field")
+    return mapping
+
+
+def load_mapping(path=None, reload=False):
+    """
+    Читает спецификацию заполнения из JSON (или YAML) один раз и возвращает
+    ее из кэша; reload - перечитать файл
+    """
+    path = path or DEFAULT_MAPPING_PATH
+    mapping = None if reload else _mappings.get(path)
+    if mapping is None:
+        with open(path, encoding='utf-8') as f:
+            if path.lower().endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError("Для спецификаций .yaml установите пакет PyYAML")
+                mapping = yaml.safe_load(f)
+            else:
+                mapping = json.load(f)
+        mapping = _mappings[path] = validate_mapping(mapping)
+    return mapping
+
+
+def mapping_fields(mapping):
+    """Поля формы, которые заполняет спецификация, в порядке описания"""
+    fields = []
+    for table in mapping['tables']:
+        fields.extend(cell['field'] for cell in table.get('cells', ()))
+        format_only = set(table.get('format_only', ()))
+        for row in table.get('rows', ()):
+            fields.extend(f"{row['prefix']}_{column}" for column in table['columns'].values()
+                          if column not in format_only)
+            fields.extend(neighbor['field'] for neighbor in row.get('neighbors', ()))
+    return tuple(dict.fromkeys(fields))
+
+
+def _match_table(tables, texts):
+    # Первая таблица спецификации, чей заголовок есть в первой ячейке (без заголовка - любая)
+    for table in tables:
+        if table.get('header', '') in texts[0][0]:
+            return table
+    return None
+
+
+def compile_slide_plan(slide, mapping=None):
+    """
+    Один раз обходит слайд шаблона и находит координаты заполнения
+    по спецификации mapping (по умолчанию - field_mapping.json).
+    План содержит позиции QR-кода и список ячеек
+    (индекс фигуры, строка, столбец, поле формы или None).
+    """
+    mapping = mapping or load_mapping()
+    qr = mapping.get('qr', {})
+    plan = {'qr_positions': [], 'cells': [], 'tables_found': False}
+    found_rows = set()
+
+    for shape_index, shape in enumerate(slide.shapes):
+        # Ищем текст-якорь для размещения QR-кода
+        if qr.get('anchor') and hasattr(shape, "text") and qr['anchor'] in shape.text:
+            size, gap = qr.get('size', 400000), qr.get('gap', 200000)
+            left = shape.left + shape.width + gap
+            top = shape.top + (shape.height - size) / 2
+            plan['qr_positions'].append((left, top, size, size))
+
+        if not shape.has_table:
+            continue
+
+        plan['tables_found'] = True
+        table = shape.table
+        rows = len(table.rows)
+        cols = len(table.columns)
+        texts = [[table.cell(r, c).text.strip() for c in range(cols)] for r in range(rows)]
+        logger.debug("Найдена таблица: %s строк, %s столбцов, заголовок: '%s'", rows, cols, texts[0][0])
+
+        spec = _match_table(mapping['tables'], texts)
+        if spec is None:
+            continue
+        name = spec.get('name', texts[0][0])
+
+        # Ячейки с заданными координатами
+        cells = spec.get('cells', ())
+        if any(cell['row'] >= rows or cell['col'] >= cols for cell in cells):
+            logger.warning("Таблица '%s' имеет неожиданную структуру, пропускаем", name)
+            continue
+        for cell in cells:
+            plan['cells'].append((shape_index, cell['row'], cell['col'], cell['field']))
+
+        if 'rows' not in spec:
+            continue
+
+        # Индексы нужных столбцов по заголовкам
+        columns = spec['columns']
+        format_only = set(spec.get('format_only', ()))
+        column_indices = {}
+        for col, header in enumerate(texts[0]):
+            if header in columns:
+                column_indices[columns[header]] = col
+
+        # Ячейки справа от текстов соседних ячеек ("Время:")
+        neighbor_cells = {}
+        for row_spec in spec['rows']:
+            for neighbor in row_spec.get('neighbors', ()):
+                neighbor_cells[neighbor['text']] = [(r, c + 1) for r in range(rows) for c in range(cols - 1)
+                                                    if texts[r][c] == neighbor['text']]
+
+        # Один проход по строкам: строка операции определяется текстом первого столбца
+        for row in range(rows):
+            operation = texts[row][0]
+            for row_spec in spec['rows']:
+                if row_spec['text'] not in operation:
+                    continue
+                prefix = row_spec['prefix']
+                found_rows.add(prefix)
+                # Столбцы format_only в строке операции не заполняются, только форматируются
+                for column, col in column_indices.items():
+                    field = None if column in format_only else f'{prefix}_{column}'
+                    plan['cells'].append((shape_index, row, col, field))
+                for neighbor in row_spec.get('neighbors', ()):
+                    for r, c in neighbor_cells[neighbor['text']]:
+                        plan['cells'].append((shape_index, r, c, neighbor['field']))
+
+    if not plan['tables_found']:
+        logger.warning("На слайде не найдено ни одной таблицы!")
+    for table in mapping['tables']:
+        for row_spec in table.get('rows', ()):
+            if row_spec['prefix'] not in found_rows:
+                logger.warning("Строка '%s' из спецификации не найдена в шаблоне", row_spec['text'])
+    return plan
+
+
+def get_template_plan(template_bytes, mapping=None):
+    """Возвращает план шаблона, компилируя его только при первом обращении"""
+    mapping = mapping or load_mapping()
+    key = (template_hash(template_bytes), mapping_hash(mapping))
+    plan = _plan_cache.get(key)
+    if plan is None:
+        prs = Presentation(BytesIO(template_bytes))
+        if not prs.slides:
+            raise ValueError("Презентация не содержит слайдов")
+        plan = compile_slide_plan(prs.slides[0], mapping)
+        plan['template_hash'] = key[0]
+        plan['fields'] = tuple(dict.fromkeys(field for _, _, _, field in plan['cells'] if field))
+        _plan_cache[key] = plan
+    return plan
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка спецификации заполнения шаблона")
+    parser.add_argument('template', nargs='?', default="ШАБЛОН.pptx", help="Путь к шаблону презентации")
+    parser.add_argument('--mapping', default=None, help="Спецификация заполнения .json или .yaml")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    try:
+        mapping = load_mapping(args.mapping)
+        with open(args.template, 'rb') as f:
+            plan = get_template_plan(f.read(), mapping)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка: {e}")
+        return 1
+    for shape_index, row, col, field in plan['cells']:
+        print(f"фигура {shape_index}, строка {row}, столбец {col}: {field or '(только формат)'}")
+    print(f"QR-кодов: {len(plan['qr_positions'])}, заполняемых полей: {len(plan['fields'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from create_reference_db import CAST_FAMILIES
+from instrumentation import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Каталог шаблонов карт. Шаблон семейства отливок называется <имя>_<семейство>.pptx,
+# например ШАБЛОН_ЛГМ.pptx; остальные карты создаются по шаблону по умолчанию
+TEMPLATES_DIR = os.environ.get('FORMBUILDER_TEMPLATES_DIR', 'шаблоны')
+DEFAULT_TEMPLATE = 'ШАБЛОН.pptx'
+TEMPLATE_EXT = '.pptx'
+
+# Спецификация заполнения рядом с шаблоном: <имя шаблона>.json или .yaml
+MAPPING_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+# Как часто проверять изменения шаблонов на диске (с)
+POLL_INTERVAL = 2.0
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def mapping_path_for(template_path):
+    """Путь к собственной спецификации заполнения шаблона или None"""
+    stem = os.path.splitext(template_path)[0]
+    for ext in MAPPING_EXTENSIONS:
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return None
+
+
+def _stamp(template_path):
+    # Время изменения и размер шаблона и его спецификации; None - файла нет
+    stem = os.path.splitext(template_path)[0]
+    stamp = []
+    for path in (template_path,) + tuple(stem + ext for ext in MAPPING_EXTENSIONS):
+        try:
+            stat = os.stat(path)
+            stamp.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+def _family_of(name):
+    stem = os.path.splitext(name)[0]
+    family = stem.rsplit('_', 1)[-1] if '_' in stem else None
+    return family if family in CAST_FAMILIES else None
+
+
+class TemplateRegistry:
+    """
+    Реестр шаблонов карт: находит шаблоны в каталоге, выбирает шаблон
+    по семейству отливки (ЛГМ, ЛПД, Прочие) и опросом времени изменения
+    следит за файлами. Измененный шаблон или его спецификация заполнения
+    перечитывается без перезапуска программы; снимки, патчеры и планы
+    остальных шаблонов не пересоздаются.
+    """
+
+    def __init__(self, directory=TEMPLATES_DIR, default_path=DEFAULT_TEMPLATE, poll_interval=POLL_INTERVAL):
+        self.directory = directory
+        self.default_path = default_path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self.templates = {}  # имя файла -> путь
+        self.families = {}  # семейство -> путь
+        self.default = default_path
+        self._stamps = {}  # путь -> отметка файлов (см. _stamp)
+        self._discovered = set()  # имена файлов шаблонов в каталоге при последнем поиске
+        self._checked = time.monotonic()
+        self._scan()
+
+    def _discover(self):
+        templates = {}
+        if self.directory and os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                # ~$ - файл блокировки открытой в PowerPoint презентации
+                if name.lower().endswith(TEMPLATE_EXT) and not name.startswith('~$'):
+                    templates[name] = os.path.join(self.directory, name)
+        return templates
+
+    def _scan(self):
+        templates = self._discover()
+        self._discovered = set(templates)
+        families = {}
+        default = None
+        for name, path in templates.items():
+            family = _family_of(name)
+            if family:
+                families[family] = path
+            elif name == os.path.basename(self.default_path) or default is None:
+                default = path
+        # Без каталога шаблонов (или без общего шаблона в нем) - прежний шаблон рядом с программой
+        if default is None:
+            default = self.default_path
+            templates.setdefault(os.path.basename(default), default)
+        self.templates, self.families, self.default = templates, families, default
+        for path in templates.values():
+            self._stamps.setdefault(path, _stamp(path))
+        logger.debug("Шаблоны: %s, по семействам: %s", sorted(templates), families)
+
+    def paths(self):
+        """Пути всех известных шаблонов"""
+        return list(dict.fromkeys(self.templates.values()))
+
+    def refresh(self):
+        """
+        Проверяет файлы шаблонов: находит новые и удаленные шаблоны
+        и перечитывает только измененные. Возвращает пути измененных шаблонов.
+        """
+        changed = []
+        with self._lock:
+            self._checked = time.monotonic()
+            # Шаблон добавили в каталог или удалили из него
+            if set(self._discover()) != self._discovered:
+                self._scan()
+            for path in self.paths():
+                stamp = _stamp(path)
+                if stamp == self._stamps.get(path):
+                    continue
+                # Модуль рендеринга загружается, только когда шаблон действительно изменился
+                import card_engine
+                try:
+                    if card_engine.reload_template(path):
+                        changed.append(path)
+                        logger.info("Шаблон %s изменен и будет скомпилирован заново", path)
+                except (OSError, ValueError) as e:
+                    # Файл могут еще записывать: повторим при следующей проверке
+                    logger.warning("Не удалось перечитать шаблон %s: %s", path, e)
+                    continue
+                self._stamps[path] = stamp
+        return changed
+
+    def refresh_if_due(self):
+        """Проверяет шаблоны, если с прошлой проверки прошло poll_interval секунд"""
+        if time.monotonic() - self._checked >= self.poll_interval:
+            return self.refresh()
+        return []
+
+    def template_for(self, family=None):
+        """Путь к шаблону для семейства отливки (или к шаблону по умолчанию)"""
+        self.refresh_if_due()
+        return self.families.get(family, self.default)
+
+    def precompile(self):
+        """Компилирует все шаблоны заранее (в текущем потоке); возвращает их количество"""
+        import card_engine
+        count = 0
+        for path in self.paths():
+            try:
+                card_engine.get_snapshot(path)
+                count += 1
+            except (OSError, ValueError) as e:
+                logger.warning("Не удалось подготовить шаблон %s: %s", path, e)
+        return count
+
+
+def get_registry():
+    """Общий реестр шаблонов процесса"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TemplateRegistry()
+        return _registry
+
+
+def load_cast_families(reference_path=None):
+    """Номер отливки -> семейство по справочнику; пустой словарь, если справочника нет"""
+    from create_reference_db import REFERENCE_DB_PATH
+    from reference_cache import ReferenceCache
+    path = reference_path or REFERENCE_DB_PATH
+    if not os.path.exists(path):
+        return {}
+    cache = ReferenceCache(path)
+    try:
+        return dict(cache.snapshot().cast_families)
+    finally:
+        cache.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Шаблоны карт по семействам отливок")
+    parser.add_argument('--dir', default=TEMPLATES_DIR, help="Каталог шаблонов")
+    parser.add_argument('--default', default=DEFAULT_TEMPLATE, help="Шаблон по умолчанию вне каталога")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    registry = TemplateRegistry(args.dir, args.default)
+    started = time.perf_counter()
+    count = registry.precompile()
+    for family in CAST_FAMILIES:
+        print(f"{family}: {registry.families.get(family, registry.default)}")
+    print(f"По умолчанию: {registry.default}")
+    print(f"Скомпилировано шаблонов: {count} за {time.perf_counter() - started:.2f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import sqlite3
+import threading
+
+import pytest
+
+import benchmarks
+import create_history_db
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = create_history_db.HistoryRepository(str(tmp_path / 'история_форм.db'))
+    repository.create_schema()
+    yield repository
+    repository.close()
+
+
+def test_reserve_cluster_numbers_across_processes():
+    # Несколько процессов резервируют номера в одной базе: без повторов и пропусков
+    result = benchmarks.stress_cluster_allocation(processes=4, rounds=10, batch=3)
+    assert result['allocated'] == 120
+    assert result['duplicates'] == 0
+    assert not result['gaps']
+
+
+def test_reserve_continues_after_saved_number(repository):
+    repository.save_form({'cluster_number': 'К25/03-005'})
+    assert repository.reserve_cluster_numbers('01.03.2025', 2) == ['К25/03-006', 'К25/03-007']
+
+
+def test_bulk_import_reports_bad_records(repository):
+    repository.save_form({'cluster_number': 'К25/03-001'})
+    report = repository.save_forms_bulk([
+        {'cluster_number': 'К25/03-001'},  # уже в базе
+        {'cluster_number': 'К25/03-002', 'gluing_date': '01.03.2025'},
+        {'cluster_number': 'К25/03-002'},  # повтор в загрузке
+        {'cluster_number': None},
+        {'cast_number': 'ЛСКМ.01'},  # без номера
+        'не запись',
+        {'cluster_number': 'К25/13-001'},  # нет такого месяца
+        {'cluster_number': 'К25/03-010'},
+    ])
+    assert report['inserted'] == 2
+    assert sorted(index for index, _, _ in report['conflicts']) == [0, 2]
+    assert [index for index, _, _ in report['invalid']] == [3, 4, 5, 6]
+
+    forms, _ = repository.search_forms(cluster_prefix='К25/03-002')
+    assert forms[0]['gluing_date'] == '01.03.2025'
+    assert forms[0]['cast_number'] == ''
+    # Загруженный номер продвигает счетчик месяца
+    assert repository.next_cluster_number('01.03.2025') == 'К25/03-011'
+
+
+def test_journal_mode_for_network_share(tmp_path, monkeypatch):
+    monkeypatch.setattr(create_history_db, 'HISTORY_JOURNAL_MODE', None)
+    assert create_history_db.default_journal_mode('//server/share/история_форм.db') == 'DELETE'
+    assert create_history_db.default_journal_mode(str(tmp_path / 'h.db')) == 'WAL'
+    with pytest.raises(ValueError):
+        create_history_db.HistoryRepository(str(tmp_path / 'h.db'), journal_mode='MEMORYX')
+
+
+def test_concurrent_first_open_of_legacy_db(tmp_path):
+    # Несколько станций одновременно впервые открывают базу прежней версии (без дат ISO)
+    path = str(tmp_path / 'история_форм.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "Маршрутные_Карты" ("ИД" INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 '"Номер_Кластера" TEXT NOT NULL, "Дата_Склейки" TEXT, "Дата_Контроля" TEXT, '
+                 '"Время_Контроля" TEXT, "Дата_Создания" TEXT)')
+    conn.executemany('INSERT INTO "Маршрутные_Карты" ("Номер_Кластера", "Дата_Склейки", "Дата_Создания") '
+                     'VALUES (?, ?, ?)',
+                     [(f'К25/03-{i:03d}', '01.03.2025', '01.03.2025 10:00:00') for i in range(1, 51)])
+    conn.commit()
+    conn.close()
+
+    repositories = [create_history_db.HistoryRepository(path) for _ in range(4)]
+    shared = create_history_db.HistoryRepository(path)
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def open_repository(repository):
+        barrier.wait()
+        try:
+            with repository.connection():
+                pass
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_repository, args=(repository,))
+               for repository in repositories + [shared] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for repository in repositories + [shared]:
+        repository.close()
+
+    assert not errors
+    # Даты ISO заполнены: поиск по дате склейки находит все карты
+    repository = create_history_db.HistoryRepository(path)
+    forms, _ = repository.search_forms(date_from='01.03.2025', date_to='01.03.2025', limit=100)
+    repository.close()
+    assert len(forms) == 50
+
+
+def test_peek_does_not_reserve(repository):
+    # Номер для формы не резервируется: повторный показ и несохраненная карта не дают пропусков
+    assert repository.peek_cluster_number('01.03.2025') == 'К25/03-001'
+    assert repository.peek_cluster_number('01.03.2025') == 'К25/03-001'
+    repository.save_form({'cluster_number': 'К25/03-001'})
+    assert repository.peek_cluster_number('01.03.2025') == 'К25/03-002'
+    assert repository.reserve_cluster_numbers('01.03.2025', 1) == ['К25/03-002']
@@ -0,0 +1,59 @@
+import os
+
+from output_store import OutputStore, directory_hits, store_file
+
+
+def _data(number):
+    return {'cluster_number': f'К25/03-{number:03d}', 'gluing_date': '01.03.2025'}
+
+
+def _writer(size, calls=None):
+    def write(f):
+        if calls is not None:
+            calls.append(f)
+        f.write(b'x' * size)
+    return write
+
+
+def test_fetch_writes_once(tmp_path):
+    store = OutputStore(str(tmp_path), max_bytes=10000)
+    calls = []
+    first = store.fetch('a' * 64, _data(1), '.pptx', _writer(100, calls))
+    second = store.fetch('a' * 64, _data(1), '.pptx', _writer(100, calls))
+    assert first == second
+    assert len(calls) == 1
+    assert os.path.dirname(first) == os.path.join(str(tmp_path), '2025', '03')
+    assert store.stats()['hits'] == 1
+
+
+def test_eviction_keeps_store_under_limit(tmp_path):
+    store = OutputStore(str(tmp_path), max_bytes=1000)
+    paths = []
+    for number in range(1, 6):
+        paths.append(store.fetch(f'{number:064d}', _data(number), '.pptx', _writer(300)))
+        # Разное время обращения, чтобы порядок вытеснения был определен
+        os.utime(paths[-1], (number, number))
+        store._index[paths[-1]][0] = number
+
+    stats = store.stats()
+    assert stats['bytes'] <= 1000
+    assert os.path.exists(paths[-1])
+    assert not os.path.exists(paths[0])
+    # Занятый объем сходится с файлами на диске
+    assert stats['bytes'] == sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def test_index_is_read_from_disk(tmp_path):
+    OutputStore(str(tmp_path)).fetch('b' * 64, _data(2), '.png', _writer(50))
+    assert OutputStore(str(tmp_path)).stats()['files'] == 1
+
+
+def test_store_file_counts_directory_hits(tmp_path):
+    calls = []
+    hits = directory_hits()
+    first = store_file('ключ', _data(1), '.pptx', _writer(10, calls), str(tmp_path))
+    assert directory_hits() == hits
+    # Файл с тем же ключом уже в каталоге: не перезаписывается и считается попаданием
+    assert store_file('ключ', _data(1), '.pptx', _writer(10, calls), str(tmp_path)) == first
+    assert len(calls) == 1
+    assert directory_hits() == hits + 1
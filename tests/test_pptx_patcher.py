@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+import card_engine
+import pptx_patcher
+from benchmarks import SAMPLE_RECORD, sample_records
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ШАБЛОН.pptx')
+
+# Кроме типовых записей: пустые поля, спецсимволы XML, поля операций, не вошедшие в форму
+RECORDS = list(sample_records(5)) + [
+    dict(SAMPLE_RECORD, cluster_number='К25/04-001', gluing_notes='Петров & Ко <"x">',
+         control_notes='  два   пробела '),
+    {'cluster_number': 'К25/04-002'},
+    dict(SAMPLE_RECORD, cluster_number='К25/04-003', pouring_date='05.03.2025',
+         pouring_executor='Иванов', cutting_notes='ок'),
+]
+
+
+@pytest.mark.parametrize('qr_mode', card_engine.QR_MODES)
+def test_patcher_matches_python_pptx(qr_mode):
+    assert pptx_patcher.check_parity(TEMPLATE_PATH, RECORDS, qr_mode) == []
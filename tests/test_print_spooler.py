@@ -0,0 +1,45 @@
+import sys
+
+from print_spooler import JOB_DONE, JOB_FAILED, PrintSpooler
+
+
+def _factory(calls, failing=()):
+    # Команда печати - интерпретатор Python, завершающийся с ошибкой для файлов из failing
+    def command(paths, printer, copies):
+        calls.append((list(paths), copies))
+        code = 1 if set(paths) & set(failing) else 0
+        return [sys.executable, '-c', f'import sys; sys.exit({code})']
+    return command
+
+
+def _run(spooler, files):
+    jobs = [spooler.submit(path, copies) for path, copies in files]
+    spooler.shutdown(timeout=30)
+    return jobs
+
+
+def test_batch_grouped_by_copies():
+    calls = []
+    spooler = PrintSpooler(command_factory=_factory(calls), retry_delay=0, batch_window=1, per_file=False)
+    jobs = _run(spooler, [('a.pptx', 1), ('b.pptx', 2), ('c.pptx', 1), ('d.pptx', 2)])
+    assert calls == [(['a.pptx', 'c.pptx'], 1), (['b.pptx', 'd.pptx'], 2)]
+    assert all(job.status == JOB_DONE and job.batch_size == 2 for job in jobs)
+
+
+def test_retries_stop_after_max_retries():
+    calls = []
+    spooler = PrintSpooler(command_factory=_factory(calls, failing=['a.pptx']), max_retries=2,
+                           retry_delay=0, batch_window=0, per_file=False)
+    job, = _run(spooler, [('a.pptx', 1)])
+    assert len(calls) == 3
+    assert job.status == JOB_FAILED
+    assert job.attempts == 3
+
+
+def test_per_file_retry_does_not_resend_printed_files():
+    calls = []
+    spooler = PrintSpooler(command_factory=_factory(calls, failing=['b.pptx']), max_retries=2,
+                           retry_delay=0, batch_window=1, per_file=True)
+    jobs = _run(spooler, [('a.pptx', 1), ('b.pptx', 1), ('c.pptx', 1)])
+    assert [paths for paths, _ in calls] == [['a.pptx'], ['b.pptx'], ['b.pptx'], ['b.pptx'], ['c.pptx']]
+    assert [job.status for job in jobs] == [JOB_DONE, JOB_FAILED, JOB_DONE]
@@ -0,0 +1,56 @@
+import sqlite3
+
+import pytest
+
+import create_reference_db
+import reference_import
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'справочник.db'))
+    yield conn
+    conn.close()
+
+
+def _castings(conn):
+    return sorted(conn.execute('SELECT "Номер", "Наименование", "Семейство" FROM "Отливки"'))
+
+
+def test_prune_keeps_rows_when_file_has_invalid_rows(conn):
+    create_reference_db.ensure_reference_schema(conn)
+    reference_import.upsert_castings(conn, [
+        {'Номер': 'ЛГМ.01', 'Наименование': 'Корпус', 'Семейство': 'ЛГМ'},
+        {'Номер': 'ЛГМ.02', 'Наименование': 'Крышка', 'Семейство': 'ЛГМ'},
+    ])
+    # Строка ЛГМ.02 с опечаткой в семействе не должна удалить существующую отливку
+    report = reference_import.upsert_castings(conn, [
+        {'Номер': 'ЛГМ.01', 'Наименование': 'Корпус', 'Семейство': 'ЛГМ'},
+        {'Номер': 'ЛГМ.02', 'Наименование': 'Крышка', 'Семейство': 'ЛГ'},
+    ], prune=True)
+    assert len(report['invalid']) == 1
+    assert report['removed'] == []
+    assert [row[0] for row in _castings(conn)] == ['ЛГМ.01', 'ЛГМ.02']
+
+    report = reference_import.upsert_castings(conn, [
+        {'Номер': 'ЛГМ.01', 'Наименование': 'Корпус', 'Семейство': 'ЛГМ'},
+    ], prune=True)
+    assert report['removed'] == [('ЛГМ.02',)]
+    assert [row[0] for row in _castings(conn)] == ['ЛГМ.01']
+
+
+def test_legacy_migration_resumes_after_interrupted_run(conn):
+    conn.execute('CREATE TABLE "ЛГМ_Отливки" ("Номер" TEXT, "Наименование" TEXT)')
+    conn.execute('CREATE TABLE "Сборщики" ("ФИО" TEXT)')
+    conn.execute('INSERT INTO "ЛГМ_Отливки" VALUES (\'ЛГМ.01\', \'Корпус\')')
+    conn.execute('INSERT INTO "Сборщики" VALUES (\'Иванов И.И.\')')
+    # Прошлый запуск создал новые таблицы и прервался до переноса данных
+    for sql in create_reference_db.CREATE_REFERENCE_SCHEMA_SQL:
+        conn.execute(sql)
+    conn.commit()
+
+    assert create_reference_db.ensure_reference_schema(conn)
+    assert _castings(conn) == [('ЛГМ.01', 'Корпус', 'ЛГМ')]
+    assert conn.execute('SELECT "ФИО", "Роль" FROM "Люди"').fetchall() == [('Иванов И.И.', 'Сборщик')]
+    # Повторный запуск ничего не переносит
+    assert not create_reference_db.ensure_reference_schema(conn)
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import create_history_db
+from render_service import RenderService
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ШАБЛОН.pptx')
+
+
+@pytest.fixture
+def service(tmp_path):
+    repository = create_history_db.HistoryRepository(str(tmp_path / 'история_форм.db'), pool_size=1)
+    service = RenderService(TEMPLATE_PATH, workers=1, repository=repository)
+    yield service
+    service.close()
+
+
+def _status(response):
+    return int(response[0])
+
+
+def _request(service, method, target, body=b''):
+    return asyncio.run(service._dispatch(method, target, body))
+
+
+async def _raw_request(service, data):
+    # Запрос через сокет: ответ на ошибку в заголовках дает handle_connection
+    server = await asyncio.start_server(service.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), 10)
+        writer.close()
+        await writer.wait_closed()
+    return status_line
+
+
+@pytest.mark.parametrize('length', ['abc', '-5'])
+def test_bad_content_length(service, length):
+    request = f'POST /render HTTP/1.1\r\nHost: test\r\nContent-Length: {length}\r\n\r\n'.encode('latin-1')
+    assert asyncio.run(_raw_request(service, request)).startswith(b'HTTP/1.1 400')
+
+
+def test_body_too_large(service):
+    request = b'POST /render HTTP/1.1\r\nHost: test\r\nContent-Length: 99999999\r\n\r\n'
+    assert asyncio.run(_raw_request(service, request)).startswith(b'HTTP/1.1 413')
+
+
+@pytest.mark.parametrize('after', ['{"x": 1}', '5', 'not json'])
+def test_history_cursor_validation(service, after):
+    assert _status(_request(service, 'GET', f'/history?after={after}')) == 400
+
+
+@pytest.mark.parametrize('target, body', [
+    ('/render', b'[1, 2]'),
+    ('/render', b'{not json'),
+    ('/render', json.dumps({'cast_number': 'ЛСКМ.01'}).encode('utf-8')),
+    ('/render?format=doc', json.dumps({'cluster_number': 'К25/03-001'}).encode('utf-8')),
+    ('/render', json.dumps({'cluster_number': 'К25/3-1'}).encode('utf-8')),
+    ('/cluster-numbers', json.dumps({'date': '01.03.2025', 'count': 'много'}).encode('utf-8')),
+    ('/cluster-numbers', json.dumps({'date': 'вчера'}).encode('utf-8')),
+])
+def test_invalid_requests(service, target, body):
+    assert _status(_request(service, 'POST', target, body)) == 400
+
+
+def test_duplicate_cluster_number_conflict(service, monkeypatch):
+    monkeypatch.setattr(service, 'render_bytes', lambda data, fmt='pptx', cache=None, template_path=None: b'card')
+    body = json.dumps({'cluster_number': 'К25/03-001'}).encode('utf-8')
+    assert _status(_request(service, 'POST', '/render', body)) == 200
+    assert _status(_request(service, 'POST', '/render', body)) == 409
+
+
+def test_peek_cluster_number(service):
+    for _ in range(2):
+        response = _request(service, 'GET', '/cluster-numbers?date=01.03.2025')
+        assert _status(response) == 200
+        assert json.loads(response[2])['number'] == 'К25/03-001'
+    assert _status(_request(service, 'GET', '/cluster-numbers?date=вчера')) == 400
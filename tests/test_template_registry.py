@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import card_engine
+from template_registry import TemplateRegistry
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(REPO_DIR, 'ШАБЛОН.pptx')
+
+RECORD = {
+    'cluster_number': 'К25/03-001',
+    'cast_number': 'ЛСКМ.03.01.102-Л1',
+    'gluing_date': '01.03.2025',
+    'pouring_date': '05.03.2025',
+    'pouring_executor': 'Иванов',
+}
+
+
+@pytest.fixture
+def templates_dir(tmp_path):
+    directory = tmp_path / 'шаблоны'
+    directory.mkdir()
+    shutil.copy(TEMPLATE_PATH, directory / 'ШАБЛОН.pptx')
+    shutil.copy(TEMPLATE_PATH, directory / 'ШАБЛОН_ЛГМ.pptx')
+    # Своя спецификация шаблона ЛГМ заполняет и строки других операций
+    shutil.copy(os.path.join(REPO_DIR, 'field_mapping_full.json'), directory / 'ШАБЛОН_ЛГМ.json')
+    return directory
+
+
+def test_template_for_family(templates_dir):
+    registry = TemplateRegistry(str(templates_dir), TEMPLATE_PATH)
+    assert registry.template_for('ЛГМ').endswith('ШАБЛОН_ЛГМ.pptx')
+    assert registry.template_for('ЛПД').endswith(os.path.join('шаблоны', 'ШАБЛОН.pptx'))
+
+
+def test_sidecar_mapping_fields(templates_dir):
+    family_template = str(templates_dir / 'ШАБЛОН_ЛГМ.pptx')
+    default_template = str(templates_dir / 'ШАБЛОН.pptx')
+    assert 'pouring_date' in card_engine.template_fields(family_template)
+    assert 'pouring_date' not in card_engine.template_fields(default_template)
+
+    data = card_engine.normalize_form_data(RECORD, card_engine.template_fields(family_template))
+    assert data['pouring_executor'] == 'Иванов'
+    # Карты, различающиеся только полями спецификации шаблона, получают разные ключи
+    changed = dict(data, pouring_executor='Петров')
+    assert card_engine.card_key(family_template, data) != card_engine.card_key(family_template, changed)
+
+
+def test_changed_template_is_recompiled(templates_dir):
+    registry = TemplateRegistry(str(templates_dir), TEMPLATE_PATH, poll_interval=0)
+    family_template = registry.template_for('ЛГМ')
+    default_template = registry.template_for()
+    snapshot = card_engine.get_snapshot(family_template)
+    other = card_engine.get_snapshot(default_template)
+    assert registry.refresh() == []
+
+    mapping_path = templates_dir / 'ШАБЛОН_ЛГМ.json'
+    mapping = json.loads(mapping_path.read_text(encoding='utf-8'))
+    mapping['qr']['size'] = 300000
+    mapping_path.write_text(json.dumps(mapping, ensure_ascii=False), encoding='utf-8')
+
+    assert registry.refresh() == [family_template]
+    rebuilt = card_engine.get_snapshot(family_template)
+    assert rebuilt is not snapshot
+    assert rebuilt.plan['qr_positions'][0][2] == 300000
+    assert card_engine.get_snapshot(default_template) is other